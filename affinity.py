@@ -0,0 +1,115 @@
+from collections import deque
+from typing import Optional
+import hashlib
+import re
+
+from utils import json_dumps, json_string_values
+
+_MESSAGES = re.compile(rb'"messages"\s*:\s*\[')
+
+def prefix_fingerprint(request_body: dict):
+    """
+    Fingerprint the shared prefix of a chat request (system prompt and leading turns)
+    Returns:
+        str: Hex digest of every message except the last one, None if there is no prefix
+    """
+    messages = request_body.get("messages")
+    if not isinstance(messages, list) or len(messages) < 2:
+        return None
+    return hashlib.blake2b(json_dumps(messages[:-1]), digest_size=8).hexdigest()
+
+def raw_prefix_fingerprint(request: bytes):
+    """
+    prefix_fingerprint for a raw chat request body, hashing the bytes of every message except the last one
+    Requests from the same client serialize a shared prefix the same way, so they get the same key
+    Raises:
+        ValueError: If a content string is not terminated
+    """
+    messages = _MESSAGES.search(request)
+    if messages is None:
+        return None
+    contents = json_string_values(request, "content")
+    if len(contents) < 2:
+        return None
+    # The last message's object starts at the last brace before its content
+    last_message = request.rfind(b"{", messages.end(), contents[-1][0])
+    if last_message < 0:
+        return None
+    return hashlib.blake2b(request[messages.end():last_message], digest_size=8).hexdigest()
+
+class AffinityTracker:
+    def __init__(self, window: int = 8, min_time_left: float = 15, per_provider: int = 4):
+        """
+        Prefer giving a provider tasks whose prefix it has recently processed,
+        so llama.cpp can reuse its prompt cache
+        Args:
+            window: Number of tasks at the head of the queue considered
+            min_time_left: Never pass over a task with less time left than this
+            per_provider: Number of recent prefixes remembered per provider
+        """
+        self.window = window
+        self.min_time_left = min_time_left
+        self.per_provider = per_provider
+        self.recent = {}
+
+        # Counters for reporting
+        self.lookups = 0
+        self.hits = 0
+        self.reorders = 0
+
+    def record(self, provider_id: int, prefix_key: str) -> None:
+        """Remember that a provider was handed a task with this prefix"""
+        if prefix_key is None:
+            return
+        keys = self.recent.get(provider_id)
+        if keys is None:
+            keys = self.recent[provider_id] = deque(maxlen=self.per_provider)
+        elif prefix_key in keys:
+            keys.remove(prefix_key)
+        keys.append(prefix_key)
+
+    def count_lookup(self, provider_id: int, prefix_key: str) -> None:
+        """
+        Count one fetch_task call that handed out a task, and a hit if its prefix
+        is one the provider recently processed
+        Call before record(), select() runs once per level and traffic class so it can't count fetches itself
+        """
+        self.lookups += 1
+        keys = self.recent.get(provider_id)
+        if prefix_key is not None and keys and prefix_key in keys:
+            self.hits += 1
+
+    def select(self, provider_id: int, tasks: list, now: float) -> Optional[int]:
+        """
+        Pick which of the candidate tasks to hand to a provider
+        Args:
+            provider_id: ID of the provider asking for work
+            tasks: Candidate tasks in scheduling order
+            now: Current timestamp
+        Returns:
+            int: Index into tasks, or None if no task matches a cached prefix
+        """
+        keys = self.recent.get(provider_id)
+        if not keys:
+            return None
+
+        for index, task in enumerate(tasks[:self.window]):
+            if task.prefix_key is not None and task.prefix_key in keys:
+                if index:
+                    self.reorders += 1
+                return index
+            # Don't let a cache hit push an urgent task past its deadline
+            expires_at = task.expires_at()
+            if expires_at is not None and expires_at - now < self.min_time_left:
+                break
+        return None
+
+    def stats(self) -> dict:
+        """Get affinity statistics"""
+        return {
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+            "reorders": self.reorders,
+            "providers": len(self.recent)
+        }
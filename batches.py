@@ -0,0 +1,44 @@
+import asyncio
+import time
+
+class Batch:
+    def __init__(self, batch_id: str, owner_id: int, total: int):
+        """
+        Progress of a batch of chat requests streamed back as NDJSON
+        Args:
+            batch_id: Unique identifier for the batch
+            owner_id: ID of the user who submitted the batch
+            total: Number of requests in the batch
+        """
+        self.batch_id = batch_id
+        self.owner_id = owner_id
+        self.total = total
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.created_at = time.time()
+        self.cancel_event = asyncio.Event()
+
+    @property
+    def pending(self) -> int:
+        return self.total - self.completed - self.failed - self.cancelled
+
+    def status(self) -> str:
+        if self.pending == 0:
+            return "finished"
+        if self.cancel_event.is_set():
+            return "cancelling"
+        return "running"
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.batch_id,
+            "object": "batch",
+            "status": self.status(),
+            "total": self.total,
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+            "pending": self.pending,
+            "created_at": self.created_at
+        }
@@ -0,0 +1,79 @@
+"""
+Measure queue throughput of the shared SQLite backend with 1 to N worker processes
+
+Each worker repeatedly registers a pending result, enqueues a task, takes a task
+from the shared queue, claims it and publishes its result, which is the backend
+work behind one chat request. The in-process CustomQueue is measured with one
+worker for reference, it cannot be shared.
+
+    python -m benchmarks.backend_scaling --workers 1 2 4 8 --seconds 5
+"""
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+import uuid
+
+from custom_queue import CustomQueue, QueueMode, Task
+from shared_backend import SQLitePendingResults, SQLiteTaskQueue
+
+REQUEST_BODY = {"messages": [{"role": "system", "content": "s" * 200}, {"role": "user", "content": "x" * 200}]}
+
+def run_cycles(task_queue, pending_results, seconds: float) -> int:
+    """Run request cycles against the backends for the given time, return completed cycles"""
+    cycles = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        task_id = str(uuid.uuid4())
+        pending_results[task_id] = None
+        task_queue.put(Task(request_body=REQUEST_BODY, requester_id=1, task_id=task_id), 0)
+        task = task_queue.get(QueueMode.PURE_FIFO)
+        if task is None:
+            continue
+        task.claimed_at = time.time()
+        task_queue.claim(task)
+        result_future = pending_results.get(task.task_id)
+        if result_future is not None:
+            if hasattr(result_future, "set_result"):
+                result_future.set_result({"choices": []})
+            pending_results.pop(task.task_id, None)
+        task_queue.remove_task(task.task_id)
+        cycles += 1
+    return cycles
+
+def shared_worker(path: str, seconds: float, start, results) -> None:
+    task_queue = SQLiteTaskQueue(path)
+    pending_results = SQLitePendingResults(path)
+    start.wait()
+    results.put(run_cycles(task_queue, pending_results, seconds))
+
+def measure_shared(workers: int, seconds: float) -> float:
+    path = os.path.join(tempfile.mkdtemp(), "queue.db")
+    SQLiteTaskQueue(path)  # create the schema before the workers race for it
+    start = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=shared_worker, args=(path, seconds, start, results))
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    start.set()
+    total = sum(results.get() for _ in processes)
+    for process in processes:
+        process.join()
+    return total / seconds
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    memory = run_cycles(CustomQueue(), {}, args.seconds) / args.seconds
+    print(f"memory  workers=1: {memory:10.0f} cycles/s")
+    for workers in args.workers:
+        throughput = measure_shared(workers, args.seconds)
+        print(f"sqlite  workers={workers}: {throughput:10.0f} cycles/s")
+
+if __name__ == "__main__":
+    main()
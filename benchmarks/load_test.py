@@ -0,0 +1,283 @@
+"""
+End-to-end load test of the gateway with simulated requesters and providers
+
+Starts the app from main.py, either in this process (httpx ASGI transport, no
+sockets) or as a uvicorn server on loopback, in a scratch directory with its
+own data.db. Requesters arrive as a Poisson process with a mix of credits and
+payload sizes; providers poll fetch_task, sleep for a sampled service time
+and submit, some fail fast with an error completion or abandon their claim.
+
+Reports throughput, latency percentiles, the 408 rate and server CPU time.
+
+    python -m benchmarks.load_test --rate 20 --providers 8 --duration 60
+    python -m benchmarks.load_test --server --workers 2 --rate 50 --service-mean 0.2
+"""
+import argparse
+import asyncio
+import math
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import httpx
+
+import main as gateway
+from database import init_db
+from models import AVAILABLE_MODELS, get_default_model
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def parse_mix(text: str) -> list:
+    """Parse "credit:share,credit:share" into [(credit, share)]"""
+    mix = []
+    for part in text.split(","):
+        credit, share = part.split(":")
+        mix.append((int(credit), float(share)))
+    return mix
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def create_users(path: str, requesters: list, providers: int) -> tuple:
+    """
+    Create requester and provider accounts in a fresh data.db
+    Args:
+        requesters: Credit of each requester account
+    Returns:
+        tuple: (requester tokens, provider tokens) in user_id-token form
+    """
+    conn = sqlite3.connect(path)
+    rows = [(user_id, f"load{user_id}", "t", credit) for user_id, credit in enumerate(requesters, 1)]
+    rows += [(len(requesters) + i + 1, f"provider{i}", "t", 0) for i in range(providers)]
+    conn.executemany("INSERT INTO users (telegram_id, telegram_name, token, credit) VALUES (?, ?, ?, ?)", rows)
+    conn.commit()
+    conn.close()
+    tokens = [f"{user_id}-t" for user_id, *_ in rows]
+    return tokens[:len(requesters)], tokens[len(requesters):]
+
+class Stats:
+    def __init__(self):
+        self.latencies = []
+        self.statuses = Counter()
+        self.fetches = 0
+        self.empty_fetches = 0
+        self.served = 0
+        self.failed = 0
+        self.abandoned = 0
+        self.started_at = None
+        self.last_completion = None
+        self.finished_at = None
+
+async def requester(client: httpx.AsyncClient, token: str, args, rng: random.Random, stats: Stats):
+    chars = rng.randint(args.min_chars, args.max_chars)
+    body = {
+        "messages": [
+            {"role": "system", "content": "你是一个轻小说翻译模型。"},
+            {"role": "user", "content": "あ" * chars}
+        ],
+        "max_tokens": min(args.max_tokens, chars * 2)
+    }
+    start = time.perf_counter()
+    try:
+        r = await client.post(f"/{token}/v1/chat/completions", json=body)
+        status = r.status_code
+    except httpx.HTTPError:
+        status = "error"
+    if status == 200:
+        stats.last_completion = time.perf_counter()
+        stats.latencies.append(stats.last_completion - start)
+    stats.statuses[status] += 1
+
+async def provider(client: httpx.AsyncClient, token: str, meta: dict, args, rng: random.Random,
+                   stats: Stats, stop: asyncio.Event):
+    idle = args.poll_interval
+    while not stop.is_set():
+        try:
+            r = await client.post(f"/{token}/fetch_task", json=meta)
+            task = r.json()
+        except (httpx.HTTPError, ValueError):
+            await asyncio.sleep(args.poll_interval)
+            continue
+        stats.fetches += 1
+        if "task_id" not in task:
+            stats.empty_fetches += 1
+            await asyncio.sleep(idle)
+            # Back off while the queue stays empty, like a provider script would
+            idle = min(idle * args.poll_backoff, args.poll_max)
+            continue
+        idle = args.poll_interval
+
+        roll = rng.random()
+        if roll < args.abandon_rate:
+            # Claim and never answer, the gateway re-queues after CLAIM_TIMEOUT
+            stats.abandoned += 1
+            continue
+        if roll < args.abandon_rate + args.fail_rate:
+            stats.failed += 1
+            response = {"error": {"message": "llama.cpp crashed"}}
+        else:
+            await asyncio.sleep(rng.lognormvariate(args.service_mu, args.service_sigma))
+            response = {"choices": [{"message": {"role": "assistant", "content": "ok"}}]}
+        try:
+            await client.post(f"/{token}/submit_result", json={"task_id": task["task_id"], "response": response})
+            stats.served += 1
+        except httpx.HTTPError:
+            pass
+
+async def drive(client: httpx.AsyncClient, requester_tokens: list, provider_tokens: list, args) -> Stats:
+    rng = random.Random(args.seed)
+    meta = {"data": [AVAILABLE_MODELS[get_default_model()]]}
+    stats = Stats()
+    stop = asyncio.Event()
+    providers = [asyncio.create_task(provider(client, token, meta, args, random.Random(rng.random()), stats, stop))
+                 for token in provider_tokens]
+
+    requests = []
+    # Arrivals follow an absolute schedule so event loop delays don't lower the rate
+    stats.started_at = next_arrival = time.perf_counter()
+    deadline = next_arrival + args.duration
+    while True:
+        next_arrival += rng.expovariate(args.rate)
+        if next_arrival >= deadline:
+            break
+        await asyncio.sleep(max(0, next_arrival - time.perf_counter()))
+        token = rng.choice(requester_tokens)
+        requests.append(asyncio.create_task(requester(client, token, args, random.Random(rng.random()), stats)))
+
+    # Let requests in flight finish or time out
+    await asyncio.gather(*requests)
+    stop.set()
+    await asyncio.gather(*providers)
+    stats.finished_at = time.perf_counter()
+    return stats
+
+def server_cpu_seconds(pids: list) -> float:
+    """Sum user+system CPU time of processes and their children from /proc, Linux only"""
+    total = 0.0
+    ticks = os.sysconf("SC_CLK_TCK")
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        # utime, stime, cutime, cstime
+        total += sum(int(value) for value in fields[11:15]) / ticks
+    return total
+
+def child_pids(pid: int) -> list:
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+
+async def run_in_process(requester_tokens: list, provider_tokens: list, args) -> tuple:
+    async with gateway.lifespan(gateway.app):
+        transport = httpx.ASGITransport(app=gateway.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://gateway", timeout=None) as client:
+            start = time.process_time()
+            stats = await drive(client, requester_tokens, provider_tokens, args)
+            # Includes the simulated clients, they share the process
+            cpu = time.process_time() - start
+    return stats, cpu
+
+async def run_server(requester_tokens: list, provider_tokens: list, args) -> tuple:
+    env = dict(os.environ, PYTHONPATH=REPO + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(args.port),
+         "--workers", str(args.workers), "--log-level", "warning"],
+        env=env
+    )
+    base_url = f"http://127.0.0.1:{args.port}"
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    try:
+        async with httpx.AsyncClient(base_url=base_url, timeout=None, limits=limits) as client:
+            for _ in range(100):
+                try:
+                    if (await client.get(f"/{requester_tokens[0]}/v1/models")).status_code == 200:
+                        break
+                except httpx.HTTPError:
+                    pass
+                await asyncio.sleep(0.1)
+            else:
+                raise RuntimeError("Server did not start")
+
+            pids = [server.pid] + child_pids(server.pid)
+            start = server_cpu_seconds(pids)
+            stats = await drive(client, requester_tokens, provider_tokens, args)
+            cpu = server_cpu_seconds(pids) - start
+    finally:
+        server.terminate()
+        server.wait()
+    return stats, cpu
+
+def report(stats: Stats, cpu: float, args) -> None:
+    total = sum(stats.statuses.values())
+    completed = stats.statuses.get(200, 0)
+    span = (stats.last_completion or stats.started_at) - stats.started_at
+    print(f"requests:    {total} in {args.duration:.0f} s ({total / args.duration:.1f}/s offered)")
+    print(f"completed:   {completed} ({completed / span if span else 0:.1f}/s until the last completion)")
+    print(f"408 rate:    {stats.statuses.get(408, 0) / total if total else 0:.2%}")
+    print(f"statuses:    {dict(stats.statuses)}")
+    print(f"latency:     p50={percentile(stats.latencies, 0.5):.3f}s p90={percentile(stats.latencies, 0.9):.3f}s "
+          f"p99={percentile(stats.latencies, 0.99):.3f}s max={max(stats.latencies, default=float('nan')):.3f}s")
+    print(f"providers:   {stats.fetches} fetches, {stats.empty_fetches} empty, {stats.served} submitted, "
+          f"{stats.failed} failed, {stats.abandoned} abandoned")
+    label = "server CPU" if args.server else "process CPU"
+    print(f"{label}: {cpu:.2f} s ({cpu / (stats.finished_at - stats.started_at):.1%} of one core)")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--server", action="store_true", help="Run uvicorn on loopback instead of in-process")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers in server mode")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds of arrivals")
+    parser.add_argument("--seed", type=int, default=1)
+    # Requesters
+    parser.add_argument("--rate", type=float, default=10, help="Mean chat requests per second")
+    parser.add_argument("--requesters", type=int, default=50)
+    parser.add_argument("--credit-mix", type=parse_mix, default=parse_mix("0:0.8,10:0.15,100:0.05"),
+                        help="credit:share pairs of requester accounts")
+    parser.add_argument("--min-chars", type=int, default=20)
+    parser.add_argument("--max-chars", type=int, default=400)
+    parser.add_argument("--max-tokens", type=int, default=1024)
+    # Providers
+    parser.add_argument("--providers", type=int, default=8)
+    parser.add_argument("--service-mean", type=float, default=1.0, help="Mean service time in seconds")
+    parser.add_argument("--service-sigma", type=float, default=0.5, help="Log-normal shape of service time")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Share of tasks answered with an error")
+    parser.add_argument("--abandon-rate", type=float, default=0.0, help="Share of claims never answered")
+    parser.add_argument("--poll-interval", type=float, default=0.1, help="Sleep after an empty fetch")
+    parser.add_argument("--poll-backoff", type=float, default=1.0,
+                        help="Multiply the sleep by this after each empty fetch, 1 for fixed polling")
+    parser.add_argument("--poll-max", type=float, default=2.0, help="Longest sleep between fetches")
+    args = parser.parse_args()
+    # Log-normal mu giving the requested mean
+    args.service_mu = math.log(args.service_mean) - args.service_sigma ** 2 / 2
+
+    rng = random.Random(args.seed)
+    credits, shares = zip(*args.credit_mix)
+    requester_credits = rng.choices(credits, shares, k=args.requesters)
+
+    # The gateway opens data.db and its other files relative to the working directory
+    os.chdir(tempfile.mkdtemp(prefix="sakura-load-"))
+    init_db()
+    requester_tokens, provider_tokens = create_users("data.db", requester_credits, args.providers)
+
+    if args.server:
+        stats, cpu = asyncio.run(run_server(requester_tokens, provider_tokens, args))
+    else:
+        stats, cpu = asyncio.run(run_in_process(requester_tokens, provider_tokens, args))
+    report(stats, cpu, args)
+
+if __name__ == "__main__":
+    main()
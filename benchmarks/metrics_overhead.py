@@ -0,0 +1,66 @@
+"""
+Measure the cost of recording metrics in nanoseconds per event
+
+Covers the operations on the request path (counter and histogram updates on a
+cached child, a label lookup, the database timing decorator) and a full scrape.
+
+    python -m benchmarks.metrics_overhead --events 1000000
+"""
+import argparse
+import time
+
+from metrics import Registry, timed
+
+def per_event_ns(func, events: int) -> float:
+    """Run func events times and return the mean cost in nanoseconds, minus loop overhead"""
+    def empty():
+        pass
+
+    def loop(f) -> int:
+        start = time.perf_counter_ns()
+        for _ in range(events):
+            f()
+        return time.perf_counter_ns() - start
+
+    return (loop(func) - loop(empty)) / events
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=1000000)
+    args = parser.parse_args()
+
+    registry = Registry()
+    counter = registry.counter("bench_total", "Counter")
+    labelled = registry.counter("bench_labelled_total", "Labelled counter", ("mode",))
+    histogram = registry.histogram("bench_seconds", "Histogram")
+    functions = registry.histogram("bench_function_seconds", "Timed functions", ("function",))
+    child = labelled.labels("pure_fifo")
+
+    @timed(functions)
+    def query():
+        pass
+
+    def bare_query():
+        pass
+
+    results = {
+        "counter.inc": per_event_ns(counter.inc, args.events),
+        "child.inc": per_event_ns(child.inc, args.events),
+        "labels().inc": per_event_ns(lambda: labelled.labels("pure_fifo").inc(), args.events)
+                        - per_event_ns(lambda: None, args.events),
+        "histogram.observe": per_event_ns(lambda: histogram.observe(0.042), args.events)
+                             - per_event_ns(lambda: None, args.events),
+        "@timed overhead": per_event_ns(query, args.events) - per_event_ns(bare_query, args.events)
+    }
+    for name, ns in results.items():
+        print(f"{name:>18}: {ns:7.1f} ns/event")
+
+    for values in ("a", "b", "c"):
+        labelled.labels(values).inc()
+        functions.labels(values).observe(0.01)
+    start = time.perf_counter_ns()
+    body = registry.render()
+    print(f"{'render':>18}: {(time.perf_counter_ns() - start) / 1000:7.1f} us for {len(body)} bytes")
+
+if __name__ == "__main__":
+    main()
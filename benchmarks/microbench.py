@@ -0,0 +1,268 @@
+"""
+Microbenchmarks for CustomQueue and database.py
+
+Queue: put, get in every QueueMode (with and without a select callback) and
+remove_task at several queue depths. Database: every database.py function
+against synthetic users tables of 1k to 1M rows, in a scratch directory.
+
+Results are median nanoseconds per call, written as JSON with --output.
+--compare checks them against an earlier file and exits with status 1 if
+anything got slower than --threshold.
+
+    python -m benchmarks.microbench --output baseline.json
+    python -m benchmarks.microbench --compare baseline.json --threshold 0.1
+    python -m benchmarks.microbench --only queue --depths 100 1000
+"""
+import argparse
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import database
+from custom_queue import CustomQueue, QueueMode, Task
+from dispatch import select_task
+from utils import json_dumps, json_loads
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def measure(run, target: float, repeat: int) -> dict:
+    """
+    Time a benchmark, run(count) performs count calls and returns the nanoseconds spent in them
+    The count is calibrated so one repeat takes about target seconds.
+    """
+    count = 1
+    while True:
+        elapsed = run(count)
+        if elapsed >= target * 1e9 / 10 or count >= 1 << 20:
+            break
+        count *= 10
+    count = max(1, int(count * target * 1e9 / max(elapsed, 1)))
+    samples = [run(count) / count for _ in range(repeat)]
+    return {"ns_per_op": statistics.median(samples), "min_ns": min(samples), "calls": count, "repeat": repeat}
+
+def make_task(rng: random.Random) -> Task:
+    chars = rng.randint(20, 2000)
+    return Task(request_body=None, requester_id=rng.randrange(1000), task_id=str(uuid.uuid4()),
+                prompt_tokens=chars + 60, generation_tokens=chars)
+
+def filled_queue(depth: int, rng: random.Random) -> tuple:
+    """A queue of depth tasks with a few priority levels, plus the (task, priority) pairs in it"""
+    queue = CustomQueue()
+    entries = [(make_task(rng), rng.choice((0, 0, 0, 1, 5, 100))) for _ in range(depth)]
+    for task, priority in entries:
+        queue.put(task, priority)
+    return queue, entries
+
+def queue_benchmarks(depths: list, target: float, repeat: int) -> dict:
+    results = {}
+    capacity = {"n_ctx": 8192, "tokens_per_second": 30}
+    for depth in depths:
+        rng = random.Random(depth)
+        queue, entries = filled_queue(depth, rng)
+        priorities = {task.task_id: priority for task, priority in entries}
+
+        def put(count):
+            # A fresh queue each time so the depth does not grow across runs
+            fresh, _ = filled_queue(depth, rng)
+            tasks = [make_task(rng) for _ in range(count)]
+            start = time.perf_counter_ns()
+            for task in tasks:
+                fresh.put(task, 0)
+            return time.perf_counter_ns() - start
+
+        def get(mode, select=None):
+            def run(count):
+                elapsed = 0
+                for _ in range(count):
+                    start = time.perf_counter_ns()
+                    task = queue.get(mode, select)
+                    elapsed += time.perf_counter_ns() - start
+                    # Keep the depth constant
+                    queue.put(task, priorities[task.task_id])
+                return elapsed
+            return run
+
+        def remove(count):
+            elapsed = 0
+            for _ in range(count):
+                task, priority = rng.choice(entries)
+                start = time.perf_counter_ns()
+                queue.remove_task(task.task_id)
+                elapsed += time.perf_counter_ns() - start
+                queue.put(task, priority)
+            return elapsed
+
+        for mode in QueueMode:
+            results[f"queue.get[{mode.name.lower()},depth={depth}]"] = measure(get(mode), target, repeat)
+        select = lambda tasks: select_task(tasks, 1, capacity, time.time())
+        results[f"queue.get_select[strict_priority,depth={depth}]"] = \
+            measure(get(QueueMode.STRICT_PRIORITY, select), target, repeat)
+        results[f"queue.remove_task[depth={depth}]"] = measure(remove, target, repeat)
+        results[f"queue.put[depth={depth}]"] = measure(put, target, repeat)
+    return results
+
+def fill_users(rows: int, rng: random.Random) -> None:
+    """Create data.db in the working directory with rows synthetic users"""
+    if os.path.exists("data.db"):
+        os.remove("data.db")
+    database.init_db()
+    conn = sqlite3.connect("data.db")
+    today = database.current_day()
+    batch = []
+    for telegram_id in range(1, rows + 1):
+        # About a tenth of the users were active today
+        batch.append((telegram_id, f"user{telegram_id}", "token", rng.randrange(1000), rng.randrange(100),
+                      rng.randrange(100000), rng.randrange(500), today - (rng.random() > 0.1)))
+        if len(batch) == 50000:
+            conn.executemany("INSERT INTO users (telegram_id, telegram_name, token, contribution, credit, "
+                             "total_usage, daily_usage, daily_usage_day) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", batch)
+            batch = []
+    if batch:
+        conn.executemany("INSERT INTO users (telegram_id, telegram_name, token, contribution, credit, "
+                         "total_usage, daily_usage, daily_usage_day) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", batch)
+    conn.commit()
+    conn.close()
+
+def database_benchmarks(sizes: list, target: float, repeat: int) -> dict:
+    results = {}
+    for rows in sizes:
+        rng = random.Random(rows)
+        fill_users(rows, rng)
+        user_ids = [rng.randint(1, rows) for _ in range(1000)]
+        next_new_id = [rows + 1]
+
+        def calls(func, *args_for):
+            def run(count):
+                ids = [user_ids[i % len(user_ids)] for i in range(count)]
+                start = time.perf_counter_ns()
+                for user_id in ids:
+                    func(*(arg(user_id) if callable(arg) else arg for arg in args_for))
+                return time.perf_counter_ns() - start
+            return run
+
+        def create_new(count):
+            ids = range(next_new_id[0], next_new_id[0] + count)
+            next_new_id[0] += count
+            start = time.perf_counter_ns()
+            for user_id in ids:
+                database.create_or_update_user(user_id, "new")
+            return time.perf_counter_ns() - start
+
+        same = lambda user_id: user_id
+        benchmarks = {
+            "is_token_valid": calls(database.is_token_valid, same, "token"),
+            "get_user_credit": calls(database.get_user_credit, same),
+            "get_user_info": calls(database.get_user_info, same),
+            "is_temp_banned": calls(database.is_temp_banned, same),
+            "increase_contribution": calls(database.increase_contribution, same),
+            "increase_credit": calls(database.increase_credit, same),
+            "increase_total_usage": calls(database.increase_total_usage, same),
+            "increase_daily_usage": calls(database.increase_daily_usage, same),
+            "set_temp_ban": calls(database.set_temp_ban, same, 0),
+            "set_user_ban_status": calls(database.set_user_ban_status, same, False),
+            "refresh_user_token": calls(database.refresh_user_token, same),
+            "create_or_update_user[existing]": calls(database.create_or_update_user, same, "renamed"),
+            "create_or_update_user[new]": create_new,
+            "get_top_contributors": calls(database.get_top_contributors, 5),
+            "get_top_credits": calls(database.get_top_credits, 5),
+            "get_top_total_usage": calls(database.get_top_total_usage, 5),
+            "get_top_daily_usage": calls(database.get_top_daily_usage, 5),
+            "init_db": calls(database.init_db),
+        }
+        for name, run in benchmarks.items():
+            results[f"db.{name}[rows={rows}]"] = measure(run, target, repeat)
+            print(f"  {name}[rows={rows}]: {results[f'db.{name}[rows={rows}]']['ns_per_op'] / 1000:.1f} us",
+                  file=sys.stderr)
+    return results
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "sqlite": sqlite3.sqlite_version,
+        "commit": commit,
+        "timestamp": time.time()
+    }
+
+def compare(baseline: dict, current: dict, threshold: float) -> int:
+    """
+    Print the change of every benchmark present in both runs
+    Returns:
+        int: Number of benchmarks slower than threshold
+    """
+    regressions = 0
+    for name, result in current["results"].items():
+        before = baseline["results"].get(name)
+        if before is None:
+            print(f"{name:<55} {result['ns_per_op']:>14.0f} ns  (new)")
+            continue
+        change = result["ns_per_op"] / before["ns_per_op"] - 1
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        elif change < -threshold:
+            flag = "  faster"
+        print(f"{name:<55} {before['ns_per_op']:>14.0f} -> {result['ns_per_op']:>14.0f} ns  {change:+7.1%}{flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", choices=("queue", "db"), help="Run only one group")
+    parser.add_argument("--depths", type=int, nargs="+", default=[100, 1000, 10000], help="Queue depths")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000, 1000000],
+                        help="users table sizes")
+    parser.add_argument("--target", type=float, default=0.2, help="Seconds per repeat")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--compare", help="Baseline JSON file to compare against")
+    parser.add_argument("--current", help="Compare this results file instead of running the benchmarks")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Slowdown flagged as a regression")
+    args = parser.parse_args()
+
+    if args.current:
+        with open(args.current, "rb") as f:
+            current = json_loads(f.read())
+    else:
+        results = {}
+        if args.only in (None, "queue"):
+            results.update(queue_benchmarks(args.depths, args.target, args.repeat))
+        if args.only in (None, "db"):
+            cwd = os.getcwd()
+            # database.py always opens data.db in the working directory
+            os.chdir(tempfile.mkdtemp(prefix="sakura-bench-"))
+            try:
+                results.update(database_benchmarks(args.rows, args.target, args.repeat))
+            finally:
+                os.chdir(cwd)
+        current = {"environment": environment(), "results": results}
+
+    if args.output:
+        with open(args.output, "wb") as f:
+            f.write(json_dumps(current))
+
+    if args.compare:
+        with open(args.compare, "rb") as f:
+            baseline = json_loads(f.read())
+        regressions = compare(baseline, current, args.threshold)
+        if regressions:
+            print(f"{regressions} regression(s) beyond {args.threshold:.0%}")
+            sys.exit(1)
+    elif not args.current:
+        for name, result in current["results"].items():
+            print(f"{name:<55} {result['ns_per_op']:>14.0f} ns/op")
+
+if __name__ == "__main__":
+    main()
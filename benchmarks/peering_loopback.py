@@ -0,0 +1,143 @@
+"""
+Overflow forwarding between two gateways on loopback
+
+Starts gateway A (no providers, peered with B) and gateway B (with simulated
+providers) as uvicorn processes in their own scratch directories. Chat
+requests sent to A stay unclaimed, are forwarded to B after --forward-after
+seconds and answered by B's providers. Reports latencies, status codes and
+both gateways' peering and queue figures.
+
+    python -m benchmarks.peering_loopback --requests 20 --providers 2
+"""
+import argparse
+import asyncio
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import httpx
+
+from models import AVAILABLE_MODELS, get_default_model
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs main.app with config overrides, config values are read when main is imported
+LAUNCHER = """
+import sys, config
+for name, value in eval(sys.argv[1]).items():
+    setattr(config, name, value)
+import uvicorn, main
+uvicorn.run(main.app, host="127.0.0.1", port=int(sys.argv[2]), log_level="warning")
+"""
+
+def create_users(directory: str, users: list) -> None:
+    """Create data.db in directory with (telegram_id, token) accounts"""
+    subprocess.run([sys.executable, "-c", "import database; database.init_db()"], cwd=directory, check=True,
+                   env=dict(os.environ, PYTHONPATH=REPO))
+    conn = sqlite3.connect(os.path.join(directory, "data.db"))
+    conn.executemany("INSERT INTO users (telegram_id, telegram_name, token) VALUES (?, ?, ?)",
+                     [(user_id, f"user{user_id}", token) for user_id, token in users])
+    conn.commit()
+    conn.close()
+
+def start_gateway(port: int, overrides: dict) -> subprocess.Popen:
+    directory = tempfile.mkdtemp(prefix=f"sakura-peer-{port}-")
+    create_users(directory, [(1, "req"), (2, "prov"), (100, "peer")])
+    return subprocess.Popen([sys.executable, "-c", LAUNCHER, repr(overrides), str(port)], cwd=directory,
+                            env=dict(os.environ, PYTHONPATH=REPO))
+
+async def wait_ready(client: httpx.AsyncClient, base_url: str) -> None:
+    for _ in range(100):
+        try:
+            if (await client.get(f"{base_url}/1-req/v1/models")).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.1)
+    raise RuntimeError(f"{base_url} did not start")
+
+async def provider(client: httpx.AsyncClient, base_url: str, service_time: float, stop: asyncio.Event,
+                   served: Counter):
+    meta = {"data": [AVAILABLE_MODELS[get_default_model()]]}
+    while not stop.is_set():
+        task = (await client.post(f"{base_url}/2-prov/fetch_task", json=meta)).json()
+        if "task_id" not in task:
+            await asyncio.sleep(0.1)
+            continue
+        await asyncio.sleep(service_time)
+        response = {"choices": [{"message": {"role": "assistant", "content": f"served by {base_url}"}}]}
+        await client.post(f"{base_url}/2-prov/submit_result", json={"task_id": task["task_id"], "response": response})
+        served[base_url] += 1
+
+async def requester(client: httpx.AsyncClient, base_url: str, results: list):
+    body = {"messages": [{"role": "user", "content": "こんにちは"}], "max_tokens": 16}
+    start = time.perf_counter()
+    r = await client.post(f"{base_url}/1-req/v1/chat/completions", json=body)
+    served_by = r.json()["choices"][0]["message"]["content"] if r.status_code == 200 else None
+    results.append((r.status_code, time.perf_counter() - start, served_by))
+
+async def run(args) -> None:
+    url_a = f"http://127.0.0.1:{args.port}"
+    url_b = f"http://127.0.0.1:{args.port + 1}"
+    # User 1 reads scheduler_stats, which is admin only
+    gateway_b = start_gateway(args.port + 1, {"PEER_ACCEPT_MAX_DEPTH": args.peer_depth, "ADMIN_USER_IDS": [1]})
+    gateway_a = start_gateway(args.port, {
+        "ADMIN_USER_IDS": [1],
+        "PEERS": [{"url": url_b, "token": "100-peer"}],
+        "PEER_FORWARD_AFTER": args.forward_after,
+        "PEER_MAX_DEPTH": args.peer_depth,
+        "PEER_POLL_INTERVAL": 1
+    })
+    try:
+        async with httpx.AsyncClient(timeout=None) as client:
+            await wait_ready(client, url_a)
+            await wait_ready(client, url_b)
+
+            stop = asyncio.Event()
+            served = Counter()
+            providers = [asyncio.create_task(provider(client, url_b, args.service_time, stop, served))
+                         for _ in range(args.providers)]
+            # Let A see B's idle providers
+            await asyncio.sleep(2)
+
+            results = []
+            requests = []
+            for _ in range(args.requests):
+                requests.append(asyncio.create_task(requester(client, url_a, results)))
+                await asyncio.sleep(args.interval)
+            await asyncio.gather(*requests)
+            stop.set()
+            await asyncio.gather(*providers)
+
+            stats_a = (await client.get(f"{url_a}/1-req/scheduler_stats")).json()
+            status_b = (await client.get(f"{url_b}/1-req/peer_status")).json()
+    finally:
+        for gateway in (gateway_a, gateway_b):
+            gateway.terminate()
+            gateway.wait()
+
+    latencies = sorted(latency for status, latency, _ in results if status == 200)
+    print(f"statuses:   {dict(Counter(status for status, _, _ in results))}")
+    print(f"served by:  {dict(Counter(served_by for _, _, served_by in results))}")
+    if latencies:
+        print(f"latency:    min={latencies[0]:.2f}s p50={latencies[len(latencies) // 2]:.2f}s max={latencies[-1]:.2f}s")
+    print(f"A peering:  {stats_a['peering']}")
+    print(f"B status:   {status_b}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8771, help="Port of A, B uses the next one")
+    parser.add_argument("--requests", type=int, default=10)
+    parser.add_argument("--interval", type=float, default=0.2, help="Seconds between requests to A")
+    parser.add_argument("--providers", type=int, default=2, help="Providers polling B")
+    parser.add_argument("--service-time", type=float, default=0.5)
+    parser.add_argument("--forward-after", type=float, default=2)
+    parser.add_argument("--peer-depth", type=int, default=2, help="PEER_MAX_DEPTH on A and PEER_ACCEPT_MAX_DEPTH on B")
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
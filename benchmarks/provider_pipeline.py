@@ -0,0 +1,129 @@
+"""
+Throughput of the reference provider worker against a serialized provider loop
+
+Runs the gateway from main.py and a stub llama.cpp server in this process
+(httpx ASGI transports, each request delayed by --rtt to stand in for the
+network), keeps the queue full with closed-loop requesters and serves it with
+either provider.ProviderWorker or, with --naive, the usual volunteer loop:
+fetch, generate, submit, repeat. Reports completions per second and how busy
+the stub's slots were.
+
+    python -m benchmarks.provider_pipeline --slots 4 --rtt 0.15
+    python -m benchmarks.provider_pipeline --slots 4 --rtt 0.15 --naive
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import httpx
+
+import main as gateway
+from benchmarks.load_test import create_users
+from benchmarks.stub_llama import create_app
+from database import init_db
+from provider import ProviderWorker
+
+class DelayedTransport(httpx.AsyncBaseTransport):
+    def __init__(self, transport: httpx.AsyncBaseTransport, delay: float):
+        """Wrap a transport, delaying each request by one network round trip"""
+        self.transport = transport
+        self.delay = delay
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(self.delay)
+        return await self.transport.handle_async_request(request)
+
+async def requester(client: httpx.AsyncClient, token: str, args, stop: asyncio.Event, statuses: list):
+    body = {
+        "messages": [
+            {"role": "system", "content": "你是一个轻小说翻译模型。"},
+            {"role": "user", "content": "あ" * args.chars}
+        ]
+    }
+    while not stop.is_set():
+        r = await client.post(f"/{token}/v1/chat/completions", json=body)
+        statuses.append(r.status_code)
+
+async def naive_provider(gateway_client: httpx.AsyncClient, llama_client: httpx.AsyncClient, token: str,
+                         poll_interval: float):
+    """fetch, generate, submit, sleep: one task at a time whatever the llama.cpp slot count"""
+    meta = (await llama_client.get("/v1/models")).json()
+    while True:
+        task = (await gateway_client.post(f"/{token}/fetch_task", json=meta)).json()
+        if "task_id" not in task:
+            await asyncio.sleep(poll_interval)
+            continue
+        result = (await llama_client.post("/v1/chat/completions", json=task["request_body"])).json()
+        await gateway_client.post(f"/{token}/submit_result", json={"task_id": task["task_id"], "response": result})
+
+async def run(requester_tokens: list, provider_token: str, args) -> None:
+    stub = create_app(args.slots, args.tokens_per_second)
+    stub_transport = DelayedTransport(httpx.ASGITransport(app=stub), args.llama_rtt)
+    async with gateway.lifespan(gateway.app):
+        gateway_transport = DelayedTransport(httpx.ASGITransport(app=gateway.app), args.rtt)
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=gateway.app), base_url="http://gateway",
+                                     timeout=None) as requester_client, \
+                httpx.AsyncClient(transport=gateway_transport, base_url="http://gateway",
+                                  timeout=None) as gateway_client, \
+                httpx.AsyncClient(transport=stub_transport, base_url="http://llama", timeout=None) as llama_client:
+            if args.naive:
+                provider = asyncio.create_task(naive_provider(gateway_client, llama_client, provider_token,
+                                                              args.poll_interval))
+            else:
+                worker = ProviderWorker("http://gateway", provider_token, "http://llama", prefetch=args.prefetch,
+                                        poll_interval=args.poll_interval, gateway_client=gateway_client,
+                                        llama_client=llama_client)
+                provider = asyncio.create_task(worker.run())
+
+            stop = asyncio.Event()
+            statuses = []
+            requesters = [asyncio.create_task(requester(requester_client, token, args, stop, statuses))
+                          for token in requester_tokens]
+            # Measure after warm-up, so start-up (meta validation, filling the slots) isn't counted
+            await asyncio.sleep(args.warmup)
+            await llama_client.post("/stats/reset")
+            completed_before = statuses.count(200)
+            start = time.perf_counter()
+            await asyncio.sleep(args.duration)
+            elapsed = time.perf_counter() - start
+            completed = statuses.count(200) - completed_before
+            stub_stats = (await llama_client.get("/stats")).json()
+
+            stop.set()
+            provider.cancel()
+            for task in requesters:
+                task.cancel()
+            await asyncio.gather(provider, *requesters, return_exceptions=True)
+
+    print(f"provider:    {'naive loop' if args.naive else f'ProviderWorker (prefetch {args.prefetch})'}")
+    print(f"completed:   {completed} in {elapsed:.1f} s ({completed / elapsed:.2f}/s)")
+    print(f"slots:       {stub_stats['slots']}, at most {stub_stats['max_active']} busy at once")
+    print(f"utilization: {stub_stats['utilization']:.1%} of slot time generating")
+    if not args.naive:
+        print(f"worker:      {worker.stats.as_dict(worker.slots)}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--naive", action="store_true", help="Serialized provider loop instead of ProviderWorker")
+    parser.add_argument("--slots", type=int, default=4, help="Parallel slots of the stub llama.cpp")
+    parser.add_argument("--tokens-per-second", type=float, default=200, help="Generation speed of each slot")
+    parser.add_argument("--chars", type=int, default=150, help="Source text length of each request")
+    parser.add_argument("--rtt", type=float, default=0.15, help="Seconds of network round trip to the gateway")
+    parser.add_argument("--llama-rtt", type=float, default=0.001, help="Seconds of round trip to llama.cpp")
+    parser.add_argument("--prefetch", type=int, default=1)
+    parser.add_argument("--poll-interval", type=float, default=0.1)
+    parser.add_argument("--requesters", type=int, default=16, help="Closed-loop requesters keeping the queue full")
+    parser.add_argument("--warmup", type=float, default=3)
+    parser.add_argument("--duration", type=float, default=20)
+    args = parser.parse_args()
+
+    # The gateway opens data.db and its other files relative to the working directory
+    os.chdir(tempfile.mkdtemp(prefix="sakura-provider-"))
+    init_db()
+    requester_tokens, provider_tokens = create_users("data.db", [0] * args.requesters, 1)
+    asyncio.run(run(requester_tokens, provider_tokens[0], args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,450 @@
+"""
+Discrete-event simulator for the fetch_task scheduling policy
+
+Runs the real CustomQueue, Task.expires_at, dispatch.queue_mode_for and
+dispatch.select_task in virtual time, with the requester side of
+handlers.wait_for_result (claim timeouts, re-queue with a priority boost,
+408s) modelled event by event. The workload is synthetic or replayed from
+traces exported by GET /{token}/traces.
+
+Policies are config.py parameters overridden per run. --sweep takes the
+cartesian product of the given values and runs the combinations in
+parallel, one process each.
+
+    python -m benchmarks.simulator --hours 4 --rate 1.5 --providers 6
+    python -m benchmarks.simulator --trace traces.jsonl --providers 6
+    python -m benchmarks.simulator --sweep FIFO_FETCH_INTERVAL=0.5,1,2 --sweep REQUEUE_PRIORITY_BOOST=0,1,5 --jobs 4
+"""
+import argparse
+import heapq
+import itertools
+import math
+import multiprocessing
+import random
+from collections import defaultdict
+
+import config
+import custom_queue
+import dispatch
+import traffic
+from custom_queue import CustomQueue, Task
+from dispatch import FleetCapacity, queue_mode_for, select_task
+from tracing import load_traces
+from utils import json_dumps
+
+# config.py parameters a policy may override
+POLICY_PARAMETERS = (
+    "CLAIM_TIMEOUT", "FIFO_FETCH_INTERVAL", "TWO_LEVEL_FETCH_INTERVAL", "EXPIRY_MARGIN",
+    "REQUEUE_PRIORITY_BOOST", "SIZE_AWARE_ENABLED", "SMALL_TASK_TOKENS", "SIZE_SLACK_SECONDS"
+)
+
+# wait_for_result's default for chat tasks, jobs and batch items use JOB_MAX_TRIES
+CHAT_MAX_TRIES = 2
+
+def apply_policy(policy: dict) -> dict:
+    """
+    Override config parameters in the modules that read them, for this process only
+    Returns:
+        dict: Every policy parameter with its effective value
+    """
+    for name, value in policy.items():
+        if name not in POLICY_PARAMETERS:
+            raise ValueError(f"Unknown policy parameter {name}, expected one of {POLICY_PARAMETERS}")
+        for module in (custom_queue, dispatch, traffic):
+            if hasattr(module, name):
+                setattr(module, name, value)
+        if name == "CLAIM_TIMEOUT":
+            # Tasks time out by their class's claim_timeout, which takes precedence over CLAIM_TIMEOUT
+            traffic.TRAFFIC_CLASSES = {class_name: {**spec, "claim_timeout": value}
+                                       for class_name, spec in traffic.TRAFFIC_CLASSES.items()}
+    return {name: policy.get(name, getattr(config, name)) for name in POLICY_PARAMETERS}
+
+def synthetic_workload(args) -> list:
+    """
+    Poisson arrivals of short lines and long chapter chunks from requesters of mixed credit
+    Returns:
+        list: Requests as dicts sorted by arrival
+    """
+    rng = random.Random(args.seed)
+    credits, shares = zip(*args.credit_mix)
+    requester_credits = rng.choices(credits, shares, k=args.requesters)
+    requests = []
+    now = 0.0
+    while True:
+        now += rng.expovariate(args.rate)
+        if now >= args.hours * 3600:
+            break
+        chars = rng.randint(600, 2000) if rng.random() < args.big_share else rng.randint(20, 120)
+        requester_id = rng.randrange(args.requesters)
+        requests.append({
+            "arrival": now,
+            "requester_id": requester_id,
+            "priority": requester_credits[requester_id],
+            "prompt_tokens": chars + 60,
+            "generation_tokens": chars,
+            "deadline": now + args.job_timeout if rng.random() < args.job_share else None,
+            "service": None
+        })
+    return requests
+
+def trace_workload(path: str) -> list:
+    """
+    Turn exported lifecycle traces into requests, keeping recorded service times
+    Returns:
+        list: Requests as dicts sorted by arrival
+    """
+    traces = sorted(load_traces(path), key=lambda trace: trace["created_at"])
+    if not traces:
+        return []
+    start = traces[0]["created_at"]
+    requests = []
+    for trace in traces:
+        priority = 0
+        service = None
+        claimed = {}
+        for timestamp, event, detail in trace["events"]:
+            if event == "enqueued":
+                priority = detail["priority"]
+            elif event == "claimed":
+                claimed[detail["provider"]] = timestamp
+            elif event == "submitted" and service is None and detail["provider"] in claimed:
+                service = timestamp - claimed[detail["provider"]]
+        deadline = trace.get("deadline")
+        requests.append({
+            "arrival": trace["created_at"] - start,
+            "requester_id": trace["requester_id"],
+            "priority": priority,
+            "prompt_tokens": trace["prompt_tokens"],
+            "generation_tokens": trace["generation_tokens"],
+            "deadline": deadline - start if deadline is not None else None,
+            "service": service
+        })
+    return requests
+
+class Waiter:
+    """Requester side of one task, the state of handlers.wait_for_result"""
+    __slots__ = ("task", "priority", "phase", "loop_start", "version", "done", "gave_up", "requeues")
+
+    def __init__(self, task: Task, priority: int):
+        self.task = task
+        self.priority = priority
+        # "first": initial wait, "loop": polling claims every second, "final": last wait after a chat re-queue
+        self.phase = "first"
+        self.loop_start = None
+        self.version = 0
+        self.done = False
+        self.gave_up = False
+        self.requeues = 0
+
+def simulate(policy: dict, requests: list, args) -> dict:
+    """Run one policy over a workload and collect timeout, latency, fairness and utilization figures"""
+    params = apply_policy(policy)
+    claim_timeout = params["CLAIM_TIMEOUT"]
+    boost = params["REQUEUE_PRIORITY_BOOST"]
+    rng = random.Random(args.seed)
+
+    queue = CustomQueue()
+    fleet = FleetCapacity(config.SIZE_FLEET_WINDOW)
+    events = []
+    counter = itertools.count()
+
+    def schedule(at: float, kind: str, data) -> None:
+        heapq.heappush(events, (at, next(counter), kind, data))
+
+    waiters = {}
+    for index, request in enumerate(requests):
+        schedule(request["arrival"], "arrive", (index, request))
+
+    # Providers between speed_min and speed_max tokens/s, advertising it if asked to
+    providers = []
+    for provider_id in range(args.providers):
+        speed = rng.uniform(args.speed_min, args.speed_max)
+        capacity = {"n_ctx": 8192, "tokens_per_second": speed} if args.advertise else {}
+        providers.append((provider_id, speed, capacity))
+        schedule(rng.uniform(0, args.poll_interval), "poll", provider_id)
+    horizon = (requests[-1]["arrival"] if requests else 0) + claim_timeout * 3
+    horizon = max([horizon] + [request["deadline"] + 1 for request in requests if request["deadline"] is not None])
+
+    stats = {
+        "latencies": [], "first_waits": [], "timeouts": 0, "requeues": 0, "skipped_expired": 0, "bans": 0,
+        "busy": 0.0, "wasted": 0.0, "abandoned": 0
+    }
+    per_requester = defaultdict(lambda: [0, 0])     # requester_id -> [submitted, completed]
+    per_priority = defaultdict(lambda: [0, 0, []])  # priority -> [submitted, timed out, latencies]
+    last_fetch = -math.inf
+
+    def finish(waiter: Waiter, now: float) -> None:
+        waiter.done = True
+        waiter.version += 1
+        latency = now - waiter.task.created_at
+        stats["latencies"].append(latency)
+        per_requester[waiter.task.requester_id][1] += 1
+        per_priority[waiter.priority][2].append(latency)
+
+    def give_up(waiter: Waiter) -> None:
+        waiter.gave_up = True
+        waiter.version += 1
+        stats["timeouts"] += 1
+        per_priority[waiter.priority][1] += 1
+        task = waiter.task
+        if task.deadline is None:
+            if task.try_count > 1:
+                stats["bans"] += 1
+        else:
+            # run_job and run_batch_item remove their task, the chat handler leaves it to fetch_task
+            queue.remove_task(task.task_id)
+
+    def grid_after(waiter: Waiter, t: float, strict: bool) -> float:
+        """First tick of the one-second polling loop at (or strictly after) t"""
+        offset = t - waiter.loop_start
+        ticks = math.floor(offset) + 1 if strict else math.ceil(offset)
+        return waiter.loop_start + max(0, ticks)
+
+    def schedule_tick(waiter: Waiter, now: float) -> None:
+        """Schedule the next loop iteration that can change anything"""
+        task = waiter.task
+        times = []
+        if waiter.done:
+            times.append(grid_after(waiter, now, False))
+        if task.claimed_at is not None:
+            times.append(grid_after(waiter, task.claimed_at + claim_timeout, True))
+        if task.deadline is not None:
+            times.append(grid_after(waiter, task.deadline, False))
+        if times:
+            waiter.version += 1
+            schedule(max(now, min(times)), "tick", (waiter, waiter.version))
+
+    def tick(waiter: Waiter, now: float) -> None:
+        """One iteration of wait_for_result's polling loop"""
+        task = waiter.task
+        if task.deadline is not None and now >= task.deadline:
+            give_up(waiter)
+            return
+        if task.claimed_at is not None and now - task.claimed_at > claim_timeout:
+            max_tries = CHAT_MAX_TRIES if task.deadline is None else config.JOB_MAX_TRIES
+            if task.try_count >= max_tries:
+                give_up(waiter)
+                return
+            task.try_count += 1
+            task.claimed_at = None
+            waiter.requeues += 1
+            stats["requeues"] += 1
+            queue.put(task, waiter.priority + boost)
+            if task.deadline is None:
+                waiter.phase = "final"
+                waiter.version += 1
+                schedule(now + claim_timeout, "timeout", (waiter, waiter.version))
+                return
+        schedule_tick(waiter, now)
+
+    while events:
+        now, _, kind, data = heapq.heappop(events)
+
+        if kind == "arrive":
+            index, request = data
+            task = Task(request_body=None, requester_id=request["requester_id"], task_id=str(index),
+                        created_at=now, deadline=request["deadline"],
+                        prompt_tokens=request["prompt_tokens"], generation_tokens=request["generation_tokens"])
+            waiter = waiters[task.task_id] = Waiter(task, request["priority"])
+            per_requester[task.requester_id][0] += 1
+            per_priority[waiter.priority][0] += 1
+            queue.put(task, waiter.priority)
+            window = claim_timeout if task.deadline is None else min(claim_timeout, task.deadline - now)
+            schedule(now + window, "timeout", (waiter, waiter.version))
+
+        elif kind == "timeout":
+            # End of an asyncio.wait_for window in wait_for_result
+            waiter, version = data
+            if version != waiter.version or waiter.done or waiter.gave_up:
+                continue
+            task = waiter.task
+            if waiter.phase == "final" or (task.first_provider_id is None and task.deadline is None):
+                give_up(waiter)
+                continue
+            waiter.phase = "loop"
+            waiter.loop_start = now
+            tick(waiter, now)
+
+        elif kind == "tick":
+            waiter, version = data
+            if version != waiter.version or waiter.gave_up:
+                continue
+            if waiter.done:
+                # The loop only notices a result on its next iteration
+                finish(waiter, now)
+                continue
+            tick(waiter, now)
+
+        elif kind == "poll":
+            provider_id = data
+            _, speed, capacity = providers[provider_id]
+            mode = queue_mode_for(now - last_fetch)
+            last_fetch = now
+            fleet.record(provider_id, capacity, now)
+            select = lambda tasks: select_task(tasks, provider_id, capacity, now, fleet=fleet)
+            while True:
+                task = queue.get(mode, select)
+                if task is None:
+                    break
+                expires_at = task.expires_at()
+                if expires_at is not None and now > expires_at:
+                    stats["skipped_expired"] += 1
+                    continue
+                break
+            if task is None:
+                if now < horizon:
+                    schedule(now + args.poll_interval, "poll", provider_id)
+                continue
+
+            waiter = waiters[task.task_id]
+            task.is_urgent = mode != custom_queue.QueueMode.PURE_FIFO
+            task.claimed_at = now
+            if task.try_count == 0:
+                task.first_provider_id = provider_id
+                stats["first_waits"].append(now - task.created_at)
+            task.try_count += 1
+            task.provider_id = provider_id
+            if waiter.phase == "loop":
+                schedule_tick(waiter, now)
+
+            request = requests[int(task.task_id)]
+            if request["service"] is not None:
+                service = request["service"]
+            else:
+                service = (task.prompt_tokens / config.PREFILL_SPEEDUP + task.generation_tokens) / speed
+                service *= rng.uniform(0.8, 1.2)
+            stats["busy"] += service
+            if rng.random() < args.abandon_rate:
+                # The provider crashes mid-task and comes back after the same time
+                stats["abandoned"] += 1
+                stats["wasted"] += service
+            else:
+                schedule(now + service, "complete", (waiter, service))
+            schedule(now + service, "poll", provider_id)
+
+        elif kind == "complete":
+            waiter, service = data
+            if waiter.done or waiter.gave_up:
+                # Duplicate of a re-queued task, or nobody is waiting any more
+                stats["wasted"] += service
+                continue
+            queue.remove_task(waiter.task.task_id)
+            if waiter.phase == "loop":
+                waiter.done = True
+                schedule_tick(waiter, now)
+            else:
+                finish(waiter, now)
+
+    return summarize(params, stats, per_requester, per_priority, len(requests), now, args.providers)
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def summarize(params: dict, stats: dict, per_requester: dict, per_priority: dict,
+              count: int, end: float, providers: int) -> dict:
+    # Jain's index over each requester's completion ratio, 1.0 when everyone fares the same
+    ratios = [completed / submitted for submitted, completed in per_requester.values() if submitted]
+    jain = sum(ratios) ** 2 / (len(ratios) * sum(r * r for r in ratios)) if ratios and any(ratios) else 0.0
+    capacity = providers * end if end else 1.0
+    return {
+        "policy": params,
+        "tasks": count,
+        "completed": len(stats["latencies"]),
+        "timeout_rate": stats["timeouts"] / count if count else 0.0,
+        "mean_latency": sum(stats["latencies"]) / len(stats["latencies"]) if stats["latencies"] else 0.0,
+        "p95_latency": percentile(stats["latencies"], 0.95),
+        "p95_first_wait": percentile(stats["first_waits"], 0.95),
+        "requeues": stats["requeues"],
+        "skipped_expired": stats["skipped_expired"],
+        "temp_bans": stats["bans"],
+        "utilization": stats["busy"] / capacity,
+        "wasted_share": stats["wasted"] / stats["busy"] if stats["busy"] else 0.0,
+        "fairness": jain,
+        "by_priority": {
+            str(priority): {
+                "tasks": submitted,
+                "timeout_rate": timed_out / submitted if submitted else 0.0,
+                "p95_latency": percentile(latencies, 0.95)
+            }
+            for priority, (submitted, timed_out, latencies) in sorted(per_priority.items())
+        }
+    }
+
+def run_policy(job: tuple) -> dict:
+    """Pool entry point, builds the workload in the worker so it is not pickled across"""
+    policy, args = job
+    requests = trace_workload(args.trace) if args.trace else synthetic_workload(args)
+    return simulate(policy, requests, args)
+
+def parse_sweep(text: str) -> tuple:
+    """Parse NAME=v1,v2,... into (name, [values])"""
+    name, values = text.split("=", 1)
+    def parse(value: str):
+        if isinstance(getattr(config, name, None), bool):
+            return value.lower() in ("1", "true", "yes")
+        return int(value) if value.lstrip("-").isdigit() else float(value)
+    return name, [parse(value) for value in values.split(",")]
+
+def parse_mix(text: str) -> list:
+    """Parse "credit:share,credit:share" into [(credit, share)]"""
+    return [(int(credit), float(share)) for credit, share in (part.split(":") for part in text.split(","))]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--trace", help="Replay traces exported from /traces instead of a synthetic workload")
+    parser.add_argument("--hours", type=float, default=4, help="Virtual hours of synthetic arrivals")
+    parser.add_argument("--rate", type=float, default=1.0, help="Synthetic arrivals per second")
+    parser.add_argument("--requesters", type=int, default=200)
+    parser.add_argument("--credit-mix", type=parse_mix, default=parse_mix("0:0.8,10:0.15,100:0.05"))
+    parser.add_argument("--big-share", type=float, default=0.2, help="Share of long chapter chunks")
+    parser.add_argument("--job-share", type=float, default=0.0, help="Share of requests submitted as jobs")
+    parser.add_argument("--job-timeout", type=float, default=config.JOB_DEFAULT_TIMEOUT)
+    parser.add_argument("--providers", type=int, default=8)
+    parser.add_argument("--speed-min", type=float, default=10, help="Slowest provider in tokens/s")
+    parser.add_argument("--speed-max", type=float, default=60, help="Fastest provider in tokens/s")
+    parser.add_argument("--advertise", action="store_true", help="Providers advertise capacity to fetch_task")
+    parser.add_argument("--abandon-rate", type=float, default=0.01, help="Share of claims never submitted")
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    parser.add_argument("--set", action="append", default=[], type=parse_sweep, metavar="NAME=VALUE",
+                        help="Fix a policy parameter")
+    parser.add_argument("--sweep", action="append", default=[], type=parse_sweep, metavar="NAME=V1,V2",
+                        help="Sweep a policy parameter over values")
+    parser.add_argument("--jobs", type=int, default=multiprocessing.cpu_count(), help="Parallel simulations")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="Also write results to this file as JSON lines")
+    args = parser.parse_args()
+
+    fixed = {name: values[0] for name, values in args.set}
+    names = [name for name, _ in args.sweep]
+    policies = [dict(fixed, **dict(zip(names, combination)))
+                for combination in itertools.product(*(values for _, values in args.sweep))]
+    unknown = set(fixed).union(names) - set(POLICY_PARAMETERS)
+    if unknown:
+        parser.error(f"Unknown policy parameters {sorted(unknown)}, expected one of {POLICY_PARAMETERS}")
+
+    jobs = [(policy, args) for policy in policies]
+    if len(jobs) > 1 and args.jobs > 1:
+        with multiprocessing.Pool(min(args.jobs, len(jobs))) as pool:
+            results = pool.map(run_policy, jobs)
+    else:
+        results = [run_policy(job) for job in jobs]
+
+    for policy, result in zip(policies, results):
+        label = " ".join(f"{name}={value}" for name, value in policy.items()) or "current config"
+        print(f"{label}: tasks={result['tasks']} timeouts={result['timeout_rate']:.2%} "
+              f"mean={result['mean_latency']:.1f}s p95={result['p95_latency']:.1f}s "
+              f"util={result['utilization']:.1%} wasted={result['wasted_share']:.1%} "
+              f"fairness={result['fairness']:.3f} requeues={result['requeues']} bans={result['temp_bans']}")
+        for priority, figures in result["by_priority"].items():
+            print(f"    credit {priority:>4}: tasks={figures['tasks']} timeouts={figures['timeout_rate']:.2%} "
+                  f"p95={figures['p95_latency']:.1f}s")
+    if args.json:
+        with open(args.json, "wb") as f:
+            for result in results:
+                f.write(json_dumps(result) + b"\n")
+
+if __name__ == "__main__":
+    main()
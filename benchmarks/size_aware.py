@@ -0,0 +1,117 @@
+"""
+Compare mean latency and timeout rate with and without size-aware dispatch
+
+Runs the real CustomQueue and dispatch.select_task in virtual time against a
+mix of short lines and long chapter chunks served by providers of different speed.
+
+    python -m benchmarks.size_aware --rate 2 --providers 8 --duration 3600
+"""
+import argparse
+import heapq
+import random
+
+import config
+import dispatch
+from custom_queue import CustomQueue, Task
+from dispatch import FleetCapacity, estimate_seconds, queue_mode_for, select_task
+from traffic import claim_timeout
+
+POLL_INTERVAL = 1.0
+
+def make_request(rng: random.Random, big_share: float) -> dict:
+    if rng.random() < big_share:
+        chars = rng.randint(600, 2000)
+    else:
+        chars = rng.randint(20, 120)
+    return {"messages": [{"role": "system", "content": "s" * 60}, {"role": "user", "content": "x" * chars}]}
+
+def simulate(size_aware: bool, args) -> dict:
+    dispatch.SIZE_AWARE_ENABLED = size_aware
+    rng = random.Random(args.seed)
+    queue = CustomQueue()
+    fleet = FleetCapacity(config.SIZE_FLEET_WINDOW)
+    events = []
+    sequence = 0
+
+    def schedule(at, kind, data):
+        nonlocal sequence
+        heapq.heappush(events, (at, sequence, kind, data))
+        sequence += 1
+
+    # Arrivals
+    now = 0.0
+    count = 0
+    while now < args.duration:
+        now += rng.expovariate(args.rate)
+        request_body = make_request(rng, args.big_share)
+        prompt_tokens, generation_tokens = dispatch.estimate_tokens(request_body)
+        task = Task(request_body=request_body, requester_id=0, task_id=str(count), created_at=now,
+                    prompt_tokens=prompt_tokens, generation_tokens=generation_tokens)
+        schedule(now, "arrive", task)
+        count += 1
+
+    # Providers between 10 and 60 tokens/s
+    for provider_id in range(args.providers):
+        capacity = {"n_ctx": 8192, "tokens_per_second": rng.uniform(10, 60)}
+        schedule(rng.uniform(0, POLL_INTERVAL), "poll", (provider_id, capacity))
+
+    latencies = []
+    timeouts = 0
+    last_fetch = -10.0
+    while events:
+        now, _, kind, data = heapq.heappop(events)
+        if kind == "arrive":
+            queue.put(data, 0)
+        elif kind == "poll":
+            provider_id, capacity = data
+            mode = queue_mode_for(now - last_fetch)
+            last_fetch = now
+            while True:
+                fleet.record(provider_id, capacity, now)
+                task = queue.get(mode, lambda tasks: select_task(tasks, provider_id, capacity, now, fleet=fleet))
+                if task is None:
+                    break
+                if now > task.expires_at():
+                    timeouts += 1
+                    continue
+                break
+            if task is None:
+                if now < args.duration * 2:
+                    schedule(now + POLL_INTERVAL, "poll", data)
+                continue
+            # Real service time varies around the estimate
+            service = estimate_seconds(task, capacity) * rng.uniform(0.8, 1.2)
+            if service > claim_timeout(task.traffic_class):
+                timeouts += 1
+            else:
+                latencies.append(now + service - task.created_at)
+            schedule(now + service, "poll", data)
+
+    # Whatever is left in the queue expired
+    while queue.get() is not None:
+        timeouts += 1
+
+    latencies.sort()
+    return {
+        "tasks": count,
+        "mean_latency": sum(latencies) / len(latencies) if latencies else 0.0,
+        "p95_latency": latencies[int(len(latencies) * 0.95)] if latencies else 0.0,
+        "timeout_rate": timeouts / count if count else 0.0
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=1.0, help="arrivals per second")
+    parser.add_argument("--providers", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=3600, help="virtual seconds of arrivals")
+    parser.add_argument("--big-share", type=float, default=0.2, help="share of long chapter chunks")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    for name, size_aware in (("fifo", False), ("size-aware", True)):
+        result = simulate(size_aware, args)
+        print(f"{name:>10}: tasks={result['tasks']} mean={result['mean_latency']:.2f}s "
+              f"p95={result['p95_latency']:.2f}s timeouts={result['timeout_rate']:.2%}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Measure snapshot size, save time and restart-to-serving time against queue size
+
+Restart-to-serving covers reading the snapshot, replaying the journal and
+putting every task back with its waiter, i.e. what lifespan does before the
+gateway accepts requests.
+
+    python -m benchmarks.snapshot_restore --sizes 1000 10000 100000
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+import uuid
+from collections import OrderedDict
+from types import SimpleNamespace
+
+from custom_queue import CustomQueue, Task
+from database import init_db
+from jobs import JobStore
+from snapshot import JournaledQueue, load_snapshot, replay_journal, restore_snapshot, save_snapshot
+from tracing import TraceRecorder
+
+REQUEST_BODY = {"messages": [{"role": "system", "content": "s" * 200}, {"role": "user", "content": "x" * 400}]}
+
+def make_app(task_queue) -> SimpleNamespace:
+    state = SimpleNamespace(task_queue=task_queue, pending_results={}, claimed_tasks={},
+                            completed_tasks=OrderedDict(), job_store=JobStore(10 ** 7),
+                            tracer=TraceRecorder(sample_rate=0))
+    return SimpleNamespace(state=state)
+
+async def measure(size: int, journaled: bool) -> dict:
+    snapshot_path = os.path.abspath("bench.snapshot")
+    journal_path = os.path.abspath("bench.journal")
+    for path in (snapshot_path, journal_path):
+        if os.path.exists(path):
+            os.remove(path)
+
+    # Half of the tasks go to the snapshot, the other half only to the journal
+    queue = JournaledQueue(journal_path) if journaled else CustomQueue()
+    app = make_app(queue)
+    snapshotted = size // 2 if journaled else size
+    for i in range(size):
+        if journaled and i == snapshotted:
+            start = time.perf_counter()
+            snapshot_bytes = save_snapshot(app, snapshot_path)
+            save_seconds = time.perf_counter() - start
+            queue.truncate()
+        # Only jobs survive a restart, queued chat tasks have nobody waiting for them
+        queue.put(Task(request_body=REQUEST_BODY, requester_id=1, task_id=str(uuid.uuid4()),
+                       is_job=True), i % 3)
+    if not journaled:
+        start = time.perf_counter()
+        snapshot_bytes = save_snapshot(app, snapshot_path)
+        save_seconds = time.perf_counter() - start
+    else:
+        queue.close()
+
+    start = time.perf_counter()
+    state = load_snapshot(snapshot_path)
+    if journaled:
+        state = replay_journal(journal_path, state)
+    restored_app = make_app(CustomQueue())
+    restored = restore_snapshot(restored_app, state)
+    restore_seconds = time.perf_counter() - start
+    assert restored == size
+
+    # Stop the waiters restore_snapshot started
+    for task in asyncio.all_tasks():
+        if task is not asyncio.current_task():
+            task.cancel()
+    return {
+        "snapshot_bytes": snapshot_bytes,
+        "save_seconds": save_seconds,
+        "restore_seconds": restore_seconds
+    }
+
+async def run(sizes: list):
+    for journaled in (False, True):
+        for size in sizes:
+            result = await measure(size, journaled)
+            label = "snapshot+journal" if journaled else "snapshot"
+            print(f"{label:>16} tasks={size:>7}: file={result['snapshot_bytes'] / 1024:9.1f} KiB "
+                  f"save={result['save_seconds'] * 1000:8.1f} ms restore={result['restore_seconds'] * 1000:8.1f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp())
+    init_db()
+    asyncio.run(run(args.sizes))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Latency of long chat requests, sent whole or split into pieces with X-Split
+
+Runs the gateway from main.py, --providers reference provider workers and one
+single-slot stub llama.cpp per provider in this process (httpx ASGI
+transports). A requester sends chapters of --chars characters one after the
+other, with the Sakura instruction and a glossary in front of the text, and
+reports the latency of each.
+
+    python -m benchmarks.split_requests --providers 8
+    python -m benchmarks.split_requests --providers 8 --split auto
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import httpx
+
+import main as gateway
+from benchmarks.load_test import create_users, percentile
+from benchmarks.stub_llama import create_app
+from database import init_db
+from provider import ProviderWorker
+from split import SPLIT_HEADER
+
+def chapter(chars: int) -> dict:
+    """A chat request translating a chapter of about chars characters, one paragraph per line"""
+    line = "「今日はいい天気ですね」と彼女は窓の外を眺めながら言った。"
+    text = "\n".join([line] * max(1, chars // (len(line) + 1)))
+    return {
+        "messages": [
+            {"role": "system", "content": "你是一个轻小说翻译模型，可以流畅通顺地以日本轻小说的风格将日文翻译成简体中文。"},
+            {"role": "user", "content": "根据以下术语表（可以为空）：\n彼女->她\n将下面的日文文本根据对应关系和备注翻译成中文：" + text}
+        ],
+        "max_tokens": len(text)
+    }
+
+async def run(requester_token: str, provider_tokens: list, args) -> list:
+    workers = []
+    clients = []
+    async with gateway.lifespan(gateway.app):
+        for token in provider_tokens:
+            gateway_client = httpx.AsyncClient(transport=httpx.ASGITransport(app=gateway.app),
+                                               base_url="http://gateway", timeout=None)
+            llama_client = httpx.AsyncClient(transport=httpx.ASGITransport(app=create_app(1, args.tokens_per_second)),
+                                             base_url="http://llama", timeout=None)
+            clients += [gateway_client, llama_client]
+            worker = ProviderWorker("http://gateway", token, "http://llama", prefetch=0, poll_interval=0.05,
+                                    poll_max=0.2, gateway_client=gateway_client, llama_client=llama_client)
+            workers.append(asyncio.create_task(worker.run()))
+
+        headers = {SPLIT_HEADER: args.split} if args.split else {}
+        latencies = []
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=gateway.app), base_url="http://gateway",
+                                     timeout=None) as client:
+            body = chapter(args.chars)
+            for _ in range(args.requests):
+                start = time.perf_counter()
+                r = await client.post(f"/{requester_token}/v1/chat/completions", json=body, headers=headers)
+                if r.status_code != 200 or "error" in r.json():
+                    print(f"failed: {r.status_code} {r.text[:200]}")
+                    continue
+                latencies.append(time.perf_counter() - start)
+
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        for client in clients:
+            await client.aclose()
+    return latencies
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--split", default=None, help="X-Split value, e.g. auto, unset to send requests whole")
+    parser.add_argument("--providers", type=int, default=8)
+    parser.add_argument("--tokens-per-second", type=float, default=100, help="Generation speed of each provider")
+    parser.add_argument("--chars", type=int, default=3000, help="Characters of text per request")
+    parser.add_argument("--requests", type=int, default=5, help="Requests sent one after the other")
+    args = parser.parse_args()
+
+    # The gateway opens data.db and its other files relative to the working directory
+    os.chdir(tempfile.mkdtemp(prefix="sakura-split-"))
+    init_db()
+    requester_tokens, provider_tokens = create_users("data.db", [0], args.providers)
+    latencies = asyncio.run(run(requester_tokens[0], provider_tokens, args))
+
+    print(f"split:     {args.split or 'off'}, {args.providers} providers at {args.tokens_per_second:g} tokens/s")
+    print(f"latency:   {len(latencies)} ok, p50={percentile(latencies, 0.5):.2f}s "
+          f"max={max(latencies, default=float('nan')):.2f}s")
+
+if __name__ == "__main__":
+    main()
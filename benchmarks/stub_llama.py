@@ -0,0 +1,126 @@
+"""
+Stub llama.cpp server for testing provider workers without a GPU
+
+Serves /v1/models with the gateway's model meta, /props with the slot count
+and context size, and /v1/chat/completions taking prompt / (speed x
+PREFILL_SPEEDUP) + generated / speed seconds per request. At most --slots
+requests generate at once, others wait like in llama.cpp. /stats reports how
+busy the slots were.
+
+    python -m benchmarks.stub_llama --port 8080 --slots 4 --tokens-per-second 30
+"""
+import argparse
+import asyncio
+import random
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+from config import PREFILL_SPEEDUP
+from dispatch import estimate_tokens
+from models import AVAILABLE_MODELS, get_default_model
+
+def create_app(slots: int = 4, tokens_per_second: float = 30, n_ctx: int = 8192, fail_rate: float = 0.0,
+               seed: int = None) -> FastAPI:
+    """
+    Build the stub server
+    Args:
+        slots: Parallel slots, like llama.cpp's --parallel
+        tokens_per_second: Generation speed of each slot
+        n_ctx: Context size of each slot reported by /props
+        fail_rate: Share of requests answered with a 500 error
+        seed: Seed of the failure draws
+    """
+    app = FastAPI()
+    model = AVAILABLE_MODELS[get_default_model()]
+    semaphore = asyncio.Semaphore(slots)
+    rng = random.Random(seed)
+    stats = {"started_at": time.monotonic(), "busy_seconds": 0.0, "completed": 0, "failed": 0, "active": 0,
+             "max_active": 0}
+
+    @app.get("/v1/models")
+    async def models():
+        return {"object": "list", "data": [model]}
+
+    @app.get("/props")
+    async def props():
+        return {"total_slots": slots, "default_generation_settings": {"n_ctx": n_ctx}}
+
+    @app.get("/health")
+    async def health():
+        return {"status": "ok"}
+
+    @app.get("/stats")
+    async def get_stats():
+        elapsed = time.monotonic() - stats["started_at"]
+        return dict(stats, slots=slots, utilization=stats["busy_seconds"] / (slots * elapsed))
+
+    @app.post("/stats/reset")
+    async def reset_stats():
+        stats.update(started_at=time.monotonic(), busy_seconds=0.0, completed=0, failed=0, max_active=0)
+        return {"status": "ok"}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        # Without max_tokens the estimate is the source text length, a translation is about as long
+        prompt_tokens, generation_tokens = estimate_tokens({"messages": body.get("messages")})
+        max_tokens = body.get("max_tokens")
+        if isinstance(max_tokens, int) and max_tokens > 0:
+            generation_tokens = min(generation_tokens, max_tokens)
+        generation_tokens = max(generation_tokens, 1)
+
+        async with semaphore:
+            stats["active"] += 1
+            stats["max_active"] = max(stats["max_active"], stats["active"])
+            start = time.monotonic()
+            try:
+                await asyncio.sleep(prompt_tokens / (tokens_per_second * PREFILL_SPEEDUP)
+                                    + generation_tokens / tokens_per_second)
+            finally:
+                stats["active"] -= 1
+                stats["busy_seconds"] += time.monotonic() - start
+
+        if rng.random() < fail_rate:
+            stats["failed"] += 1
+            return JSONResponse(status_code=500, content={"error": {
+                "code": 500, "message": "stub failure", "type": "server_error"}})
+        stats["completed"] += 1
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model["id"],
+            "choices": [{
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": "訳" * generation_tokens}
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": generation_tokens,
+                "total_tokens": prompt_tokens + generation_tokens
+            },
+            "timings": {"predicted_per_second": tokens_per_second}
+        }
+
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--slots", type=int, default=4)
+    parser.add_argument("--tokens-per-second", type=float, default=30)
+    parser.add_argument("--n-ctx", type=int, default=8192)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    import uvicorn
+    uvicorn.run(create_app(args.slots, args.tokens_per_second, args.n_ctx, args.fail_rate),
+                host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
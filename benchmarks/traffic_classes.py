@@ -0,0 +1,140 @@
+"""
+Interactive latency under a bulk flood, with and without traffic classes
+
+Runs the gateway from main.py in this process (httpx ASGI transport) with a
+fixed pool of simulated providers. Interactive requesters send single-line
+chat requests as a Poisson process while a bulk client translating a book
+line by line keeps --bulk-backlog jobs of the same size queued at all times,
+so size-aware dispatch can't tell them apart. Reports interactive latency
+percentiles, bulk throughput and how busy the providers were.
+
+    python -m benchmarks.traffic_classes
+    python -m benchmarks.traffic_classes --single-class   # jobs share the interactive queue, as before
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+import httpx
+
+import config
+import main as gateway
+from benchmarks.load_test import create_users, percentile
+from database import init_db
+from models import AVAILABLE_MODELS, get_default_model
+
+# Same size for both, so the shortest-job-first lane doesn't favour either
+LINE = {"messages": [{"role": "user", "content": "今日は雨が降っています。"}], "max_tokens": 32}
+
+class Stats:
+    def __init__(self):
+        self.interactive = []
+        self.interactive_failed = 0
+        self.bulk_completed = 0
+        self.busy_seconds = 0.0
+
+async def interactive(client: httpx.AsyncClient, token: str, stats: Stats):
+    start = time.perf_counter()
+    r = await client.post(f"/{token}/v1/chat/completions", json=LINE)
+    if r.status_code == 200:
+        stats.interactive.append(time.perf_counter() - start)
+    else:
+        stats.interactive_failed += 1
+
+async def bulk_job(client: httpx.AsyncClient, token: str, stats: Stats):
+    job = (await client.post(f"/{token}/v1/jobs", json=LINE)).json()
+    while True:
+        job = (await client.get(f"/{token}/v1/jobs/{job['id']}", params={"wait": 30})).json()
+        if job["status"] != "queued" and job["status"] != "running":
+            break
+    if job["status"] == "completed":
+        stats.bulk_completed += 1
+
+async def bulk(client: httpx.AsyncClient, token: str, backlog: int, stats: Stats, stop: asyncio.Event):
+    """Keep backlog jobs in flight, like a book translation tool"""
+    running = set()
+    while not stop.is_set():
+        while len(running) < backlog:
+            running.add(asyncio.create_task(bulk_job(client, token, stats)))
+        done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+    for task in running:
+        task.cancel()
+
+async def provider(client: httpx.AsyncClient, token: str, args, rng: random.Random, stats: Stats,
+                   stop: asyncio.Event):
+    meta = {"data": [AVAILABLE_MODELS[get_default_model()]]}
+    while not stop.is_set():
+        task = (await client.post(f"/{token}/fetch_task", json=meta)).json()
+        if "task_id" not in task:
+            await asyncio.sleep(0.05)
+            continue
+        seconds = rng.expovariate(1 / args.service_mean)
+        await asyncio.sleep(seconds)
+        stats.busy_seconds += seconds
+        await client.post(f"/{token}/submit_result",
+                          json={"task_id": task["task_id"], "response": {"choices": [{"message": {"content": "ok"}}]}})
+
+async def run(requester_tokens: list, bulk_token: str, provider_tokens: list, args) -> Stats:
+    rng = random.Random(args.seed)
+    stats = Stats()
+    stop = asyncio.Event()
+    async with gateway.lifespan(gateway.app):
+        transport = httpx.ASGITransport(app=gateway.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://gateway", timeout=None) as client:
+            providers = [asyncio.create_task(provider(client, token, args, random.Random(rng.random()), stats, stop))
+                         for token in provider_tokens]
+            flood = asyncio.create_task(bulk(client, bulk_token, args.bulk_backlog, stats, stop))
+            # Let the bulk backlog build up first
+            await asyncio.sleep(args.warmup)
+            stats.busy_seconds = 0.0
+            stats.bulk_completed = 0
+
+            requests = []
+            start = next_arrival = time.perf_counter()
+            while True:
+                next_arrival += rng.expovariate(args.rate)
+                if next_arrival >= start + args.duration:
+                    break
+                await asyncio.sleep(max(0, next_arrival - time.perf_counter()))
+                requests.append(asyncio.create_task(interactive(client, rng.choice(requester_tokens), stats)))
+            await asyncio.gather(*requests)
+            stats.elapsed = time.perf_counter() - start
+            stats.utilization = stats.busy_seconds / (len(provider_tokens) * stats.elapsed)
+            stop.set()
+            flood.cancel()
+            await asyncio.gather(flood, *providers, return_exceptions=True)
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--single-class", action="store_true", help="Route jobs to the interactive class")
+    parser.add_argument("--providers", type=int, default=4)
+    parser.add_argument("--rate", type=float, default=1.0, help="Interactive requests per second")
+    parser.add_argument("--service-mean", type=float, default=0.5, help="Mean seconds per task")
+    parser.add_argument("--bulk-backlog", type=int, default=40, help="Bulk jobs kept in flight")
+    parser.add_argument("--warmup", type=float, default=5)
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.single_class:
+        config.TRAFFIC_CLASS_ROUTES["job"] = "interactive"
+
+    # The gateway opens data.db and its other files relative to the working directory
+    os.chdir(tempfile.mkdtemp(prefix="sakura-traffic-"))
+    init_db()
+    tokens, provider_tokens = create_users("data.db", [0] * 11, args.providers)
+    stats = asyncio.run(run(tokens[:10], tokens[10], provider_tokens, args))
+
+    print(f"classes:     {'single (jobs routed to interactive)' if args.single_class else 'interactive + bulk'}")
+    print(f"interactive: {len(stats.interactive)} ok, {stats.interactive_failed} failed, "
+          f"p50={percentile(stats.interactive, 0.5):.2f}s p95={percentile(stats.interactive, 0.95):.2f}s "
+          f"max={max(stats.interactive, default=float('nan')):.2f}s")
+    print(f"bulk:        {stats.bulk_completed} jobs ({stats.bulk_completed / stats.elapsed:.2f}/s)")
+    print(f"providers:   {stats.utilization:.1%} busy")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+from typing import Optional
+import threading
+import time
+
+from database import get_user_info, get_top_contributors, get_top_credits, get_top_total_usage, get_top_daily_usage
+
+class UserInfoCache:
+    def __init__(self, ttl: float = 30, max_size: int = 10000):
+        """
+        Short-lived cache of get_user_info results
+        Entries are dropped after ttl seconds, or at once by invalidate when
+        this process changes the user (register, token refresh).
+        Args:
+            ttl: Seconds an entry is served from memory
+            max_size: Number of users kept, the oldest entries are dropped first
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = {}
+        # The bot looks users up from worker threads
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, telegram_id: int) -> Optional[dict]:
+        """Get user information like get_user_info, from memory when fresh"""
+        entry = self.entries.get(telegram_id)
+        now = time.monotonic()
+        if entry is not None and now - entry[0] < self.ttl:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        user_info = get_user_info(telegram_id)
+        with self.lock:
+            # dict keeps insertion order, re-inserting moves the entry to the end
+            self.entries.pop(telegram_id, None)
+            self.entries[telegram_id] = (now, user_info)
+            if len(self.entries) > self.max_size:
+                del self.entries[next(iter(self.entries))]
+        return user_info
+
+    def invalidate(self, telegram_id: int) -> None:
+        self.entries.pop(telegram_id, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None
+        }
+
+class LeaderboardSnapshot:
+    def __init__(self, ttl: float = 60, limit: int = 5):
+        """
+        The /globaldata rankings, re-read from the database at most every ttl seconds
+        Args:
+            ttl: Seconds a snapshot is served from memory
+            limit: Number of users in each ranking
+        """
+        self.ttl = ttl
+        self.limit = limit
+        self.taken_at = None
+        self.rankings = None
+
+    def get(self) -> dict:
+        """Get the rankings: contributors, credits, total_usage and daily_usage lists of (name, value)"""
+        now = time.monotonic()
+        if self.rankings is None or now - self.taken_at >= self.ttl:
+            self.rankings = {
+                "contributors": get_top_contributors(self.limit),
+                "credits": get_top_credits(self.limit),
+                "total_usage": get_top_total_usage(self.limit),
+                "daily_usage": get_top_daily_usage(self.limit)
+            }
+            self.taken_at = now
+        return self.rankings
@@ -0,0 +1,278 @@
+"""
+Content-Encoding negotiation for the provider endpoints
+
+Providers may send fetch_task/submit_result bodies compressed with gzip or zstd
+(Content-Encoding) and get responses compressed with the best encoding they
+accept (Accept-Encoding). With a shared zstd dictionary configured, providers
+that downloaded it from GET /{token}/compression_dictionary can also use the
+"zstd-dict" coding, which compresses repeated system prompts much better.
+
+Train a dictionary from request bodies, one JSON object per line:
+
+    python -m compression train bodies.jsonl --output sakura.dict --size 65536
+"""
+from typing import Optional
+import argparse
+import gzip
+import io
+import time
+import zlib
+
+from metrics import COMPRESSION_BYTES, COMPRESSION_SECONDS
+from utils import json_dumps, json_loads
+
+# zstandard is optional, gzip is always available
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DICTIONARY_ENCODING = "zstd-dict"
+
+class Codecs:
+    def __init__(self, gzip_level: int = 5, zstd_level: int = 3, dictionary: bytes = None):
+        """
+        Compressors and decompressors for the supported content codings
+        Args:
+            gzip_level: gzip compression level
+            zstd_level: zstd compression level
+            dictionary: Trained zstd dictionary enabling the zstd-dict coding, needs zstandard
+        """
+        self.gzip_level = gzip_level
+        self.dictionary = dictionary
+        self.zstd = None
+        self.zstd_dict = None
+        if zstandard is not None:
+            self.zstd = (zstandard.ZstdCompressor(level=zstd_level), zstandard.ZstdDecompressor())
+            if dictionary:
+                data = zstandard.ZstdCompressionDict(dictionary)
+                self.zstd_dict = (zstandard.ZstdCompressor(level=zstd_level, dict_data=data),
+                                  zstandard.ZstdDecompressor(dict_data=data))
+
+    def encodings(self) -> list:
+        """Supported codings, preferred first"""
+        encodings = []
+        if self.zstd_dict is not None:
+            encodings.append(DICTIONARY_ENCODING)
+        if self.zstd is not None:
+            encodings.append("zstd")
+        encodings.append("gzip")
+        return encodings
+
+    def negotiate(self, accept_encoding: str) -> Optional[str]:
+        """Pick the preferred coding listed in an Accept-Encoding header, None for identity"""
+        accepted = set()
+        for part in accept_encoding.split(","):
+            coding, _, params = part.strip().partition(";")
+            if params.strip().replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+                continue
+            accepted.add(coding.strip().lower())
+        for encoding in self.encodings():
+            if encoding in accepted:
+                return encoding
+        return None
+
+    def compress(self, encoding: str, data: bytes) -> bytes:
+        if encoding == "gzip":
+            return gzip.compress(data, self.gzip_level)
+        if encoding == "zstd":
+            return self.zstd[0].compress(data)
+        return self.zstd_dict[0].compress(data)
+
+    def decompress(self, encoding: str, data: bytes, max_size: int) -> bytes:
+        """
+        Decompress a request body
+        Raises:
+            ValueError: If the data is corrupt or larger than max_size
+        """
+        try:
+            if encoding == "gzip":
+                # wbits 16 + MAX_WBITS reads a gzip header
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                result = decompressor.decompress(data, max_size + 1)
+                if decompressor.unconsumed_tail:
+                    raise ValueError("Decompressed body too large")
+            else:
+                decompressor = (self.zstd if encoding == "zstd" else self.zstd_dict)[1]
+                # Read in chunks, the frame header's content size can't be trusted
+                reader = decompressor.stream_reader(io.BytesIO(data), read_across_frames=True)
+                chunks = []
+                size = 0
+                while size <= max_size:
+                    chunk = reader.read(65536)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+                    size += len(chunk)
+                result = b"".join(chunks)
+        except (zlib.error, getattr(zstandard, "ZstdError", zlib.error)) as e:
+            raise ValueError(f"Invalid {encoding} body: {e}")
+        if len(result) > max_size:
+            raise ValueError("Decompressed body too large")
+        return result
+
+class CompressionMiddleware:
+    def __init__(self, app, codecs: Codecs, paths: tuple, min_size: int = 1024, max_body: int = 32 * 1024 * 1024):
+        """
+        ASGI middleware decompressing request bodies and compressing responses
+        Responses of the matched routes are small JSON documents, so they are
+        buffered whole and only compressed when at least min_size bytes.
+        Args:
+            app: The wrapped ASGI app
+            codecs: Supported content codings
+            paths: Path suffixes the middleware applies to, e.g. "/fetch_task"
+            min_size: Smallest response body worth compressing
+            max_body: Largest decompressed request body accepted
+        """
+        self.app = app
+        self.codecs = codecs
+        self.paths = paths
+        self.min_size = min_size
+        self.max_body = max_body
+
+    def matches(self, path: str) -> bool:
+        return any(path.endswith(suffix) or f"{suffix}/" in path for suffix in self.paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.matches(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope["headers"])
+        content_encoding = headers.get(b"content-encoding", b"identity").decode("latin-1").strip().lower()
+        if content_encoding == "identity":
+            length = int(headers.get(b"content-length", b"0") or 0)
+            COMPRESSION_BYTES.labels("request", "identity", "wire").inc(length)
+            COMPRESSION_BYTES.labels("request", "identity", "plain").inc(length)
+        elif content_encoding not in self.codecs.encodings():
+            await send_error(send, 415, "unsupported_encoding", f"Unsupported Content-Encoding {content_encoding}")
+            return
+        else:
+            body = await read_body(receive)
+            start = time.thread_time()
+            try:
+                body_plain = self.codecs.decompress(content_encoding, body, self.max_body)
+            except ValueError as e:
+                await send_error(send, 400, "invalid_encoding", str(e))
+                return
+            COMPRESSION_SECONDS.labels("request", content_encoding).inc(time.thread_time() - start)
+            COMPRESSION_BYTES.labels("request", content_encoding, "wire").inc(len(body))
+            COMPRESSION_BYTES.labels("request", content_encoding, "plain").inc(len(body_plain))
+
+            scope = dict(scope)
+            scope["headers"] = [(name, value) for name, value in scope["headers"]
+                                if name not in (b"content-encoding", b"content-length")]
+            scope["headers"].append((b"content-length", str(len(body_plain)).encode("latin-1")))
+            receive = replay(body_plain, receive)
+
+        encoding = self.codecs.negotiate(headers.get(b"accept-encoding", b"").decode("latin-1"))
+        await self.app(scope, receive, self.compressing_send(send, encoding))
+
+    def compressing_send(self, send, encoding: Optional[str]):
+        start_message = None
+        chunks = []
+
+        async def wrapped(message):
+            nonlocal start_message
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+            chunks.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+
+            body = b"".join(chunks)
+            headers = [(name, value) for name, value in start_message.get("headers", [])]
+            already_encoded = any(name.lower() == b"content-encoding" for name, _ in headers)
+            if encoding is None or already_encoded or len(body) < self.min_size:
+                COMPRESSION_BYTES.labels("response", "identity", "wire").inc(len(body))
+                COMPRESSION_BYTES.labels("response", "identity", "plain").inc(len(body))
+            else:
+                start = time.thread_time()
+                compressed = self.codecs.compress(encoding, body)
+                COMPRESSION_SECONDS.labels("response", encoding).inc(time.thread_time() - start)
+                COMPRESSION_BYTES.labels("response", encoding, "wire").inc(len(compressed))
+                COMPRESSION_BYTES.labels("response", encoding, "plain").inc(len(body))
+                body = compressed
+                headers = [(name, value) for name, value in headers if name.lower() != b"content-length"]
+                headers.append((b"content-encoding", encoding.encode("latin-1")))
+                headers.append((b"content-length", str(len(body)).encode("latin-1")))
+                headers.append((b"vary", b"Accept-Encoding"))
+            await send(dict(start_message, headers=headers))
+            await send({"type": "http.response.body", "body": body, "more_body": False})
+
+        return wrapped
+
+async def read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            break
+    return b"".join(chunks)
+
+def replay(body: bytes, receive):
+    """A receive callable returning body once, then the original channel (e.g. for disconnects)"""
+    sent = False
+
+    async def wrapped():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        return await receive()
+
+    return wrapped
+
+async def send_error(send, status: int, code: str, message: str) -> None:
+    """Send an error in the same shape as the handlers' HTTPException details"""
+    body = json_dumps({"detail": {"error": {
+        "message": message,
+        "type": "invalid_request_error",
+        "code": code
+    }}})
+    await send({"type": "http.response.start", "status": status, "headers": [
+        (b"content-type", b"application/json"),
+        (b"content-length", str(len(body)).encode("latin-1"))
+    ]})
+    await send({"type": "http.response.body", "body": body})
+
+def load_dictionary(path: Optional[str]) -> Optional[bytes]:
+    if not path:
+        return None
+    with open(path, "rb") as f:
+        return f.read()
+
+def train(samples: list, size: int) -> bytes:
+    """Train a zstd dictionary from sample request bodies"""
+    if zstandard is None:
+        raise RuntimeError("Training a dictionary needs the zstandard package")
+    return zstandard.train_dictionary(size, samples).as_bytes()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    train_parser = subparsers.add_parser("train", help="Train a zstd dictionary from request bodies")
+    train_parser.add_argument("inputs", nargs="+", help="JSON lines files of request bodies")
+    train_parser.add_argument("--output", required=True)
+    train_parser.add_argument("--size", type=int, default=64 * 1024, help="Dictionary size in bytes")
+    args = parser.parse_args()
+
+    samples = []
+    for path in args.inputs:
+        with open(path, "rb") as f:
+            # Re-encode so samples match the bytes the gateway sends
+            samples.extend(json_dumps(json_loads(line)) for line in f if line.strip())
+    dictionary = train(samples, args.size)
+    with open(args.output, "wb") as f:
+        f.write(dictionary)
+    print(f"{len(dictionary)} byte dictionary trained on {len(samples)} samples")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+# Gateway tuning parameters
+
+# Seconds a claim may stay silent before its task is re-queued
+CLAIM_TIMEOUT = 60
+
+# fetch_task policy, see benchmarks/simulator.py for tuning these offline
+FIFO_FETCH_INTERVAL = 1          # Fetches closer together than this use pure FIFO
+TWO_LEVEL_FETCH_INTERVAL = 5     # ...closer than this two-level priority, otherwise strict priority
+EXPIRY_MARGIN = 2                # Stop handing out a chat task this long before its requester gives up
+REQUEUE_PRIORITY_BOOST = 1       # Priority added when a silent claim is re-queued
+
+# Hedged dispatch: when the queue is empty and a claimed task has been running
+# longer than HEDGE_PERCENTILE of observed claim-to-submit times, hand a second
+# copy of it to the idle provider. The first submitted result wins.
+HEDGE_ENABLED = False
+HEDGE_PERCENTILE = 0.95      # Percentile of completion time that triggers a hedge
+HEDGE_MIN_SAMPLES = 50       # Completion samples required before hedging starts
+HEDGE_SAMPLE_WINDOW = 1000   # Number of recent completion samples kept
+HEDGE_BUDGET = 0.05          # Max hedge copies as a fraction of normal dispatches
+
+# Number of recently completed task ids remembered for duplicate submissions
+COMPLETED_TASKS_MAX = 10000
+
+# Raw passthrough: keep chat request and result bodies as bytes from ingress to
+# egress instead of parsing them into dicts and re-encoding them
+RAW_PASSTHROUGH = False
+
+# Asynchronous job API. Jobs live in the worker process that accepted them, so
+# QUEUE_BACKEND = "sqlite" with several workers needs JOBS_ENABLED = False
+JOBS_ENABLED = True
+JOB_DEFAULT_TIMEOUT = 600    # Seconds a job may wait for a result by default
+JOB_MAX_TIMEOUT = 3600       # Upper bound for the per-job timeout parameter
+JOB_MAX_TRIES = 6            # try_count limit, each claim and each re-queue counts once
+JOB_MAX_WAIT = 60            # Longest long-poll wait in seconds
+JOB_RESULT_TTL = 3600        # Seconds a finished job is kept
+JOB_STORE_MAX = 10000        # Maximum number of jobs kept, finished or not
+JOB_CALLBACK_PRIVATE_HOSTS = []  # Callback hosts allowed to resolve to private addresses, e.g. ["localhost"]
+
+# Batch endpoint. Batch status lives in the worker process streaming the batch, so
+# QUEUE_BACKEND = "sqlite" with several workers needs BATCH_ENABLED = False
+BATCH_ENABLED = True
+BATCH_MAX_REQUESTS = 1000    # Maximum number of chat requests in one batch
+BATCH_MAX_IN_FLIGHT = 16     # Requests of one batch queued or running at once
+BATCH_ITEM_TIMEOUT = 300     # Seconds each request may wait once it is queued
+
+# Prefix affinity: prefer handing a provider tasks whose system prompt and
+# leading turns it processed recently, so llama.cpp can reuse its prompt cache
+AFFINITY_ENABLED = True
+AFFINITY_WINDOW = 8              # Tasks at the head of the queue considered
+AFFINITY_MIN_TIME_LEFT = 15      # Never pass over a task with less time left than this
+AFFINITY_PREFIXES_PER_PROVIDER = 4
+
+# Size-aware scheduling: tasks are sized from message length and max_tokens.
+# Providers may advertise {"capacity": {"n_ctx": ..., "tokens_per_second": ...}}
+# in fetch_task, and only get tasks they can finish within one claim
+SIZE_AWARE_ENABLED = True
+SMALL_TASK_TOKENS = 256          # Tasks up to this size use the shortest-job-first lane
+ESTIMATE_CHARS_PER_TOKEN = 1.0   # Japanese and Chinese text is about one token per character
+PREFILL_SPEEDUP = 10             # Prompt tokens are processed this much faster than generated ones
+SIZE_SLACK_SECONDS = 10          # The SJF lane yields to a head task with less time left than this
+SIZE_HEAD_MAX_WAIT = 90          # ...or to a head task that has waited this long
+SIZE_HOLD_SECONDS = 15           # A task no provider was fit for is handed to any provider after this,
+                                 # unless a provider that can run it fetched within SIZE_FLEET_WINDOW
+SIZE_FLEET_WINDOW = 60           # Seconds since its last fetch a provider's capacity counts toward the fleet
+
+# Queue backend: "memory" keeps the queue in this process, "sqlite" shares it
+# through a WAL database so the gateway can run several uvicorn workers.
+# Job and batch state is not shared, the gateway refuses to start with "sqlite"
+# while JOBS_ENABLED or BATCH_ENABLED
+QUEUE_BACKEND = "memory"
+SHARED_QUEUE_PATH = "queue.db"
+SHARED_POLL_INTERVAL = 0.02      # Seconds between checks for results submitted to other workers
+SHARED_SELECT_LIMIT = 256        # Candidates loaded per fetch for dispatch selection
+SHARED_PURGE_AGE = 7200          # Seconds after which orphaned rows are dropped
+SHARED_BUSY_TIMEOUT = 0.05       # Seconds a statement waits for another worker's write lock, it blocks the event loop
+SHARED_BUSY_RETRIES = 5          # Attempts before a locked database error is raised
+
+# Warm restart (memory backend only, the sqlite backend is already durable):
+# the queue, claimed tasks and finished jobs are snapshotted on shutdown and
+# restored on startup. The journal records every queue change in between
+# snapshots so a crash loses nothing either
+SNAPSHOT_ENABLED = False
+SNAPSHOT_PATH = "queue.snapshot"
+SNAPSHOT_INTERVAL = 300          # Seconds between periodic snapshots, 0 for shutdown only
+JOURNAL_ENABLED = False
+JOURNAL_PATH = "queue.journal"
+JOURNAL_FSYNC = False            # fsync every journal record, safe against power loss but slow
+
+# Telegram IDs allowed to use the admin routes (metrics and other diagnostics)
+ADMIN_USER_IDS = []
+
+# Task lifecycle tracing: finished tasks' events are kept in a ring buffer and
+# exported as JSON lines from GET /{token}/traces (admin only). With the sqlite
+# backend, provider-side events reach the requester's worker with the claim
+# state, which is dropped on submit, so only re-queued or timed out tasks show them
+TRACE_ENABLED = True
+TRACE_SAMPLE_RATE = 1.0          # Fraction of tasks traced
+TRACE_BUFFER_SIZE = 10000        # Finished traces kept in memory
+
+# SQLite statement timing, see GET /{token}/db_stats (admin only)
+DB_SLOW_QUERY_SECONDS = 0.05     # Statements slower than this are logged with their query plan
+DB_BUSY_TIMEOUT = 5              # Seconds to wait for a locked database before giving up
+
+# Sampling profiler, see GET /{token}/profile (admin only)
+PROFILE_MAX_SECONDS = 60         # Longest profile allowed
+PROFILE_MIN_INTERVAL = 0.001     # Shortest sampling interval allowed
+PROFILE_MAX_OVERHEAD = 0.02      # Share of wall time the sampler may spend walking stacks
+
+# Usage history: chat and submit events are written in batches and rolled up
+# into hourly and daily tables, see GET /{token}/usage and /{token}/usage/summary
+USAGE_DB_PATH = "usage.db"
+USAGE_FLUSH_INTERVAL = 5         # Seconds between batched event writes
+USAGE_COMPACT_INTERVAL = 60      # Seconds between rollups, queries lag behind by up to this much
+USAGE_RAW_RETENTION = 7 * 86400  # Seconds raw events are kept once rolled up
+USAGE_HOURLY_RETENTION = 90 * 86400  # Seconds hourly rollups are kept, daily rollups are kept forever
+
+# gzip/zstd Content-Encoding on fetch_task and submit_result, zstd needs the zstandard package
+COMPRESSION_ENABLED = True
+COMPRESSION_MIN_SIZE = 1024      # Smallest response body compressed, in bytes
+COMPRESSION_GZIP_LEVEL = 5
+COMPRESSION_ZSTD_LEVEL = 3
+COMPRESSION_ZSTD_DICT_PATH = None  # Dictionary trained with `python -m compression train`, enables zstd-dict
+COMPRESSION_MAX_BODY = 32 * 1024 * 1024  # Largest decompressed request body accepted
+
+# Telegram bot inside the gateway process, None to run telegram_bot.py separately.
+# With several workers, the first to take TELEGRAM_BOT_LOCK_PATH runs it
+TELEGRAM_BOT_TOKEN = None
+TELEGRAM_BOT_LOCK_PATH = "telegram_bot.lock"
+USER_CACHE_TTL = 30              # Seconds /userdata answers from memory
+LEADERBOARD_TTL = 60             # Seconds /globaldata answers from memory
+
+# Overflow forwarding to peer gateways running this project. Each peer is
+# {"url": "http://host:port", "token": "<user_id>-<token>"}, the token being an
+# account on the peer. Chat tasks still unclaimed after PEER_FORWARD_AFTER are
+# sent to the accepting peer with the shallowest queue
+PEERS = []
+PEER_FORWARD_AFTER = 40          # Seconds, below CLAIM_TIMEOUT so the peer has time left
+PEER_MAX_DEPTH = 2               # Largest peer queue depth (with our forwards in flight) still sent tasks
+PEER_MAX_FORWARDS = 16           # Forwarded requests in flight at once
+PEER_POLL_INTERVAL = 5           # Seconds between peer status polls
+PEER_REQUEST_TIMEOUT = 150       # Seconds to wait for a peer's response
+# Answering other gateways' GET /{token}/peer_status
+PEER_ACCEPT = True               # Advertise spare capacity to peers
+PEER_ACCEPT_MAX_DEPTH = 0        # Accept forwarded tasks only while the queue is at most this deep
+PEER_IDLE_WINDOW = 10            # Seconds since a provider found the queue empty to count as idle
+
+# Traffic classes: each request belongs to one class, with its own queue and a
+# guaranteed share of fetch_task claims while it has tasks waiting. Share a
+# class leaves unused goes to the others. The class is taken from the
+# account (TRAFFIC_CLASS_USERS), else the X-Traffic-Class header, else the route
+TRAFFIC_CLASSES = {
+    # share: minimum fraction of claims, claim_timeout: seconds a chat request waits
+    # for a claim (and a claim may stay silent), slo: latency target in seconds
+    "interactive": {"share": 0.5, "claim_timeout": 60, "slo": 30},
+    "bulk": {"share": 0.5, "claim_timeout": 60, "slo": 300}
+}
+TRAFFIC_CLASS_ROUTES = {"chat": "interactive", "job": "bulk", "batch": "bulk"}
+TRAFFIC_CLASS_USERS = {}         # Telegram ID -> class, e.g. accounts of bulk translation tools
+
+# Split chat requests: a requester sending X-Split gets a long last message cut
+# into paragraph-aligned pieces, queued as separate tasks so several providers
+# translate it at once, and one completion joined back from them
+SPLIT_ENABLED = True
+SPLIT_MIN_CHARS = 1000           # Shorter texts are sent as one task
+SPLIT_PIECE_CHARS = 400          # Characters per piece for "X-Split: auto"
+SPLIT_MAX_PIECES = 16            # Pieces are made longer to stay within this many
+SPLIT_PIECE_TRIES = 3            # Times a piece answered with an error is queued again on its own
+# Text before and including the last of these in the message is an instruction
+# (with the glossary) repeated in every piece, the rest is split
+SPLIT_TEXT_MARKERS = ["将下面的日文文本翻译成中文：", "将下面的日文文本根据对应关系和备注翻译成中文："]
@@ -1,9 +1,21 @@
+from abc import ABC, abstractmethod
 from queue import Queue
-from typing import Any, Optional
+from collections import Counter
+from typing import Any, Callable, Optional
 from enum import Enum
+import inspect
 import uuid
 import time
 from threading import Lock
+from utils import json_dumps
+from config import EXPIRY_MARGIN
+from traffic import claim_timeout, class_of
+from metrics import QUEUE_OPERATIONS, QUEUE_GET_SECONDS
+
+_PUTS = QUEUE_OPERATIONS.labels("put")
+_GETS = QUEUE_OPERATIONS.labels("get")
+_EMPTY_GETS = QUEUE_OPERATIONS.labels("get_empty")
+_REMOVES = QUEUE_OPERATIONS.labels("remove")
 
 class QueueMode(Enum):
     PURE_FIFO = 1      # Pure FIFO mode
@@ -20,11 +32,77 @@ class PriorityItem:
         return self.priority > other.priority or \
                (self.priority == other.priority and self.sequence < other.sequence)
 
-class CustomQueue:
+def levels(items: list, mode: QueueMode) -> list:
+    """Split items sorted for mode into runs of the same priority class, highest first"""
+    if mode == QueueMode.PURE_FIFO:
+        return [items] if items else []
+    if mode == QueueMode.TWO_LEVEL:
+        key = lambda x: x.priority > 0
+    else:  # STRICT_PRIORITY
+        key = lambda x: x.priority
+    runs = []
+    for item in items:
+        if runs and key(runs[-1][0]) == key(item):
+            runs[-1].append(item)
+        else:
+            runs.append([item])
+    return runs
+
+class QueueBackend(ABC):
+    """
+    Interface shared by the in-process CustomQueue and the multi-process queue in shared_backend.py
+
+    put/put_many/get/remove_task/empty behave like a priority queue of Tasks,
+    partitioned by the tasks' traffic class when get() is given classes.
+    claim() publishes a task's claim fields after fetch_task changed them and refresh()
+    loads them back into the requester's copy, both are no-ops when the Task object is shared.
+    touch_last_fetch() stores the time of a fetch and returns the previous one.
+    """
+    @abstractmethod
+    def put(self, item: Any, priority: int = 0) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def put_many(self, items: list, priority: int = 0) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get(self, mode: QueueMode = QueueMode.PURE_FIFO, select: Callable[[list], Optional[int]] = None,
+            classes: list = None) -> Optional[Any]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def empty(self) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def class_sizes(self) -> dict:
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_task(self, task_id: str) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def qsize(self) -> int:
+        raise NotImplementedError
+
+    def claim(self, task) -> None:
+        pass
+
+    def refresh(self, task) -> None:
+        pass
+
+    @abstractmethod
+    def touch_last_fetch(self, now: float) -> float:
+        raise NotImplementedError
+
+class CustomQueue(QueueBackend):
     def __init__(self):
         self.queue = Queue()
         self.sequence_counter = 0
         self.lock = Lock()  # Add lock
+        self.last_fetch_time = 0
     
     def put(self, item: Any, priority: int = 0) -> None:
         """Put an item into the queue with specified priority"""
@@ -32,13 +110,35 @@ class CustomQueue:
             priority_item = PriorityItem(item, priority, self.sequence_counter)
             self.sequence_counter += 1
             self.queue.put(priority_item)
+        _PUTS.inc()
+
+    def put_many(self, items: list, priority: int = 0) -> None:
+        """Put several items into the queue with the same priority under one lock"""
+        with self.lock:
+            for item in items:
+                self.queue.put(PriorityItem(item, priority, self.sequence_counter))
+                self.sequence_counter += 1
+        _PUTS.inc(len(items))
     
-    def get(self, mode: QueueMode = QueueMode.PURE_FIFO) -> Optional[Any]:
-        """Get an item from the queue based on the specified mode"""
+    def get(self, mode: QueueMode = QueueMode.PURE_FIFO, select: Callable[[list], Optional[int]] = None,
+            classes: list = None) -> Optional[Any]:
+        """
+        Get an item from the queue based on the specified mode
+        Args:
+            mode: Queue mode deciding the order
+            select: Optional callback given the items that rank level with each other
+                    (same priority class in the current mode), in order, returning
+                    the index of the item to take, or None to try the next level down
+            classes: Traffic classes to take from in order of preference, each
+                     class is ordered and passed to select on its own and the first
+                     one yielding an item wins; None to treat all items as one queue
+        """
         with self.lock:
             if self.queue.empty():
+                _EMPTY_GETS.inc()
                 return None
-                
+
+            start = time.perf_counter()
             # Convert queue to list for sorting
             items = []
             while not self.queue.empty():
@@ -50,32 +150,109 @@ class CustomQueue:
                 items.sort(key=lambda x: (-1 if x.priority > 0 else 0, x.sequence))
             else:  # STRICT_PRIORITY
                 items.sort()
-                
-            # Get first item and put back the rest
-            result = items[0].item
-            for item in items[1:]:
-                self.queue.put(item)
-                
-            return result
+
+            if classes is None:
+                groups = [items]
+            else:
+                groups = [[x for x in items if class_of(x.item.traffic_class) == name] for name in classes]
+
+            result = None
+            for group in groups:
+                if not group:
+                    continue
+                if select is None:
+                    result = group[0]
+                    break
+                # A provider that can't take anything at the head's level may still suit a lower one
+                for level in levels(group, mode):
+                    index = select([x.item for x in level])
+                    if index is not None:
+                        result = level[index]
+                        break
+                if result is not None:
+                    break
+
+            # Put back everything but the selected item
+            for item in items:
+                if item is not result:
+                    self.queue.put(item)
+
+            QUEUE_GET_SECONDS.observe(time.perf_counter() - start)
+            if result is None:
+                _EMPTY_GETS.inc()
+                return None
+            _GETS.inc()
+            return result.item
     
     def empty(self) -> bool:
         """Check if the queue is empty"""
         return self.queue.empty()
+
+    def qsize(self) -> int:
+        """Get the number of queued items"""
+        return self.queue.qsize()
+
+    def class_sizes(self) -> dict:
+        """Get the number of queued items per traffic class"""
+        with self.lock:
+            return dict(Counter(class_of(x.item.traffic_class) for x in self.queue.queue))
     
-    def remove_task(self, task_id: str) -> None:
-        """Remove a task from queue by its task_id"""
+    def remove_task(self, task_id: str) -> bool:
+        """
+        Remove a task from queue by its task_id
+        Returns:
+            bool: True if the task was in the queue
+        """
         with self.lock:
             items = []
+            found = False
             while not self.queue.empty():
                 item = self.queue.get()
                 if item.item.task_id != task_id:
                     items.append(item)
+                else:
+                    found = True
                     
             # Put back the remaining items
             for item in items:
                 self.queue.put(item)
+        _REMOVES.inc()
+        return found
+
+    def snapshot_items(self) -> list:
+        """Get (priority, sequence, item) of every queued item without removing them"""
+        with self.lock:
+            return [(x.priority, x.sequence, x.item) for x in self.queue.queue]
+
+    def restore_items(self, items: list, sequence_counter: int) -> None:
+        """Put back items from snapshot_items(), keeping their priority and order"""
+        with self.lock:
+            for priority, sequence, item in items:
+                self.queue.put(PriorityItem(item, priority, sequence))
+            self.sequence_counter = max(self.sequence_counter, sequence_counter)
+
+    def touch_last_fetch(self, now: float) -> float:
+        """Record a fetch at now, returning the previous fetch time"""
+        previous = self.last_fetch_time
+        self.last_fetch_time = now
+        return previous
 
 class Task:
+    # __slots__ keeps queued tasks small, there can be thousands of them
+    __slots__ = (
+        "request_body", "request_bytes", "requester_id", "is_urgent", "try_count",
+        "first_provider_id", "task_id", "created_at", "claimed_at", "response_body",
+        "provider_id", "hedge_provider_id", "hedge_claimed_at", "max_tokens", "deadline",
+        "prefix_key", "prompt_tokens", "generation_tokens", "is_job", "callback_url", "trace", "traffic_class",
+        "held_since"
+    )
+
+    # Fields changed by fetch_task when a provider claims the task
+    CLAIM_FIELDS = (
+        "is_urgent", "try_count", "first_provider_id", "claimed_at",
+        "provider_id", "hedge_provider_id", "hedge_claimed_at", "trace"
+    )
+
     def __init__(self, 
                  request_body: dict,
                  requester_id: int,
@@ -83,9 +260,23 @@ class Task:
                  is_urgent: bool = False,
                  try_count: int = 0,
                  first_provider_id: int = None,
-                 created_at: float = time.time(),
+                 created_at: float = None,
                  claimed_at: float = None,
-                 response_body: dict = None
+                 response_body: dict = None,
+                 provider_id: int = None,
+                 hedge_provider_id: int = None,
+                 hedge_claimed_at: float = None,
+                 request_bytes: bytes = None,
+                 max_tokens: int = None,
+                 deadline: float = None,
+                 prefix_key: str = None,
+                 prompt_tokens: int = 0,
+                 generation_tokens: int = 0,
+                 is_job: bool = False,
+                 callback_url: str = None,
+                 trace: list = None,
+                 traffic_class: str = None,
+                 held_since: float = None
                  ):
         """
         Args:
@@ -95,6 +286,21 @@ class Task:
             try_count: Number of times this task has been tried
             first_provider_id: ID of the first provider who processed this task
             task_id: Unique identifier for the task
+            created_at: When the task was created (defaults to now)
+            provider_id: ID of the provider holding the current claim
+            hedge_provider_id: ID of the provider running the hedge copy, if any
+            hedge_claimed_at: When the hedge copy was dispatched
+            request_bytes: Raw request body, used instead of request_body in passthrough mode
+            max_tokens: max_tokens extracted from the request body
+            deadline: Timestamp after which the task is abandoned, None for chat tasks
+            prefix_key: Fingerprint of the shared message prefix, for prompt cache affinity
+            prompt_tokens: Estimated prompt length in tokens
+            generation_tokens: Estimated completion length in tokens
+            is_job: Whether the task belongs to an asynchronous job
+            callback_url: The job's callback URL, if any
+            trace: Lifecycle events [(timestamp, event, detail)], None if not traced
+            traffic_class: Name of the traffic class, see TRAFFIC_CLASSES in config.py
+            held_since: When a provider was first refused the task for its size, None if never
         """
         self.request_body = request_body
         self.requester_id = requester_id
@@ -102,6 +308,76 @@ class Task:
         self.try_count = try_count
         self.first_provider_id = first_provider_id
         self.task_id = task_id
-        self.created_at = created_at
+        self.created_at = created_at if created_at is not None else time.time()
         self.claimed_at = claimed_at
         self.response_body = response_body
+        self.provider_id = provider_id
+        self.hedge_provider_id = hedge_provider_id
+        self.hedge_claimed_at = hedge_claimed_at
+        self.request_bytes = request_bytes
+        self.max_tokens = max_tokens
+        self.deadline = deadline
+        self.prefix_key = prefix_key
+        self.prompt_tokens = prompt_tokens
+        self.generation_tokens = generation_tokens
+        self.is_job = is_job
+        self.callback_url = callback_url
+        self.trace = trace
+        self.traffic_class = traffic_class
+        self.held_since = held_since
+
+    def trace_event(self, event: str, **detail) -> None:
+        """Record a lifecycle event if the task is traced"""
+        if self.trace is not None:
+            self.trace.append((time.time(), event, detail or None))
+
+    def expires_at(self) -> Optional[float]:
+        """Get the time after which the task is no longer worth handing out, None if never"""
+        if self.deadline is not None:
+            return self.deadline - EXPIRY_MARGIN
+        # A chat requester waits one claim timeout of its class for the first claim and one more after a re-queue
+        if self.try_count <= 1:
+            return self.created_at + claim_timeout(self.traffic_class) * (self.try_count + 1) - EXPIRY_MARGIN
+        return None
+
+    def _meta(self) -> dict:
+        """Get the fields sent to providers besides the request body"""
+        return {
+            "requester_id": self.requester_id,
+            "is_urgent": self.is_urgent,
+            "try_count": self.try_count,
+            "first_provider_id": self.first_provider_id,
+            "task_id": self.task_id,
+            "created_at": self.created_at,
+            "claimed_at": self.claimed_at,
+            "response_body": self.response_body,
+            "provider_id": self.provider_id,
+            "hedge_provider_id": self.hedge_provider_id,
+            "hedge_claimed_at": self.hedge_claimed_at
+        }
+
+    def to_dict(self) -> dict:
+        """Get the task as sent to providers by fetch_task"""
+        data = {"request_body": self.request_body}
+        data.update(self._meta())
+        return data
+
+    def __setstate__(self, state: tuple) -> None:
+        """Unpickle a task, slots added since it was pickled (old snapshots, journals, queue rows) get their defaults"""
+        for name, value in _SLOT_DEFAULTS.items():
+            setattr(self, name, value)
+        for name, value in state[1].items():
+            setattr(self, name, value)
+
+    def to_json_bytes(self) -> bytes:
+        """Serialize the task for providers, splicing in the raw request body without parsing it"""
+        if self.request_bytes is None:
+            return json_dumps(self.to_dict())
+        # _meta() is never empty, so its encoding always starts with '{"'
+        return b'{"request_body":' + self.request_bytes + b',' + json_dumps(self._meta())[1:]
+
+# Keyword defaults of Task.__init__, see Task.__setstate__
+_SLOT_DEFAULTS = {
+    name: parameter.default for name, parameter in inspect.signature(Task.__init__).parameters.items()
+    if name in Task.__slots__ and parameter.default is not inspect.Parameter.empty
+}
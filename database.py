@@ -1,11 +1,18 @@
-import sqlite3
+from querylog import connect
 from utils import generate_random_password
 import asyncio
+import datetime
 import time
+from metrics import timed, DB_QUERY_SECONDS
 
+def current_day() -> int:
+    """Get today's local date as a day number, daily_usage counts only when daily_usage_day matches it"""
+    return datetime.date.today().toordinal()
+
+@timed(DB_QUERY_SECONDS)
 def init_db():
     """Initialize SQLite database"""
-    conn = sqlite3.connect('data.db')
+    conn = connect('data.db')
     c = conn.cursor()
     
     # Create users table if not exists
@@ -19,16 +26,23 @@ def init_db():
             total_usage INTEGER DEFAULT 0,
             daily_usage INTEGER DEFAULT 0,
             is_banned BOOLEAN DEFAULT 0,
-            temp_ban_until INTEGER DEFAULT 0
+            temp_ban_until INTEGER DEFAULT 0,
+            daily_usage_day INTEGER DEFAULT 0
         )
     ''')
     
-    # Reset daily_usage to 0 for all users
-    c.execute('UPDATE users SET daily_usage = 0')
+    # Databases created before daily_usage_day: their daily_usage reads as 0 until the next increment
+    c.execute('PRAGMA table_info(users)')
+    if 'daily_usage_day' not in [column[1] for column in c.fetchall()]:
+        c.execute('ALTER TABLE users ADD COLUMN daily_usage_day INTEGER DEFAULT 0')
+    
+    # Today's leaderboard only reads rows stamped today
+    c.execute('CREATE INDEX IF NOT EXISTS users_daily_usage ON users (daily_usage_day, daily_usage)')
     
     conn.commit()
     conn.close()
 
+@timed(DB_QUERY_SECONDS)
 def create_or_update_user(telegram_id: int, telegram_name: str = None) -> str:
     """
     Create a new user or update existing user's telegram_name in the database
@@ -38,7 +52,7 @@ def create_or_update_user(telegram_id: int, telegram_name: str = None) -> str:
     Returns:
         str: User's token
     """
-    conn = sqlite3.connect('data.db')
+    conn = connect('data.db')
     c = conn.cursor()
     
     # Check if user already exists
@@ -69,6 +83,7 @@ def create_or_update_user(telegram_id: int, telegram_name: str = None) -> str:
     conn.close()
     return token
 
+@timed(DB_QUERY_SECONDS)
 def refresh_user_token(telegram_id: int) -> str:
     """
     Refresh user's token in the database
@@ -77,7 +92,7 @@ def refresh_user_token(telegram_id: int) -> str:
     Returns:
         str: New token, or None if user doesn't exist
     """
-    conn = sqlite3.connect('data.db')
+    conn = connect('data.db')
     c = conn.cursor()
     
     # Check if user exists
@@ -98,6 +113,7 @@ def refresh_user_token(telegram_id: int) -> str:
     conn.close()
     return new_token
 
+@timed(DB_QUERY_SECONDS)
 def increase_contribution(telegram_id: int, amount: int = 1) -> bool:
     """
     Increase user's contribution by specified amount (default 1)
@@ -107,7 +123,7 @@ def increase_contribution(telegram_id: int, amount: int = 1) -> bool:
     Returns:
         bool: True if successful, False if user doesn't exist
     """
-    conn = sqlite3.connect('data.db')
+    conn = connect('data.db')
     c = conn.cursor()
     
     # Check if user exists
@@ -127,6 +143,7 @@ def increase_contribution(telegram_id: int, amount: int = 1) -> bool:
     conn.close()
     return True
 
+@timed(DB_QUERY_SECONDS)
 def increase_credit(telegram_id: int, amount: int = -1) -> bool:
     """
     Increase user's credit by specified amount (default -1)
@@ -137,7 +154,7 @@ def increase_credit(telegram_id: int, amount: int = -1) -> bool:
     Returns:
         bool: True if successful, False if user doesn't exist
     """
-    conn = sqlite3.connect('data.db')
+    conn = connect('data.db')
     c = conn.cursor()
     
     # Check if user exists and get current credit
@@ -162,6 +179,7 @@ def increase_credit(telegram_id: int, amount: int = -1) -> bool:
     conn.close()
     return True
 
+@timed(DB_QUERY_SECONDS)
 def increase_total_usage(telegram_id: int, amount: int = 1) -> bool:
     """
     Increase user's total_usage by specified amount (default 1)
@@ -171,7 +189,7 @@ def increase_total_usage(telegram_id: int, amount: int = 1) -> bool:
     Returns:
         bool: True if successful, False if user doesn't exist
     """
-    conn = sqlite3.connect('data.db')
+    conn = connect('data.db')
     c = conn.cursor()
     
     # Check if user exists
@@ -191,6 +209,7 @@ def increase_total_usage(telegram_id: int, amount: int = 1) -> bool:
     conn.close()
     return True
 
+@timed(DB_QUERY_SECONDS)
 def increase_daily_usage(telegram_id: int, amount: int = 1) -> bool:
     """
     Increase user's daily_usage by specified amount (default 1)
@@ -200,7 +219,7 @@ def increase_daily_usage(telegram_id: int, amount: int = 1) -> bool:
     Returns:
         bool: True if successful, False if user doesn't exist
     """
-    conn = sqlite3.connect('data.db')
+    conn = connect('data.db')
     c = conn.cursor()
     
     # Check if user exists
@@ -209,18 +228,21 @@ def increase_daily_usage(telegram_id: int, amount: int = 1) -> bool:
         conn.close()
         return False
         
-    # Update daily_usage
+    # Update daily_usage, starting from 0 if it was last written on an earlier day
+    today = current_day()
     c.execute('''
         UPDATE users 
-        SET daily_usage = daily_usage + ?
+        SET daily_usage = CASE WHEN daily_usage_day = ? THEN daily_usage + ? ELSE ? END,
+            daily_usage_day = ?
         WHERE telegram_id = ?
-    ''', (amount, telegram_id))
+    ''', (today, amount, amount, today, telegram_id))
     
     conn.commit()
     conn.close()
     return True
 
 #Unused
+@timed(DB_QUERY_SECONDS)
 def set_user_ban_status(telegram_id: int, ban: bool = True) -> bool:
     """
     Set user's ban status
@@ -230,7 +252,7 @@ def set_user_ban_status(telegram_id: int, ban: bool = True) -> bool:
     Returns:
         bool: True if successful, False if user doesn't exist
     """
-    conn = sqlite3.connect('data.db')
+    conn = connect('data.db')
     c = conn.cursor()
     
     # Check if user exists
@@ -250,6 +272,7 @@ def set_user_ban_status(telegram_id: int, ban: bool = True) -> bool:
     conn.close()
     return True
 
+@timed(DB_QUERY_SECONDS)
 def get_user_info(telegram_id: int) -> dict:
     """
     Get user information from database
@@ -258,16 +281,16 @@ def get_user_info(telegram_id: int) -> dict:
     Returns:
         dict: User information including all fields, or None if user doesn't exist
     """
-    conn = sqlite3.connect('data.db')
+    conn = connect('data.db')
     c = conn.cursor()
     
     # Get user info
     c.execute('''
         SELECT telegram_id, telegram_name, token, contribution, 
-               credit, total_usage, daily_usage, is_banned
+               credit, total_usage, CASE WHEN daily_usage_day = ? THEN daily_usage ELSE 0 END, is_banned
         FROM users 
         WHERE telegram_id = ?
-    ''', (telegram_id,))
+    ''', (current_day(), telegram_id))
     
     user = c.fetchone()
     conn.close()
@@ -287,6 +310,7 @@ def get_user_info(telegram_id: int) -> dict:
         'is_banned': bool(user[7])
     }
 
+@timed(DB_QUERY_SECONDS)
 def get_top_contributors(limit: int = 5) -> list:
     """
     Get top N users with highest contribution (>0)
@@ -295,7 +319,7 @@ def get_top_contributors(limit: int = 5) -> list:
     Returns:
         list: List of tuples (telegram_name, contribution)
     """
-    conn = sqlite3.connect('data.db')
+    conn = connect('data.db')
     c = conn.cursor()
     
     c.execute('''
@@ -310,6 +334,7 @@ def get_top_contributors(limit: int = 5) -> list:
     conn.close()
     return result
 
+@timed(DB_QUERY_SECONDS)
 def get_top_credits(limit: int = 5) -> list:
     """
     Get top N users with highest credit (>0)
@@ -318,7 +343,7 @@ def get_top_credits(limit: int = 5) -> list:
     Returns:
         list: List of tuples (telegram_name, credit)
     """
-    conn = sqlite3.connect('data.db')
+    conn = connect('data.db')
     c = conn.cursor()
     
     c.execute('''
@@ -333,6 +358,7 @@ def get_top_credits(limit: int = 5) -> list:
     conn.close()
     return result
 
+@timed(DB_QUERY_SECONDS)
 def get_top_total_usage(limit: int = 5) -> list:
     """
     Get top N users with highest total usage (>0)
@@ -341,7 +367,7 @@ def get_top_total_usage(limit: int = 5) -> list:
     Returns:
         list: List of tuples (telegram_name, total_usage)
     """
-    conn = sqlite3.connect('data.db')
+    conn = connect('data.db')
     c = conn.cursor()
     
     c.execute('''
@@ -356,6 +382,7 @@ def get_top_total_usage(limit: int = 5) -> list:
     conn.close()
     return result
 
+@timed(DB_QUERY_SECONDS)
 def get_top_daily_usage(limit: int = 5) -> list:
     """
     Get top N users with highest daily usage (>0)
@@ -364,22 +391,23 @@ def get_top_daily_usage(limit: int = 5) -> list:
     Returns:
         list: List of tuples (telegram_name, daily_usage)
     """
-    conn = sqlite3.connect('data.db')
+    conn = connect('data.db')
     c = conn.cursor()
     
     c.execute('''
         SELECT telegram_name, daily_usage
         FROM users
-        WHERE daily_usage > 0
+        WHERE daily_usage_day = ? AND daily_usage > 0
         ORDER BY daily_usage DESC
         LIMIT ?
-    ''', (limit,))
+    ''', (current_day(), limit))
     
     result = c.fetchall()
     conn.close()
     return result
 
 #Unused
+@timed(DB_QUERY_SECONDS)
 def is_temp_banned(telegram_id: int) -> bool:
     """
     Check if user is temporarily banned
@@ -388,7 +416,7 @@ def is_temp_banned(telegram_id: int) -> bool:
     Returns:
         bool: True if user is temp banned and ban period hasn't expired, False otherwise
     """
-    conn = sqlite3.connect('data.db')
+    conn = connect('data.db')
     c = conn.cursor()
     
     # Get user's temp ban timestamp
@@ -408,6 +436,7 @@ def is_temp_banned(telegram_id: int) -> bool:
     current_time = int(asyncio.get_event_loop().time())
     return result[0] > current_time
 
+@timed(DB_QUERY_SECONDS)
 def set_temp_ban(telegram_id: int, ban_until: int) -> bool:
     """
     Set user's temporary ban end time
@@ -417,7 +446,7 @@ def set_temp_ban(telegram_id: int, ban_until: int) -> bool:
     Returns:
         bool: True if successful, False if user doesn't exist
     """
-    conn = sqlite3.connect('data.db')
+    conn = connect('data.db')
     c = conn.cursor()
     
     # Check if user exists
@@ -437,6 +466,7 @@ def set_temp_ban(telegram_id: int, ban_until: int) -> bool:
     conn.close()
     return True
 
+@timed(DB_QUERY_SECONDS)
 def is_token_valid(telegram_id: int, token: str) -> bool:
     """
     Check if user's token is valid
@@ -446,7 +476,7 @@ def is_token_valid(telegram_id: int, token: str) -> bool:
     Returns:
         bool: True if token is valid, False otherwise
     """
-    conn = sqlite3.connect('data.db')
+    conn = connect('data.db')
     c = conn.cursor()
     
     # Check if user exists and get token, ban status and temp ban timestamp
@@ -477,6 +507,7 @@ def is_token_valid(telegram_id: int, token: str) -> bool:
     # Check token match
     return token == stored_token
 
+@timed(DB_QUERY_SECONDS)
 def get_user_credit(telegram_id: int) -> int:
     """
     Get user's credit
@@ -485,7 +516,7 @@ def get_user_credit(telegram_id: int) -> int:
     Returns:
         int: User's credit
     """
-    conn = sqlite3.connect('data.db')
+    conn = connect('data.db')
     c = conn.cursor()
     c.execute('SELECT credit FROM users WHERE telegram_id = ?', (telegram_id,))
     result = c.fetchone()
@@ -0,0 +1,168 @@
+from typing import Optional
+
+from custom_queue import QueueMode
+from traffic import claim_timeout
+from utils import json_string_values, json_string_length, json_int_value
+from config import SIZE_AWARE_ENABLED, SMALL_TASK_TOKENS, ESTIMATE_CHARS_PER_TOKEN, \
+    PREFILL_SPEEDUP, SIZE_SLACK_SECONDS, SIZE_HEAD_MAX_WAIT, SIZE_HOLD_SECONDS, FIFO_FETCH_INTERVAL, TWO_LEVEL_FETCH_INTERVAL
+
+def queue_mode_for(since_last_fetch: float) -> QueueMode:
+    """
+    Pick the queue mode from the time since the previous fetch
+    Frequent fetches mean spare capacity, so plain FIFO is fair enough;
+    rare fetches mean providers are saturated and credit decides
+    """
+    if since_last_fetch < FIFO_FETCH_INTERVAL:
+        return QueueMode.PURE_FIFO
+    elif since_last_fetch < TWO_LEVEL_FETCH_INTERVAL:
+        return QueueMode.TWO_LEVEL
+    return QueueMode.STRICT_PRIORITY
+
+def estimate_tokens(request_body: dict) -> tuple[int, int]:
+    """
+    Estimate the size of a chat request from its message length and max_tokens
+    Returns:
+        tuple: (prompt_tokens: int, generation_tokens: int)
+    """
+    lengths = []
+    messages = request_body.get("messages")
+    if isinstance(messages, list):
+        for message in messages:
+            content = message.get("content") if isinstance(message, dict) else None
+            if isinstance(content, str):
+                lengths.append(len(content))
+    return size_estimate(lengths, request_body.get("max_tokens"))
+
+def estimate_raw_tokens(request: bytes) -> tuple[int, int]:
+    """
+    estimate_tokens for a raw chat request body, reading only its content strings and max_tokens
+    Raises:
+        ValueError: If a content string is not terminated
+    """
+    lengths = [json_string_length(request[start:end]) for start, end in json_string_values(request, "content")]
+    return size_estimate(lengths, json_int_value(request, "max_tokens"))
+
+def size_estimate(lengths: list, max_tokens) -> tuple[int, int]:
+    """Estimate (prompt_tokens, generation_tokens) from the length of each message and max_tokens"""
+    prompt_tokens = int(sum(lengths) / ESTIMATE_CHARS_PER_TOKEN)
+
+    # A translation is about as long as its source text
+    last_chars = lengths[-1] if lengths else 0
+    if isinstance(max_tokens, int) and max_tokens > 0:
+        generation_tokens = max_tokens
+    else:
+        generation_tokens = int(last_chars / ESTIMATE_CHARS_PER_TOKEN)
+    return prompt_tokens, generation_tokens
+
+def parse_capacity(capacity) -> dict:
+    """Keep the valid fields of a provider's advertised capacity"""
+    if not isinstance(capacity, dict):
+        return {}
+    parsed = {}
+    for key in ("n_ctx", "tokens_per_second"):
+        value = capacity.get(key)
+        if isinstance(value, (int, float)) and not isinstance(value, bool) and value > 0:
+            parsed[key] = value
+    return parsed
+
+def estimate_seconds(task, capacity: dict) -> Optional[float]:
+    """Estimate how long a provider needs for a task, None if it did not advertise its speed"""
+    tokens_per_second = capacity.get("tokens_per_second")
+    if not tokens_per_second:
+        return None
+    return (task.prompt_tokens / PREFILL_SPEEDUP + task.generation_tokens) / tokens_per_second
+
+class FleetCapacity:
+    def __init__(self, window: float = 60):
+        """
+        Capacities recently advertised by the providers fetching from this worker
+        Args:
+            window: Seconds since its last fetch a provider still counts as part of the fleet
+        """
+        self.window = window
+        self.providers = {}
+
+    def record(self, provider_id: int, capacity: dict, now: float) -> None:
+        """Remember the capacity a provider sent with fetch_task"""
+        self.providers[provider_id] = (now, capacity)
+
+    def can_run(self, task, now: float) -> bool:
+        """Check if any provider seen within the window could fit and finish the task"""
+        for provider_id, (seen_at, capacity) in list(self.providers.items()):
+            if now - seen_at > self.window:
+                del self.providers[provider_id]
+            elif fits(task, capacity, now):
+                return True
+        return False
+
+def can_finish(task, capacity: dict, now: float, fleet: FleetCapacity = None) -> bool:
+    """
+    Check if a provider can fit a task in its context and finish it before it expires
+    A task held back for SIZE_HOLD_SECONDS since a provider was first refused it goes to
+    any provider once no provider in the fleet could run it either: trying then beats
+    waiting for a requester timeout
+    """
+    if fits(task, capacity, now):
+        return True
+    if task.held_since is None:
+        task.held_since = now
+    return now - task.held_since >= SIZE_HOLD_SECONDS and (fleet is None or not fleet.can_run(task, now))
+
+def fits(task, capacity: dict, now: float) -> bool:
+    """Check a task's size against a provider's context and speed, see can_finish"""
+    n_ctx = capacity.get("n_ctx")
+    if n_ctx and task.prompt_tokens + task.generation_tokens > n_ctx:
+        return False
+    seconds = estimate_seconds(task, capacity)
+    if seconds is None:
+        return True
+    # A claim silent for its class's claim timeout is re-queued, so the whole job must fit in one claim
+    if seconds > claim_timeout(task.traffic_class):
+        return False
+    return task.deadline is None or now + seconds <= task.deadline
+
+def select_task(tasks: list, provider_id: int, capacity: dict, now: float, affinity=None,
+                fleet: FleetCapacity = None) -> Optional[int]:
+    """
+    Pick which of the candidate tasks to hand to a provider
+    Args:
+        tasks: Candidate tasks in scheduling order
+        provider_id: ID of the provider asking for work
+        capacity: The provider's advertised capacity, see parse_capacity
+        now: Current timestamp
+        affinity: Optional AffinityTracker
+        fleet: Optional FleetCapacity, keeps tasks held back while a provider that can run them is around
+    Returns:
+        int: Index into tasks, or None if no task suits this provider
+    """
+    if SIZE_AWARE_ENABLED:
+        # Big jobs only go to providers that can finish them in time
+        indices = [i for i, task in enumerate(tasks) if can_finish(task, capacity, now, fleet)]
+        if not indices:
+            return None
+        candidates = [tasks[i] for i in indices]
+    else:
+        indices = None
+        candidates = tasks
+
+    choice = None
+    if affinity is not None:
+        choice = affinity.select(provider_id, candidates, now)
+
+    if choice is None and SIZE_AWARE_ENABLED:
+        # Shortest-job-first lane for small jobs, unless the head is running out of slack or has waited
+        # too long, re-queued chat tasks never expire and could otherwise be passed over forever
+        head = candidates[0]
+        expires_at = head.expires_at()
+        if (expires_at is None or expires_at - now > SIZE_SLACK_SECONDS) and now - head.created_at < SIZE_HEAD_MAX_WAIT:
+            smallest = None
+            for i, task in enumerate(candidates):
+                size = task.prompt_tokens + task.generation_tokens
+                if size <= SMALL_TASK_TOKENS and (smallest is None or size < smallest[1]):
+                    smallest = (i, size)
+            if smallest is not None:
+                choice = smallest[0]
+
+    if choice is None:
+        choice = 0
+    return indices[choice] if indices is not None else choice
@@ -1,13 +1,54 @@
 from database import is_token_valid, get_user_credit, set_temp_ban
-from fastapi import HTTPException, FastAPI
+from fastapi import HTTPException, FastAPI, Response
+from fastapi.responses import StreamingResponse
 from models import is_valid_model, AVAILABLE_MODELS, verify_model_meta
-from utils import parse_user_token
+from utils import parse_user_token, json_loads, json_dumps, json_int_value, json_has_key
 from custom_queue import Task, QueueMode
+from config import REQUEUE_PRIORITY_BOOST, HEDGE_ENABLED, COMPLETED_TASKS_MAX, RAW_PASSTHROUGH, \
+    JOB_DEFAULT_TIMEOUT, JOB_MAX_TIMEOUT, JOB_MAX_TRIES, JOB_MAX_WAIT, \
+    BATCH_MAX_REQUESTS, BATCH_MAX_IN_FLIGHT, BATCH_ITEM_TIMEOUT, AFFINITY_ENABLED, ADMIN_USER_IDS, \
+    PEER_ACCEPT, PEER_ACCEPT_MAX_DEPTH, PEER_IDLE_WINDOW, SPLIT_PIECE_TRIES
+from jobs import Job, is_allowed_callback_url, send_callback
+from batches import Batch
+from affinity import prefix_fingerprint, raw_prefix_fingerprint
+from querylog import QUERY_LOG
+from profiler import collapsed
+from peering import PeerError
+from traffic import resolve_class, claim_timeout, record_request, TRAFFIC_CLASS_HEADER
+from split import SplitRequest, SplitPieceError, parse_split, piece_completion, SPLIT_HEADER
+from usage import ROLES as USAGE_ROLES, RESOLUTIONS as USAGE_RESOLUTIONS
+from dispatch import estimate_tokens, estimate_raw_tokens, parse_capacity, select_task, queue_mode_for
+from metrics import REGISTRY, TASK_WAIT_SECONDS, CLAIM_TO_SUBMIT_SECONDS, FETCHES, DISPATCHES, EXPIRED_SKIPS, \
+    REQUEUES, SUBMITS, CHAT_REQUESTS, CHAT_SECONDS, PEER_FORWARDS, SPLIT_REQUESTS, SPLIT_PIECES
 import uuid
 import asyncio
+import threading
 import time
 
-async def chat_completions_handler(user_token: str, model_name: str, request: dict, app: FastAPI):
+# Metric children used on every request, looked up once
+_DISPATCHES = {mode: DISPATCHES.labels(mode.name.lower()) for mode in QueueMode}
+_FETCH_DISPATCHED = FETCHES.labels("dispatched")
+_FETCH_HEDGED = FETCHES.labels("hedged")
+_FETCH_EMPTY = FETCHES.labels("empty")
+_SUBMIT_SUCCESS = SUBMITS.labels("success")
+_SUBMIT_DUPLICATE = SUBMITS.labels("duplicate")
+_SUBMIT_NOT_FOUND = SUBMITS.labels("not_found")
+_CHAT_COMPLETED = CHAT_REQUESTS.labels("completed")
+_CHAT_TIMEOUT = CHAT_REQUESTS.labels("timeout")
+_FORWARD_COMPLETED = PEER_FORWARDS.labels("completed")
+_FORWARD_FAILED = PEER_FORWARDS.labels("failed")
+_PIECE_COMPLETED = SPLIT_PIECES.labels("completed")
+_PIECE_RETRIED = SPLIT_PIECES.labels("retried")
+_PIECE_FAILED = SPLIT_PIECES.labels("failed")
+
+def authenticate_user(user_token: str) -> int:
+    """
+    Parse and validate a user token
+    Returns:
+        int: The user's ID
+    Raises:
+        HTTPException: If the token is malformed, invalid or banned
+    """
     # Parse user token into user_id and token
     try:
         user_id, token = parse_user_token(user_token)
@@ -37,7 +78,308 @@ async def chat_completions_handler(user_token: str, model_name: str, request: di
                 }
             }
         )
-        
+    return user_id
+
+def authenticate_admin(user_token: str) -> int:
+    """
+    Validate a user token and check the user is listed in ADMIN_USER_IDS
+    Raises:
+        HTTPException: If the token is invalid or the user is not an admin
+    """
+    user_id = authenticate_user(user_token)
+    if user_id not in ADMIN_USER_IDS:
+        raise HTTPException(
+            status_code=403,
+            detail={
+                "error": {
+                    "message": "Admin access required",
+                    "type": "permission_error",
+                    "param": "user_token",
+                    "code": "forbidden"
+                }
+            }
+        )
+    return user_id
+
+def load_json_body(body: bytes) -> dict:
+    """
+    Parse a JSON object from a raw request body
+    Raises:
+        HTTPException: If the body is not a JSON object
+    """
+    try:
+        data = json_loads(body)
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        raise invalid_json_body()
+    return data
+
+def check_raw_body(body: bytes) -> None:
+    """
+    Check a raw request body looks like a JSON object without parsing it (passthrough mode)
+    Malformed bodies that get past this are rejected by the provider's llama.cpp instead
+    Raises:
+        HTTPException: If the body is not enclosed in braces
+    """
+    stripped = body.strip()
+    if not stripped.startswith(b"{") or not stripped.endswith(b"}"):
+        raise invalid_json_body()
+
+def invalid_json_body() -> HTTPException:
+    """Build the 400 error for a body that is not a JSON object"""
+    return HTTPException(
+        status_code=400,
+        detail={
+            "error": {
+                "message": "Request body must be a JSON object",
+                "type": "invalid_request_error",
+                "param": None,
+                "code": "invalid_json"
+            }
+        }
+    )
+
+def traffic_class_for(user_id: int, route: str, requested: str = None) -> str:
+    """
+    Pick a request's traffic class, see traffic.resolve_class
+    Raises:
+        HTTPException: If the X-Traffic-Class header names an unknown class
+    """
+    try:
+        return resolve_class(user_id, route, requested)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=400,
+            detail={
+                "error": {
+                    "message": str(e),
+                    "type": "invalid_request_error",
+                    "param": TRAFFIC_CLASS_HEADER,
+                    "code": "invalid_traffic_class"
+                }
+            }
+        )
+
+def split_for(request_body: dict, split: str = None):
+    """
+    Split a chat request if the requester asked for it with X-Split and its text is long enough
+    Returns:
+        SplitRequest: The pieces, None to run the request as one task
+    Raises:
+        HTTPException: If the X-Split header is malformed
+    """
+    try:
+        piece_chars = parse_split(split)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=400,
+            detail={
+                "error": {
+                    "message": str(e),
+                    "type": "invalid_request_error",
+                    "param": SPLIT_HEADER,
+                    "code": "invalid_split"
+                }
+            }
+        )
+    if piece_chars is None:
+        return None
+    pieces = SplitRequest(request_body, piece_chars)
+    return pieces if len(pieces) > 1 else None
+
+def task_response(task: Task):
+    """Build the fetch_task response for a task"""
+    if RAW_PASSTHROUGH:
+        return Response(content=task.to_json_bytes(), media_type="application/json")
+    return task.to_dict()
+
+def create_task(request: bytes, request_body: dict, user_id: int, deadline: float = None,
+                traffic_class: str = None) -> Task:
+    """
+    Build a task from a chat request body
+    Args:
+        request: Raw request body, used instead of request_body in passthrough mode
+        request_body: Parsed request body, None in passthrough mode to read the
+            scheduler fields from the raw bytes without parsing them
+    Raises:
+        HTTPException: If a raw body is malformed
+    """
+    task_id = str(uuid.uuid4())
+    if request_body is None:
+        try:
+            max_tokens = json_int_value(request, "max_tokens")
+            prefix_key = raw_prefix_fingerprint(request)
+            prompt_tokens, generation_tokens = estimate_raw_tokens(request)
+        except ValueError:
+            raise invalid_json_body()
+    else:
+        max_tokens = request_body.get("max_tokens")
+        prefix_key = prefix_fingerprint(request_body)
+        prompt_tokens, generation_tokens = estimate_tokens(request_body)
+    if RAW_PASSTHROUGH:
+        # Keep only the raw bytes, a parsed body is dropped after extracting scheduler fields
+        return Task(request_body=None, request_bytes=request, requester_id=user_id, task_id=task_id,
+                    max_tokens=max_tokens, deadline=deadline, prefix_key=prefix_key,
+                    prompt_tokens=prompt_tokens, generation_tokens=generation_tokens, traffic_class=traffic_class)
+    return Task(request_body=request_body, requester_id=user_id, task_id=task_id,
+                max_tokens=max_tokens, deadline=deadline, prefix_key=prefix_key,
+                prompt_tokens=prompt_tokens, generation_tokens=generation_tokens, traffic_class=traffic_class)
+
+async def forward_to_peer(app: FastAPI, task: Task, priority: int, path: str, requeue_until: float):
+    """
+    Send an unclaimed task to a peer gateway if one has spare capacity
+    Args:
+        requeue_until: Time the requester stops waiting for a claim, a failed task is only queued again before it
+    Returns:
+        The peer's response body, None if the task was not forwarded or the peer failed
+    """
+    peer = app.state.peers.pick()
+    # remove_task fails if a provider, possibly in another worker, took the task meanwhile
+    if peer is None or not app.state.task_queue.remove_task(task.task_id):
+        return None
+
+    task.trace_event("forwarded", peer=peer.url)
+    body = task.request_bytes if task.request_bytes is not None else json_dumps(task.request_body)
+    try:
+        result = await app.state.peers.forward(peer, path, body)
+    except PeerError:
+        _FORWARD_FAILED.inc()
+        task.trace_event("forward_failed", peer=peer.url)
+        # A slow peer can use up the requester's window, the task would then be queued for nobody
+        if time.time() < requeue_until:
+            app.state.task_queue.put(task, priority + REQUEUE_PRIORITY_BOOST)
+        return None
+    _FORWARD_COMPLETED.inc()
+    app.state.pending_results.pop(task.task_id, None)
+    return result
+
+async def wait_for_result(app: FastAPI, task: Task, result_future: asyncio.Future, priority: int,
+                          timeout: float = None, max_tries: int = 2, forward_path: str = None):
+    """
+    Wait for a task's result, re-queueing it with REQUEUE_PRIORITY_BOOST once its claim has been silent for timeout
+    Chat tasks (no deadline) get one timeout to be claimed and one more after the re-queue,
+    tasks with a deadline keep waiting and re-queueing until the deadline or max_tries
+    Args:
+        timeout: Seconds to wait for a claim, by default the claim timeout of the task's traffic class
+        forward_path: Chat route to call on a peer gateway if the task is still unclaimed
+            after PEER_FORWARD_AFTER seconds, None to never forward
+    Returns:
+        The submitted result
+    Raises:
+        asyncio.TimeoutError: If no result arrived in time
+    """
+    if timeout is None:
+        timeout = claim_timeout(task.traffic_class)
+
+    def window() -> float:
+        if task.deadline is None:
+            return timeout
+        # Check on the claim after timeout even when the deadline is further away
+        return max(0, min(timeout, task.deadline - time.time()))
+
+    first_window = window()
+    if forward_path is not None and app.state.peers is not None:
+        first_deadline = time.time() + first_window
+        forward_at = time.time() + app.state.peers.forward_after
+        while True:
+            try:
+                return await asyncio.wait_for(asyncio.shield(result_future),
+                                              timeout=max(0, min(forward_at, first_deadline) - time.time()))
+            except asyncio.TimeoutError:
+                pass
+            app.state.task_queue.refresh(task)
+            if time.time() >= first_deadline or task.first_provider_id is not None:
+                break
+            result = await forward_to_peer(app, task, priority, forward_path, first_deadline)
+            if result is not None:
+                return result
+            # No peer could take it, try again while the task is still waiting
+            forward_at = time.time() + 1
+        first_window = max(0, first_deadline - time.time())
+
+    # shield() keeps the future alive across timeouts so a late result is not lost
+    try:
+        return await asyncio.wait_for(asyncio.shield(result_future), timeout=first_window)
+    except asyncio.TimeoutError:
+        # Claims may have been made by another worker process
+        app.state.task_queue.refresh(task)
+        if task.first_provider_id is None and task.deadline is None:
+            raise
+
+    while True:
+        if result_future.done():
+            return result_future.result()
+        app.state.task_queue.refresh(task)
+        if task.deadline is not None and time.time() >= task.deadline:
+            raise asyncio.TimeoutError
+
+        # A running hedge copy counts as a fresh claim
+        if task.claimed_at is not None:
+            last_claimed_at = max(task.claimed_at, task.hedge_claimed_at or 0)
+            if time.time() - last_claimed_at > timeout:
+                if task.try_count >= max_tries:
+                    raise asyncio.TimeoutError
+                task.try_count += 1
+                task.trace_event("lease_expired", provider=task.provider_id)
+                task.claimed_at = None
+                # The hedge copy went silent too, let the task be hedged again on its next claim
+                task.hedge_provider_id = None
+                task.hedge_claimed_at = None
+                REQUEUES.inc()
+                # 重新加入队列，并提高优先级
+                app.state.claimed_tasks.pop(task.task_id, None)
+                task.trace_event("requeued", priority=priority + REQUEUE_PRIORITY_BOOST)
+                app.state.task_queue.claim(task)
+                app.state.task_queue.put(task, priority + REQUEUE_PRIORITY_BOOST)
+                if task.deadline is None:
+                    return await asyncio.wait_for(asyncio.shield(result_future), timeout=timeout)
+
+        await asyncio.sleep(1)
+
+def finish_trace(app: FastAPI, task: Task, outcome: str) -> None:
+    """Move a task's trace into the ring buffer, loading events recorded by other workers first"""
+    if task.trace is not None:
+        app.state.task_queue.refresh(task)
+        app.state.tracer.finish(task, outcome)
+
+def reported_tokens(task: Task, result) -> tuple:
+    """Get (prompt, generation) tokens from a completion's usage field, falling back to the task's estimates"""
+    if isinstance(result, dict) and isinstance(result.get("usage"), dict):
+        usage = result["usage"]
+        return usage.get("prompt_tokens") or 0, usage.get("completion_tokens") or 0
+    if isinstance(result, bytes):
+        # Raw results are searched instead of parsed, the usage counts are the only integers under these keys
+        prompt_tokens = json_int_value(result, "prompt_tokens")
+        generation_tokens = json_int_value(result, "completion_tokens")
+        if prompt_tokens is not None or generation_tokens is not None:
+            return prompt_tokens or 0, generation_tokens or 0
+    return task.prompt_tokens, task.generation_tokens
+
+def is_error_result(result) -> bool:
+    """Check if a submitted result is an error response, raw results included"""
+    if isinstance(result, bytes):
+        return json_has_key(result, "error")
+    return isinstance(result, dict) and "error" in result
+
+def record_usage(app: FastAPI, task: Task, outcome: str, result=None) -> None:
+    """Add a requester usage event for a finished task, and its latency to its traffic class"""
+    prompt_tokens, generation_tokens = reported_tokens(task, result)
+    failed = outcome != "completed" or is_error_result(result)
+    record_request(task, failed)
+    app.state.usage.record("requester", task.requester_id, failed, prompt_tokens, generation_tokens,
+                           time.time() - task.created_at)
+
+def result_response(result):
+    """Build the chat completion response, raw results are sent as-is"""
+    if isinstance(result, bytes):
+        return Response(content=result, media_type="application/json")
+    return result
+
+async def chat_completions_handler(user_token: str, model_name: str, request: bytes, app: FastAPI,
+                                   forwarded: bool = False, traffic_class: str = None, split: str = None):
+    user_id = authenticate_user(user_token)
+
     # Validate model name
     if not is_valid_model(model_name):
         raise HTTPException(
@@ -53,43 +395,52 @@ async def chat_completions_handler(user_token: str, model_name: str, request: di
             }
         )
 
+    if RAW_PASSTHROUGH and split is None:
+        # Passthrough mode never parses the body, unless it is to be split
+        request_body = None
+        check_raw_body(request)
+    else:
+        request_body = load_json_body(request)
+    traffic_class = traffic_class_for(user_id, "chat", traffic_class)
+    pieces = split_for(request_body, split)
+
     # Get user priority
     user_priority = get_user_credit(user_id)
+
+    # Initial timeout of the class's claim_timeout, tasks from a peer are not forwarded again
+    forward_path = None if forwarded else f"/{model_name}/v1/chat/completions"
+    if pieces is not None:
+        return await split_chat_completion(app, user_id, pieces, user_priority, traffic_class, forward_path)
     
     #Construct task
-    task_id = str(uuid.uuid4())
+    task = create_task(request, request_body, user_id, traffic_class=traffic_class)
+    task_id = task.task_id
     result_future = asyncio.Future()
     app.state.pending_results[task_id] = result_future
-    task = Task(request_body=request, requester_id=user_id, task_id=task_id)
     
     #Add task to queue
+    app.state.tracer.start(task)
+    task.trace_event("enqueued", priority=user_priority, traffic_class=traffic_class)
     app.state.task_queue.put(task, user_priority)
     
     try:
-        # Initial timeout of 60 seconds
-        result = await asyncio.wait_for(result_future, timeout=60)
-        return result
+        result = await wait_for_result(app, task, result_future, user_priority, forward_path=forward_path)
+        _CHAT_COMPLETED.inc()
+        CHAT_SECONDS.observe(time.time() - task.created_at)
+        finish_trace(app, task, "completed")
+        record_usage(app, task, "completed", result)
+        return result_response(result)
     except asyncio.TimeoutError:
-        if task.first_provider_id is not None:
-            while True:
-                if time.time() - task.claimed_at > 60 and task.try_count < 2:
-                    task.try_count += 1
-                    # 重新加入队列，使用+1的优先级
-                    app.state.task_queue.put(task, user_priority+1)
-                    try:
-                        result = await asyncio.wait_for(result_future, timeout=60)
-                        return result
-                    except asyncio.TimeoutError:
-                        break
-                
-                await asyncio.sleep(1)
-        
+        _CHAT_TIMEOUT.inc()
+        finish_trace(app, task, "timeout")
+        record_usage(app, task, "timeout")
         if task.try_count > 1:
             # Set temporary ban for 3 minutes (180 seconds)
             set_temp_ban(user_id, int(time.time()) + 180)
         
-        # Remove from pending_results
+        # Remove from pending_results and claimed_tasks
         app.state.pending_results.pop(task_id, None)
+        app.state.claimed_tasks.pop(task_id, None)
         
         #Task removed by fetch_task_handler
         
@@ -104,37 +455,410 @@ async def chat_completions_handler(user_token: str, model_name: str, request: di
             }
         )
     
-async def fetch_task_handler(user_token: str, submit: dict, app: FastAPI):
-    # Parse user token into user_id and token
+async def run_piece(app: FastAPI, request_body: dict, user_id: int, priority: int, traffic_class: str,
+                    forward_path: str, tasks: list):
+    """
+    Run one piece of a split chat request as a chat task of its own
+    A piece answered with an error is queued again by itself, up to SPLIT_PIECE_TRIES times,
+    silent claims are re-queued by wait_for_result as for any chat task
+    Args:
+        tasks: Every task created is appended here, for the caller's usage and ban checks
+    Returns:
+        The piece's completion
+    Raises:
+        asyncio.TimeoutError: If the piece got no result in time
+        SplitPieceError: If every try was answered with an error
+    """
+    request = json_dumps(request_body) if RAW_PASSTHROUGH else None
+    for attempt in range(SPLIT_PIECE_TRIES):
+        task = create_task(request, request_body, user_id, traffic_class=traffic_class)
+        tasks.append(task)
+        result_future = asyncio.Future()
+        app.state.pending_results[task.task_id] = result_future
+        app.state.tracer.start(task)
+        # Retries jump ahead like re-queued tasks, the other pieces are likely done already
+        piece_priority = priority + REQUEUE_PRIORITY_BOOST if attempt else priority
+        task.trace_event("enqueued", priority=piece_priority, traffic_class=traffic_class)
+        app.state.task_queue.put(task, piece_priority)
+
+        outcome = "cancelled"
+        try:
+            result = await wait_for_result(app, task, result_future, piece_priority, forward_path=forward_path)
+            outcome = "completed"
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+            _PIECE_FAILED.inc()
+            raise
+        finally:
+            app.state.pending_results.pop(task.task_id, None)
+            app.state.claimed_tasks.pop(task.task_id, None)
+            if outcome == "cancelled":
+                # Another piece failed, don't leave this one for a provider
+                app.state.task_queue.remove_task(task.task_id)
+            finish_trace(app, task, outcome)
+
+        if piece_completion(result) is not None:
+            _PIECE_COMPLETED.inc()
+            return result
+        if attempt + 1 < SPLIT_PIECE_TRIES:
+            _PIECE_RETRIED.inc()
+    _PIECE_FAILED.inc()
+    raise SplitPieceError(result)
+
+async def split_chat_completion(app: FastAPI, user_id: int, pieces: SplitRequest, priority: int,
+                                traffic_class: str, forward_path: str):
+    """Queue the pieces of a split chat request at once and answer with their joined completion"""
+    SPLIT_REQUESTS.inc()
+    start = time.time()
+    tasks = []
+    runners = [asyncio.ensure_future(run_piece(app, body, user_id, priority, traffic_class, forward_path, tasks))
+               for body in pieces.bodies]
     try:
-        user_id, token = parse_user_token(user_token)
-    except ValueError:
+        done, _ = await asyncio.wait(runners, return_when=asyncio.FIRST_EXCEPTION)
+        for runner in done:
+            if runner.exception() is not None:
+                raise runner.exception()
+        result = pieces.merge([runner.result() for runner in runners])
+    except SplitPieceError as e:
+        # Answer with the provider's error, as an unsplit request would
+        _CHAT_COMPLETED.inc()
+        CHAT_SECONDS.observe(time.time() - start)
+        record_usage(app, tasks[0], "completed", e.result)
+        return result_response(e.result)
+    except asyncio.TimeoutError:
+        _CHAT_TIMEOUT.inc()
+        record_usage(app, tasks[0], "timeout")
+        if any(task.try_count > 1 for task in tasks):
+            # Set temporary ban for 3 minutes (180 seconds)
+            set_temp_ban(user_id, int(time.time()) + 180)
         raise HTTPException(
-            status_code=401,
+            status_code=408,
             detail={
                 "error": {
-                    "message": "Invalid user token format", 
+                    "message": "Request timeout",
+                    "type": "timeout_error",
+                    "code": "timeout"
+                }
+            }
+        )
+    finally:
+        for runner in runners:
+            runner.cancel()
+
+    _CHAT_COMPLETED.inc()
+    CHAT_SECONDS.observe(time.time() - start)
+    # One usage event for the whole request, with the pieces' usage summed
+    record_usage(app, tasks[0], "completed", result)
+    return result
+
+async def run_job(app: FastAPI, job: Job, result_future: asyncio.Future, priority: int):
+    """Wait for a job's task in the background and store the outcome"""
+    task = job.task
+    try:
+        result = await wait_for_result(app, task, result_future, priority, max_tries=JOB_MAX_TRIES)
+        app.state.job_store.finish(job, "completed", result)
+    except asyncio.TimeoutError:
+        app.state.job_store.finish(job, "failed", error="timeout")
+    except asyncio.CancelledError:
+        app.state.job_store.finish(job, "cancelled", error="cancelled")
+    finally:
+        app.state.pending_results.pop(task.task_id, None)
+        app.state.claimed_tasks.pop(task.task_id, None)
+        app.state.task_queue.remove_task(task.task_id)
+    finish_trace(app, task, job.status)
+    record_usage(app, task, job.status, job.result)
+
+    if job.callback_url:
+        await send_callback(job)
+
+def job_response(job: Job, status_code: int = 200) -> Response:
+    return Response(content=job.to_json_bytes(), media_type="application/json", status_code=status_code)
+
+async def submit_job_handler(user_token: str, model_name: str, request: bytes, app: FastAPI,
+                             callback_url: str = None, timeout: float = None, traffic_class: str = None):
+    user_id = authenticate_user(user_token)
+
+    # Validate model name
+    if not is_valid_model(model_name):
+        raise HTTPException(
+            status_code=400,
+            detail={
+                "error": {
+                    "message": "Invalid model name",
                     "type": "invalid_request_error",
-                    "param": "user_token",
-                    "code": "invalid_token"
+                    "param": "model_name",
+                    "code": "invalid_model",
+                    "model_name": model_name
                 }
             }
         )
-    
-    # Validate user token
-    if not is_token_valid(user_id, token):
+
+    # NaN fails this check too
+    if timeout is not None and not timeout > 0:
         raise HTTPException(
-            status_code=401,
+            status_code=400,
             detail={
                 "error": {
-                    "message": "Invalid token or banned",
-                    "type": "authentication_error",
-                    "param": "user_token",
-                    "code": "invalid_token"
+                    "message": "timeout must be a positive number of seconds",
+                    "type": "invalid_request_error",
+                    "param": "timeout",
+                    "code": "invalid_timeout"
                 }
             }
         )
-        
+
+    # Validate callback URL, it must not point into the gateway's own network
+    if callback_url is not None and not await is_allowed_callback_url(callback_url):
+        raise HTTPException(
+            status_code=400,
+            detail={
+                "error": {
+                    "message": "Invalid callback URL, it must be an http(s) URL of a public host",
+                    "type": "invalid_request_error",
+                    "param": "callback_url",
+                    "code": "invalid_callback_url"
+                }
+            }
+        )
+
+    if RAW_PASSTHROUGH:
+        # Passthrough mode never parses the body
+        request_body = None
+        check_raw_body(request)
+    else:
+        request_body = load_json_body(request)
+    traffic_class = traffic_class_for(user_id, "job", traffic_class)
+
+    # Jobs are not bound to an HTTP timeout, so they may wait longer than chat requests
+    timeout = min(timeout if timeout is not None else JOB_DEFAULT_TIMEOUT, JOB_MAX_TIMEOUT)
+    user_priority = get_user_credit(user_id)
+    task = create_task(request, request_body, user_id, deadline=time.time() + timeout, traffic_class=traffic_class)
+    task.is_job = True
+    task.callback_url = callback_url
+    job = Job(task.task_id, user_id, task, callback_url)
+    if not app.state.job_store.add(job):
+        raise HTTPException(
+            status_code=429,
+            detail={
+                "error": {
+                    "message": "Too many pending jobs",
+                    "type": "rate_limit_error",
+                    "code": "job_store_full"
+                }
+            }
+        )
+
+    result_future = asyncio.Future()
+    app.state.pending_results[task.task_id] = result_future
+    app.state.tracer.start(task)
+    task.trace_event("enqueued", priority=user_priority, traffic_class=traffic_class)
+    app.state.task_queue.put(task, user_priority)
+    job.runner = asyncio.create_task(run_job(app, job, result_future, user_priority))
+
+    return job_response(job, status_code=202)
+
+def get_owned_job(user_id: int, job_id: str, app: FastAPI) -> Job:
+    """Get a job belonging to user_id, raising 404 otherwise"""
+    job = app.state.job_store.get(job_id)
+    if job is None or job.owner_id != user_id:
+        raise HTTPException(
+            status_code=404,
+            detail={
+                "error": {
+                    "message": "Job not found or expired",
+                    "type": "invalid_request_error",
+                    "param": "job_id",
+                    "code": "not_found"
+                }
+            }
+        )
+    return job
+
+async def get_job_handler(user_token: str, job_id: str, app: FastAPI, wait: float = 0):
+    user_id = authenticate_user(user_token)
+    job = get_owned_job(user_id, job_id, app)
+
+    # Long-poll until the job finishes or wait runs out
+    if wait and not job.done.is_set():
+        try:
+            await asyncio.wait_for(job.done.wait(), timeout=min(wait, JOB_MAX_WAIT))
+        except asyncio.TimeoutError:
+            pass
+
+    return job_response(job)
+
+async def cancel_job_handler(user_token: str, job_id: str, app: FastAPI):
+    user_id = authenticate_user(user_token)
+    job = get_owned_job(user_id, job_id, app)
+
+    if job.runner is not None and not job.done.is_set():
+        job.runner.cancel()
+        await job.done.wait()
+
+    return job_response(job)
+
+async def run_batch_item(app: FastAPI, task: Task, result_future: asyncio.Future, priority: int):
+    """Wait for one request of a batch, returning (status, result)"""
+    status = "cancelled"
+    result = None
+    try:
+        result = await wait_for_result(app, task, result_future, priority, max_tries=JOB_MAX_TRIES)
+        status = "completed"
+        return status, result
+    except asyncio.TimeoutError:
+        status = "failed"
+        return status, None
+    finally:
+        app.state.pending_results.pop(task.task_id, None)
+        app.state.claimed_tasks.pop(task.task_id, None)
+        app.state.task_queue.remove_task(task.task_id)
+        finish_trace(app, task, status)
+        # The provider's reported usage, estimates only if there is no result
+        record_usage(app, task, status, result)
+
+def batch_line(index: int, status: str, result=None) -> bytes:
+    """Encode one NDJSON result line, raw results are spliced in as-is"""
+    if isinstance(result, bytes):
+        return b'{"response":' + result + b',' + json_dumps({"index": index, "status": status})[1:] + b'\n'
+    return json_dumps({"index": index, "status": status, "response": result}) + b'\n'
+
+async def stream_batch(app: FastAPI, batch: Batch, items: list, priority: int, traffic_class: str = None):
+    """
+    Feed a batch through the queue and yield NDJSON lines as requests finish
+    At most BATCH_MAX_IN_FLIGHT requests of a batch are queued or running at once,
+    so one book cannot flood the queue ahead of everyone else
+    """
+    running = {}
+    next_index = 0
+
+    def start(count: int):
+        nonlocal next_index
+        tasks = []
+        for index in range(next_index, min(next_index + count, len(items))):
+            request_body = items[index]
+            request = json_dumps(request_body) if RAW_PASSTHROUGH else None
+            task = create_task(request, request_body, batch.owner_id, deadline=time.time() + BATCH_ITEM_TIMEOUT,
+                               traffic_class=traffic_class)
+            result_future = asyncio.Future()
+            app.state.pending_results[task.task_id] = result_future
+            app.state.tracer.start(task)
+            task.trace_event("enqueued", priority=priority, traffic_class=traffic_class)
+            runner = asyncio.ensure_future(run_batch_item(app, task, result_future, priority))
+            running[runner] = index
+            tasks.append(task)
+            next_index = index + 1
+        app.state.task_queue.put_many(tasks, priority)
+
+    cancel_waiter = asyncio.ensure_future(batch.cancel_event.wait())
+    try:
+        start(BATCH_MAX_IN_FLIGHT)
+        while running:
+            done, _ = await asyncio.wait(list(running) + [cancel_waiter], return_when=asyncio.FIRST_COMPLETED)
+            if cancel_waiter in done:
+                break
+            for runner in done:
+                index = running.pop(runner)
+                status, result = runner.result()
+                if status == "completed":
+                    batch.completed += 1
+                else:
+                    batch.failed += 1
+                yield batch_line(index, status, result)
+            start(BATCH_MAX_IN_FLIGHT - len(running))
+
+        # Cancelled, report everything that did not finish
+        for runner, index in running.items():
+            runner.cancel()
+            batch.cancelled += 1
+            yield batch_line(index, "cancelled")
+        for index in range(next_index, len(items)):
+            batch.cancelled += 1
+            yield batch_line(index, "cancelled")
+
+        yield json_dumps(batch.to_dict()) + b'\n'
+    finally:
+        # Also reached when the client disconnects mid-stream
+        cancel_waiter.cancel()
+        for runner in running:
+            runner.cancel()
+        app.state.batches.pop(batch.batch_id, None)
+
+async def submit_batch_handler(user_token: str, model_name: str, request: bytes, app: FastAPI,
+                               traffic_class: str = None):
+    # Auth and priority are looked up once for the whole batch
+    user_id = authenticate_user(user_token)
+
+    # Validate model name
+    if not is_valid_model(model_name):
+        raise HTTPException(
+            status_code=400,
+            detail={
+                "error": {
+                    "message": "Invalid model name",
+                    "type": "invalid_request_error",
+                    "param": "model_name",
+                    "code": "invalid_model",
+                    "model_name": model_name
+                }
+            }
+        )
+
+    items = load_json_body(request).get("requests")
+    if not isinstance(items, list) or not items or len(items) > BATCH_MAX_REQUESTS \
+            or not all(isinstance(item, dict) for item in items):
+        raise HTTPException(
+            status_code=400,
+            detail={
+                "error": {
+                    "message": f"'requests' must be a list of 1 to {BATCH_MAX_REQUESTS} chat request objects",
+                    "type": "invalid_request_error",
+                    "param": "requests",
+                    "code": "invalid_batch"
+                }
+            }
+        )
+
+    traffic_class = traffic_class_for(user_id, "batch", traffic_class)
+    user_priority = get_user_credit(user_id)
+    batch = Batch(str(uuid.uuid4()), user_id, len(items))
+    app.state.batches[batch.batch_id] = batch
+
+    return StreamingResponse(
+        stream_batch(app, batch, items, user_priority, traffic_class),
+        media_type="application/x-ndjson",
+        headers={"X-Batch-Id": batch.batch_id}
+    )
+
+def get_owned_batch(user_id: int, batch_id: str, app: FastAPI) -> Batch:
+    """Get a running batch belonging to user_id, raising 404 otherwise"""
+    batch = app.state.batches.get(batch_id)
+    if batch is None or batch.owner_id != user_id:
+        raise HTTPException(
+            status_code=404,
+            detail={
+                "error": {
+                    "message": "Batch not found or already finished",
+                    "type": "invalid_request_error",
+                    "param": "batch_id",
+                    "code": "not_found"
+                }
+            }
+        )
+    return batch
+
+async def get_batch_handler(user_token: str, batch_id: str, app: FastAPI):
+    user_id = authenticate_user(user_token)
+    return get_owned_batch(user_id, batch_id, app).to_dict()
+
+async def cancel_batch_handler(user_token: str, batch_id: str, app: FastAPI):
+    user_id = authenticate_user(user_token)
+    batch = get_owned_batch(user_id, batch_id, app)
+    batch.cancel_event.set()
+    return batch.to_dict()
+
+async def fetch_task_handler(user_token: str, submit: dict, app: FastAPI):
+    user_id = authenticate_user(user_token)
+
     # Verify model meta
     if not verify_model_meta(submit):
         raise HTTPException(
@@ -149,33 +873,46 @@ async def fetch_task_handler(user_token: str, submit: dict, app: FastAPI):
             }
         )
     
-    # Check if last fetch time is within 10 seconds
-    if time.time() - app.state.last_fetch_time < 1:
-        queue_mode=QueueMode.PURE_FIFO
-    elif time.time() - app.state.last_fetch_time < 5:
-        queue_mode=QueueMode.TWO_LEVEL
-    else:
-        queue_mode=QueueMode.STRICT_PRIORITY
+    # Pick queue mode from the time since the last fetch, and update last fetch time
+    now = time.time()
+    queue_mode = queue_mode_for(now - app.state.task_queue.touch_last_fetch(now))
     
-    # Update last fetch time
-    app.state.last_fetch_time = time.time()
-    
-    # Get task from queue with time check
+    # Match task size to the provider's advertised capacity, prefer tasks whose prefix it has cached
+    capacity = parse_capacity(submit.get("capacity"))
+    app.state.fleet.record(user_id, capacity, now)
+    affinity = app.state.affinity if AFFINITY_ENABLED else None
+    select = lambda tasks: select_task(tasks, user_id, capacity, time.time(), affinity, app.state.fleet)
+
+    # Get task from queue with time check, traffic classes are offered in the order of their shares
     while True:
-        task = app.state.task_queue.get(queue_mode)
+        task = app.state.task_queue.get(queue_mode, select, app.state.traffic.order())
         
         if task is None:
+            # Queue is empty, so this provider is idle capacity for a hedge copy
+            if HEDGE_ENABLED:
+                hedge_task = app.state.hedger.pick(app.state.claimed_tasks, user_id, time.time())
+                if hedge_task is not None:
+                    hedge_task.hedge_provider_id = user_id
+                    hedge_task.hedge_claimed_at = time.time()
+                    hedge_task.trace_event("hedged", provider=user_id)
+                    app.state.task_queue.claim(hedge_task)
+                    app.state.affinity.record(user_id, hedge_task.prefix_key)
+                    _FETCH_HEDGED.inc()
+                    return task_response(hedge_task)
+            _FETCH_EMPTY.inc()
+            app.state.last_empty_fetch = time.time()
             return {
                 "status": "empty",
                 "message": "No tasks available in queue"
             }
             
         current_time = time.time()
-        time_elapsed = current_time - task.created_at
         
         # Skip tasks that are likely to timeout soon
-        if (task.try_count == 0 and time_elapsed > 58) or \
-           (task.try_count == 1 and time_elapsed > 118):
+        expires_at = task.expires_at()
+        if expires_at is not None and current_time > expires_at:
+            EXPIRED_SKIPS.inc()
+            task.trace_event("skipped_expired")
             continue
             
         # Found a valid task
@@ -183,43 +920,29 @@ async def fetch_task_handler(user_token: str, submit: dict, app: FastAPI):
     
     # Set task attributes
     task.is_urgent = queue_mode != QueueMode.PURE_FIFO
+    task.claimed_at = time.time()
     if task.try_count == 0:
         task.first_provider_id = user_id
+        TASK_WAIT_SECONDS.observe(task.claimed_at - task.created_at)
     task.try_count += 1
-    task.claimed_at = time.time()
+    task.provider_id = user_id
+    task.trace_event("claimed", provider=user_id, mode=queue_mode.name.lower(), try_count=task.try_count)
+    app.state.traffic.record_claim(task, task.claimed_at)
+    app.state.task_queue.claim(task)
+    app.state.claimed_tasks[task.task_id] = task
+    app.state.hedger.record_dispatch()
+    if affinity is not None:
+        affinity.count_lookup(user_id, task.prefix_key)
+    app.state.affinity.record(user_id, task.prefix_key)
+    _DISPATCHES[queue_mode].inc()
+    _FETCH_DISPATCHED.inc()
     
-    return task
+    return task_response(task)
 
-async def submit_result_handler(user_token: str, submit: dict, app: FastAPI):
-    # Parse user token into user_id and token
-    try:
-        user_id, token = parse_user_token(user_token)
-    except ValueError:
-        raise HTTPException(
-            status_code=401,
-            detail={
-                "error": {
-                    "message": "Invalid user token format", 
-                    "type": "invalid_request_error",
-                    "param": "user_token",
-                    "code": "invalid_token"
-                }
-            }
-        )
-    
-    # Validate user token
-    if not is_token_valid(user_id, token):
-        raise HTTPException(
-            status_code=401,
-            detail={
-                "error": {
-                    "message": "Invalid token or banned",
-                    "type": "authentication_error",
-                    "param": "user_token",
-                    "code": "invalid_token"
-                }
-            }
-        )
+async def submit_result_handler(user_token: str, submit: bytes, app: FastAPI):
+    user_id = authenticate_user(user_token)
+
+    submit = load_json_body(submit)
 
     # Get task_id from submit
     task_id = submit.get("task_id")
@@ -236,9 +959,45 @@ async def submit_result_handler(user_token: str, submit: dict, app: FastAPI):
             }
         )
 
+    # Only /submit_result/{task_id} is zero-copy, this route has to parse the wrapper to find task_id
+    response = submit.get("response")
+    if RAW_PASSTHROUGH:
+        response = json_dumps(response)
+
+    return complete_task(user_id, task_id, response, app)
+
+async def submit_raw_result_handler(user_token: str, task_id: str, response: bytes, app: FastAPI):
+    user_id = authenticate_user(user_token)
+
+    # The body is the completion itself, passed through as bytes without being parsed
+    if RAW_PASSTHROUGH:
+        check_raw_body(response)
+    else:
+        response = load_json_body(response)
+
+    return complete_task(user_id, task_id, response, app)
+
+def complete_task(user_id: int, task_id: str, response, app: FastAPI) -> dict:
+    """
+    Hand a provider's result to the waiting requester
+    Args:
+        user_id: ID of the submitting provider
+        task_id: ID of the completed task
+        response: Completion as a dict, or as JSON bytes in passthrough mode
+    Returns:
+        dict: Submit status
+    """
     # Get result_future from pending_results
     result_future = app.state.pending_results.get(task_id)
     if not result_future:
+        # Losing copy of a hedged task, accept it without effect
+        if task_id in app.state.completed_tasks:
+            _SUBMIT_DUPLICATE.inc()
+            return {
+                "status": "duplicate",
+                "message": "Task already completed by another provider"
+            }
+        _SUBMIT_NOT_FOUND.inc()
         raise HTTPException(
             status_code=404,
             detail={
@@ -253,45 +1012,194 @@ async def submit_result_handler(user_token: str, submit: dict, app: FastAPI):
 
     # Set result to future
     if not result_future.done():
-        result_future.set_result(submit.get("response"))
+        claimed_task = app.state.claimed_tasks.get(task_id)
+        if claimed_task is not None:
+            claimed_task.trace_event("submitted", provider=user_id)
+        result_future.set_result(response)
         
     # Remove task from queue and pending_results
     app.state.task_queue.remove_task(task_id)
     app.state.pending_results.pop(task_id, None)
 
+    # Record completion time of the winning claim
+    task = app.state.claimed_tasks.pop(task_id, None)
+    if task is not None:
+        hedge_won = task.hedge_provider_id == user_id
+        claimed_at = task.hedge_claimed_at if hedge_won else task.claimed_at
+        app.state.hedger.record_completion(time.time() - claimed_at, hedge_won)
+        CLAIM_TO_SUBMIT_SECONDS.observe(time.time() - claimed_at)
+        prompt_tokens, generation_tokens = reported_tokens(task, response)
+        app.state.usage.record("provider", user_id, is_error_result(response),
+                               prompt_tokens, generation_tokens, time.time() - claimed_at)
+    else:
+        app.state.usage.record("provider", user_id, is_error_result(response))
+
+    # Remember the winner so the other copy can be told to cancel
+    completed_tasks = app.state.completed_tasks
+    completed_tasks[task_id] = user_id
+    if len(completed_tasks) > COMPLETED_TASKS_MAX:
+        completed_tasks.popitem(last=False)
+
+    _SUBMIT_SUCCESS.inc()
     return {"status": "success"}
 
-async def list_models_handler(user_token: str, model_name: str):
-    # Parse user token into user_id and token
+async def task_status_handler(user_token: str, task_id: str, app: FastAPI):
+    user_id = authenticate_user(user_token)
+
+    # Still waiting for a result
+    if task_id in app.state.pending_results:
+        return {"status": "pending"}
+
+    # Completed, providers still running a copy should cancel it
+    winner_id = app.state.completed_tasks.get(task_id)
+    if winner_id is None:
+        return {"status": "not_found"}
+    if winner_id == user_id:
+        return {"status": "completed"}
+    return {"status": "cancelled"}
+
+async def scheduler_stats_handler(user_token: str, app: FastAPI):
+    authenticate_admin(user_token)
+
+    hedging = app.state.hedger.stats()
+    hedging["enabled"] = HEDGE_ENABLED
+    affinity = app.state.affinity.stats()
+    affinity["enabled"] = AFFINITY_ENABLED
+    return {
+        "hedging": hedging,
+        "affinity": affinity,
+        "tracing": app.state.tracer.stats(),
+        "traffic": app.state.traffic.stats(app.state.task_queue.class_sizes()),
+        "peering": app.state.peers.stats() if app.state.peers is not None else None
+    }
+
+async def metrics_handler(user_token: str):
+    authenticate_admin(user_token)
+    return Response(content=REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+async def traces_handler(user_token: str, app: FastAPI, task_id: str = None, since: float = 0):
+    authenticate_admin(user_token)
+
+    # A single task's trace, e.g. for a user report
+    if task_id is not None:
+        trace = app.state.tracer.find(task_id)
+        if trace is None:
+            raise HTTPException(
+                status_code=404,
+                detail={
+                    "error": {
+                        "message": "Trace not found, the task was not sampled or its trace was dropped",
+                        "type": "invalid_request_error",
+                        "param": "task_id",
+                        "code": "not_found"
+                    }
+                }
+            )
+        return Response(content=json_dumps(trace), media_type="application/json")
+
+    return Response(content=app.state.tracer.export_jsonl(since), media_type="application/x-ndjson")
+
+async def db_stats_handler(user_token: str):
+    authenticate_admin(user_token)
+    return QUERY_LOG.summary()
+
+async def profile_handler(user_token: str, app: FastAPI, seconds: float = 10, interval: float = 0.005,
+                          output: str = "collapsed"):
+    authenticate_admin(user_token)
+    if seconds <= 0 or interval <= 0 or output not in ("collapsed", "json"):
+        raise HTTPException(
+            status_code=400,
+            detail={
+                "error": {
+                    "message": "seconds and interval must be positive, output must be collapsed or json",
+                    "type": "invalid_request_error",
+                    "code": "invalid_profile"
+                }
+            }
+        )
+
+    profiler = app.state.profiler
+    # Handlers run on the event loop thread, which is the one to sample
+    loop_thread_id = threading.get_ident()
     try:
-        user_id, token = parse_user_token(user_token)
-    except ValueError:
+        profile = await asyncio.to_thread(profiler.run, loop_thread_id, seconds, interval)
+    except RuntimeError:
         raise HTTPException(
-            status_code=401,
+            status_code=409,
             detail={
                 "error": {
-                    "message": "Invalid user token format", 
+                    "message": "A profile is already running",
                     "type": "invalid_request_error",
-                    "param": "user_token",
-                    "code": "invalid_token"
+                    "code": "profile_running"
                 }
             }
         )
-        
-    # Validate user token
-    if not is_token_valid(user_id, token):
+
+    if output == "json":
+        return Response(content=json_dumps(profile), media_type="application/json")
+    return Response(content=collapsed(profile), media_type="text/plain; charset=utf-8")
+
+async def query_usage(app: FastAPI, role: str, resolution: str, start: float, end: float, user_id: int = None,
+                      by_user: bool = False) -> dict:
+    """Validate usage query parameters and read the rollups, the range defaults to the last 7 days"""
+    if role not in USAGE_ROLES or resolution not in USAGE_RESOLUTIONS:
         raise HTTPException(
-            status_code=401,
+            status_code=400,
             detail={
                 "error": {
-                    "message": "Invalid token or banned",
-                    "type": "authentication_error",
-                    "param": "user_token",
-                    "code": "invalid_token"
+                    "message": f"role must be one of {', '.join(USAGE_ROLES)}, "
+                               f"resolution one of {', '.join(USAGE_RESOLUTIONS)}",
+                    "type": "invalid_request_error",
+                    "code": "invalid_usage_query"
                 }
             }
         )
-        
+    end = time.time() if end is None else end
+    start = end - 7 * 86400 if start is None else start
+    # compact() holds the store's lock in a thread for a while, wait for it off the event loop
+    data = await asyncio.to_thread(app.state.usage.query, role, start, end, resolution, user_id, by_user)
+    return {"role": role, "resolution": resolution, "start": start, "end": end, "data": data}
+
+async def usage_handler(user_token: str, app: FastAPI, role: str = "requester", resolution: str = "hour",
+                        start: float = None, end: float = None):
+    user_id = authenticate_user(user_token)
+    return await query_usage(app, role, resolution, start, end, user_id)
+
+async def usage_summary_handler(user_token: str, app: FastAPI, role: str = "requester", resolution: str = "hour",
+                                start: float = None, end: float = None, by_user: bool = False):
+    authenticate_admin(user_token)
+    return await query_usage(app, role, resolution, start, end, by_user=by_user)
+
+async def compression_dictionary_handler(user_token: str, codecs):
+    authenticate_user(user_token)
+    if codecs.zstd_dict is None:
+        raise HTTPException(
+            status_code=404,
+            detail={
+                "error": {
+                    "message": "No compression dictionary configured",
+                    "type": "invalid_request_error",
+                    "code": "not_found"
+                }
+            }
+        )
+    return Response(content=codecs.dictionary, media_type="application/octet-stream")
+
+async def peer_status_handler(user_token: str, app: FastAPI):
+    authenticate_user(user_token)
+    queue_depth = app.state.task_queue.qsize()
+    # Spare capacity: a provider found the queue empty recently
+    idle = time.time() - app.state.last_empty_fetch < PEER_IDLE_WINDOW
+    return {
+        "queue_depth": queue_depth,
+        "claimed": len(app.state.claimed_tasks),
+        "idle_providers": idle,
+        "accepting": PEER_ACCEPT and idle and queue_depth <= PEER_ACCEPT_MAX_DEPTH
+    }
+
+async def list_models_handler(user_token: str, model_name: str):
+    authenticate_user(user_token)
+
     if not is_valid_model(model_name):
         raise HTTPException(
             status_code=400,
@@ -0,0 +1,104 @@
+from collections import deque
+from typing import Optional
+
+class HedgeController:
+    def __init__(self,
+                 percentile: float = 0.95,
+                 min_samples: int = 50,
+                 window: int = 1000,
+                 budget: float = 0.05):
+        """
+        Decide when a claimed task deserves a second (hedge) copy
+        Args:
+            percentile: Percentile of observed completion time that triggers a hedge
+            min_samples: Number of completion samples required before hedging
+            window: Number of recent completion samples kept
+            budget: Max hedge copies as a fraction of normal dispatches
+        """
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.budget = budget
+        self.samples = deque(maxlen=window)
+        self._threshold = None
+        self._samples_since_update = 0
+
+        # Counters for reporting
+        self.dispatches = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.budget_denied = 0
+
+    def record_dispatch(self) -> None:
+        """Record a normal (non-hedge) dispatch of a task to a provider"""
+        self.dispatches += 1
+
+    def record_completion(self, duration: float, hedge_won: bool = False) -> None:
+        """Record the claim-to-submit duration of the winning result"""
+        self.samples.append(duration)
+        self._samples_since_update += 1
+        if hedge_won:
+            self.hedge_wins += 1
+
+    def threshold(self) -> Optional[float]:
+        """Get the completion time above which a claim may be hedged, None if not enough samples"""
+        if len(self.samples) < self.min_samples:
+            return None
+
+        # Re-sort only every few samples, this is called on every empty fetch
+        if self._threshold is None or self._samples_since_update >= 32:
+            ordered = sorted(self.samples)
+            index = min(len(ordered) - 1, int(len(ordered) * self.percentile))
+            self._threshold = ordered[index]
+            self._samples_since_update = 0
+        return self._threshold
+
+    def budget_available(self) -> bool:
+        """Check if another hedge copy fits inside the extra-compute budget"""
+        return self.hedges < self.budget * self.dispatches
+
+    def pick(self, claimed_tasks: dict, provider_id: int, now: float):
+        """
+        Pick the claimed task most overdue for a hedge copy
+        Args:
+            claimed_tasks: Dict of task_id -> Task currently claimed by a provider
+            provider_id: ID of the idle provider asking for work
+            now: Current timestamp
+        Returns:
+            Task: Task to hedge, or None if nothing qualifies
+        """
+        threshold = self.threshold()
+        if threshold is None:
+            return None
+
+        candidate = None
+        for task in claimed_tasks.values():
+            # Only one hedge per task, never to the provider already running it
+            if task.hedge_provider_id is not None or task.provider_id == provider_id:
+                continue
+            if now - task.claimed_at < threshold:
+                continue
+            if candidate is None or task.claimed_at < candidate.claimed_at:
+                candidate = task
+
+        if candidate is None:
+            return None
+
+        if not self.budget_available():
+            self.budget_denied += 1
+            return None
+
+        self.hedges += 1
+        return candidate
+
+    def stats(self) -> dict:
+        """Get hedging statistics including budget usage"""
+        return {
+            "threshold": self.threshold(),
+            "samples": len(self.samples),
+            "dispatches": self.dispatches,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "budget": self.budget,
+            "budget_used": self.hedges / self.dispatches if self.dispatches else 0.0,
+            "budget_denied": self.budget_denied
+        }
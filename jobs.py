@@ -0,0 +1,178 @@
+from collections import OrderedDict, deque
+from typing import Optional
+from urllib.parse import urlparse
+import urllib.request
+import asyncio
+import ipaddress
+import socket
+import time
+
+from config import JOB_CALLBACK_PRIVATE_HOSTS
+from utils import json_dumps
+
+class Job:
+    __slots__ = (
+        "job_id", "owner_id", "task", "status", "result", "error",
+        "created_at", "finished_at", "callback_url", "done", "runner"
+    )
+
+    def __init__(self, job_id: str, owner_id: int, task, callback_url: str = None):
+        """
+        Args:
+            job_id: Unique identifier for the job, same as its task_id
+            owner_id: ID of the user who submitted the job
+            task: The Task carrying the chat request
+            callback_url: URL to POST the finished job to, if any
+        """
+        self.job_id = job_id
+        self.owner_id = owner_id
+        self.task = task
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.callback_url = callback_url
+        self.done = asyncio.Event()
+        self.runner = None
+
+    def current_status(self) -> str:
+        """Get job status, 'running' once a provider has claimed the task"""
+        if self.status == "queued" and self.task.claimed_at is not None:
+            return "running"
+        return self.status
+
+    def to_json_bytes(self) -> bytes:
+        """Serialize the job for polling and callbacks, raw results are spliced in as-is"""
+        data = {
+            "id": self.job_id,
+            "object": "job",
+            "status": self.current_status(),
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "error": self.error
+        }
+        if isinstance(self.result, bytes):
+            return b'{"result":' + self.result + b',' + json_dumps(data)[1:]
+        data["result"] = self.result
+        return json_dumps(data)
+
+class JobStore:
+    def __init__(self, max_jobs: int = 10000, ttl: float = 3600):
+        """
+        Bounded job store, finished jobs are kept for ttl seconds
+        Args:
+            max_jobs: Maximum number of jobs kept, finished or not
+            ttl: Seconds a finished job's result is kept
+        """
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self.jobs = OrderedDict()
+        # Jobs finish in time order, so expiry times are already sorted
+        self.expiry = deque()
+
+    def purge(self, now: float = None) -> None:
+        """Drop finished jobs whose TTL has passed"""
+        now = now or time.time()
+        while self.expiry and self.expiry[0][0] <= now:
+            _, job_id = self.expiry.popleft()
+            self.jobs.pop(job_id, None)
+
+    def add(self, job: Job) -> bool:
+        """
+        Add a job to the store, evicting the oldest finished job if full
+        Returns:
+            bool: True if added, False if the store is full of unfinished jobs
+        """
+        self.purge()
+        if len(self.jobs) >= self.max_jobs:
+            for job_id, old_job in self.jobs.items():
+                if old_job.finished_at is not None:
+                    del self.jobs[job_id]
+                    break
+            else:
+                return False
+        self.jobs[job.job_id] = job
+        return True
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """Get a job by id, None if unknown or expired"""
+        self.purge()
+        return self.jobs.get(job_id)
+
+    def restore(self, job: Job) -> None:
+        """Put back a job from a snapshot, call in finished_at order so expiry stays sorted"""
+        self.jobs[job.job_id] = job
+        if job.finished_at is not None:
+            self.expiry.append((job.finished_at + self.ttl, job.job_id))
+            job.done.set()
+
+    def finish(self, job: Job, status: str, result=None, error: str = None) -> None:
+        """Mark a job finished and start its TTL"""
+        job.status = status
+        job.result = result
+        job.error = error
+        job.finished_at = time.time()
+        self.expiry.append((job.finished_at + self.ttl, job.job_id))
+        job.done.set()
+
+def is_valid_callback_url(url: str) -> bool:
+    """Check if a callback URL is an absolute http(s) URL"""
+    parsed = urlparse(url)
+    return parsed.scheme in ("http", "https") and bool(parsed.netloc)
+
+def is_public_host(host: str) -> bool:
+    """
+    Check a host only resolves to public addresses, so callbacks can't reach the gateway's own network
+    Hosts in JOB_CALLBACK_PRIVATE_HOSTS are always allowed. Blocks on DNS, run it in a thread
+    """
+    if host in JOB_CALLBACK_PRIVATE_HOSTS:
+        return True
+    try:
+        infos = socket.getaddrinfo(host, None, proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError):
+        return False
+    for info in infos:
+        # Drop the scope of link-local IPv6 addresses, e.g. fe80::1%eth0
+        address = ipaddress.ip_address(info[4][0].split("%")[0])
+        # is_global is False for private, loopback, link-local, reserved and shared addresses
+        if not address.is_global or address.is_multicast:
+            return False
+    return bool(infos)
+
+async def is_allowed_callback_url(url: str) -> bool:
+    """Check if a callback URL is an absolute http(s) URL to a public host"""
+    if not is_valid_callback_url(url):
+        return False
+    host = urlparse(url).hostname
+    return host is not None and await asyncio.to_thread(is_public_host, host)
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    # A redirect could point the callback at a private address
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+_opener = urllib.request.build_opener(_NoRedirect)
+
+def _post_json(url: str, body: bytes, timeout: float) -> None:
+    # Checked again on every attempt, the host may resolve elsewhere by now
+    if not is_public_host(urlparse(url).hostname):
+        raise ValueError(f"Callback host of {url} resolves to a private address")
+    req = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"}, method="POST")
+    with _opener.open(req, timeout=timeout):
+        pass
+
+async def send_callback(job: Job, retries: int = 3, timeout: float = 10) -> bool:
+    """
+    POST a finished job to its callback URL, retrying with backoff
+    Returns:
+        bool: True if the callback was delivered
+    """
+    body = job.to_json_bytes()
+    for attempt in range(retries):
+        try:
+            await asyncio.to_thread(_post_json, job.callback_url, body, timeout)
+            return True
+        except Exception:
+            await asyncio.sleep(2 ** attempt)
+    return False
@@ -1,24 +1,145 @@
 from contextlib import asynccontextmanager
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 
 from database import init_db
-from handlers import list_models_handler, chat_completions_handler, fetch_task_handler, submit_result_handler
+from handlers import list_models_handler, chat_completions_handler, fetch_task_handler, submit_result_handler, submit_raw_result_handler, task_status_handler, scheduler_stats_handler, \
+    submit_job_handler, get_job_handler, cancel_job_handler, submit_batch_handler, get_batch_handler, cancel_batch_handler, \
+    metrics_handler, traces_handler, db_stats_handler, profile_handler, usage_handler, usage_summary_handler, \
+    compression_dictionary_handler, peer_status_handler
 from models import get_default_model
 from custom_queue import CustomQueue  # 导入 CustomQueue 类
+from hedging import HedgeController
+from jobs import JobStore
+from affinity import AffinityTracker
+from dispatch import FleetCapacity
+from config import HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES, HEDGE_SAMPLE_WINDOW, HEDGE_BUDGET, JOB_STORE_MAX, JOB_RESULT_TTL, \
+    AFFINITY_WINDOW, AFFINITY_MIN_TIME_LEFT, AFFINITY_PREFIXES_PER_PROVIDER, SIZE_FLEET_WINDOW, \
+    JOBS_ENABLED, BATCH_ENABLED, QUEUE_BACKEND, SHARED_QUEUE_PATH, SHARED_POLL_INTERVAL, SHARED_SELECT_LIMIT, SHARED_PURGE_AGE, \
+    SNAPSHOT_ENABLED, SNAPSHOT_PATH, SNAPSHOT_INTERVAL, JOURNAL_ENABLED, JOURNAL_PATH, JOURNAL_FSYNC, \
+    TRACE_ENABLED, TRACE_SAMPLE_RATE, TRACE_BUFFER_SIZE, PROFILE_MAX_SECONDS, PROFILE_MIN_INTERVAL, PROFILE_MAX_OVERHEAD, \
+    USAGE_DB_PATH, USAGE_FLUSH_INTERVAL, USAGE_COMPACT_INTERVAL, USAGE_RAW_RETENTION, USAGE_HOURLY_RETENTION, \
+    COMPRESSION_ENABLED, COMPRESSION_MIN_SIZE, COMPRESSION_GZIP_LEVEL, COMPRESSION_ZSTD_LEVEL, COMPRESSION_ZSTD_DICT_PATH, \
+    COMPRESSION_MAX_BODY, TELEGRAM_BOT_TOKEN, TELEGRAM_BOT_LOCK_PATH, \
+    PEERS, PEER_FORWARD_AFTER, PEER_MAX_DEPTH, PEER_MAX_FORWARDS, PEER_POLL_INTERVAL, PEER_REQUEST_TIMEOUT, \
+    TRAFFIC_CLASSES
+from collections import OrderedDict
+from shared_backend import SQLiteTaskQueue, SQLitePendingResults
+from snapshot import JournaledQueue, save_snapshot, load_snapshot, replay_journal, restore_snapshot, snapshot_periodically
+from metrics import QUEUE_DEPTH, CLAIMED_TASKS, PENDING_RESULTS, TRAFFIC_QUEUE_DEPTH
+from tracing import TraceRecorder
+from profiler import SamplingProfiler
+from usage import UsageStore, maintain_usage
+from compression import Codecs, CompressionMiddleware, load_dictionary
+from peering import PeerPool, FORWARDED_HEADER
+from traffic import TrafficScheduler, TRAFFIC_CLASS_HEADER
+from split import SPLIT_HEADER
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+async def purge_shared_backend(app: FastAPI):
+    """Periodically drop rows orphaned by crashed workers"""
+    while True:
+        await asyncio.sleep(60)
+        await asyncio.to_thread(app.state.task_queue.purge, SHARED_PURGE_AGE)
+        await asyncio.to_thread(app.state.pending_results.purge, SHARED_PURGE_AGE)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Handle startup and shutdown events"""
     # Startup
+    if QUEUE_BACKEND == "sqlite" and JOBS_ENABLED:
+        # GET and DELETE of a job must reach the worker that accepted it
+        raise RuntimeError('Jobs are kept per worker process, set JOBS_ENABLED = False to use QUEUE_BACKEND = "sqlite"')
+    if QUEUE_BACKEND == "sqlite" and BATCH_ENABLED:
+        # GET and DELETE of a batch must reach the worker streaming it
+        raise RuntimeError('Batches are kept per worker process, set BATCH_ENABLED = False to use QUEUE_BACKEND = "sqlite"')
     init_db()
-    # Initialize a custom queue
-    app.state.task_queue = CustomQueue()
-    app.state.pending_results = {}
-    app.state.last_fetch_time = 0
+    background = []
+    if QUEUE_BACKEND == "sqlite":
+        # Queue and results shared with the other worker processes
+        app.state.task_queue = SQLiteTaskQueue(SHARED_QUEUE_PATH, SHARED_SELECT_LIMIT)
+        app.state.pending_results = SQLitePendingResults(SHARED_QUEUE_PATH, SHARED_POLL_INTERVAL)
+        background.append(asyncio.create_task(app.state.pending_results.poll_forever()))
+        background.append(asyncio.create_task(purge_shared_backend(app)))
+    elif SNAPSHOT_ENABLED and JOURNAL_ENABLED:
+        app.state.task_queue = JournaledQueue(JOURNAL_PATH, JOURNAL_FSYNC)
+        app.state.pending_results = {}
+    else:
+        # Initialize a custom queue
+        app.state.task_queue = CustomQueue()
+        app.state.pending_results = {}
+    app.state.claimed_tasks = {}
+    app.state.completed_tasks = OrderedDict()
+    app.state.hedger = HedgeController(HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES, HEDGE_SAMPLE_WINDOW, HEDGE_BUDGET)
+    app.state.job_store = JobStore(JOB_STORE_MAX, JOB_RESULT_TTL)
+    app.state.batches = {}
+    app.state.traffic = TrafficScheduler(TRAFFIC_CLASSES)
+    app.state.affinity = AffinityTracker(AFFINITY_WINDOW, AFFINITY_MIN_TIME_LEFT, AFFINITY_PREFIXES_PER_PROVIDER)
+    app.state.fleet = FleetCapacity(SIZE_FLEET_WINDOW)
+    app.state.tracer = TraceRecorder(TRACE_BUFFER_SIZE, TRACE_SAMPLE_RATE if TRACE_ENABLED else 0)
+    app.state.profiler = SamplingProfiler(PROFILE_MAX_SECONDS, PROFILE_MIN_INTERVAL, PROFILE_MAX_OVERHEAD)
+    app.state.usage = UsageStore(USAGE_DB_PATH, USAGE_RAW_RETENTION, USAGE_HOURLY_RETENTION)
+    background.append(asyncio.create_task(maintain_usage(app.state.usage, USAGE_FLUSH_INTERVAL, USAGE_COMPACT_INTERVAL)))
+    app.state.last_empty_fetch = 0
+    app.state.peers = None
+    if PEERS:
+        app.state.peers = PeerPool(PEERS, PEER_FORWARD_AFTER, PEER_MAX_DEPTH, PEER_MAX_FORWARDS, PEER_POLL_INTERVAL,
+                                   PEER_REQUEST_TIMEOUT)
+        background.append(asyncio.create_task(app.state.peers.poll_forever()))
+
+    # Gauges are read at scrape time rather than tracked on every change
+    QUEUE_DEPTH.set_function(app.state.task_queue.qsize)
+    CLAIMED_TASKS.set_function(lambda: len(app.state.claimed_tasks))
+    PENDING_RESULTS.set_function(lambda: len(app.state.pending_results))
+    TRAFFIC_QUEUE_DEPTH.set_function(lambda: app.state.traffic.depths(app.state.task_queue.class_sizes()))
+
+    snapshotting = SNAPSHOT_ENABLED and QUEUE_BACKEND != "sqlite"
+    if snapshotting:
+        # Restore the previous process's queue, then start a fresh snapshot and journal
+        state = load_snapshot(SNAPSHOT_PATH)
+        if JOURNAL_ENABLED:
+            state = replay_journal(JOURNAL_PATH, state)
+        if state:
+            restore_snapshot(app, state)
+        save_snapshot(app, SNAPSHOT_PATH)
+        if JOURNAL_ENABLED:
+            app.state.task_queue.truncate()
+        if SNAPSHOT_INTERVAL:
+            background.append(asyncio.create_task(snapshot_periodically(app, SNAPSHOT_PATH, SNAPSHOT_INTERVAL)))
+
+    bot = None
+    if TELEGRAM_BOT_TOKEN:
+        # Imported here so the gateway runs without python-telegram-bot when the bot is separate
+        from telegram_bot import TelegramBot, acquire_bot_lock
+        bot_lock = acquire_bot_lock(TELEGRAM_BOT_LOCK_PATH)
+        if bot_lock is not None:
+            bot = TelegramBot(TELEGRAM_BOT_TOKEN, app)
+            try:
+                await bot.start()
+            except Exception:
+                # Telegram being unreachable must not keep the gateway from serving
+                logger.exception("Telegram bot failed to start, running without it")
+                bot = None
+                bot_lock.close()
     yield
     # Shutdown
-    # Add cleanup code here if needed
+    if bot is not None:
+        await bot.stop()
+        bot_lock.close()
+    for task in background:
+        task.cancel()
+    await asyncio.gather(*background, return_exceptions=True)
+    app.state.usage.close()
+    if app.state.peers is not None:
+        app.state.peers.close()
+    if snapshotting:
+        save_snapshot(app, SNAPSHOT_PATH)
+        if JOURNAL_ENABLED:
+            app.state.task_queue.truncate()
+            app.state.task_queue.close()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -32,24 +153,134 @@ app.add_middleware(
     expose_headers=["*"]
 )
 
+codecs = Codecs(COMPRESSION_GZIP_LEVEL, COMPRESSION_ZSTD_LEVEL, load_dictionary(COMPRESSION_ZSTD_DICT_PATH))
+if COMPRESSION_ENABLED:
+    # Provider traffic only, requesters' clients get plain responses as before
+    app.add_middleware(CompressionMiddleware, codecs=codecs, paths=("/fetch_task", "/submit_result"),
+                       min_size=COMPRESSION_MIN_SIZE, max_body=COMPRESSION_MAX_BODY)
+
 @app.post("/{user_token}/v1/chat/completions")
-async def chat_completions_default(user_token: str, request: dict):
+async def chat_completions_default(user_token: str, request: Request):
     """Handle chat completion request with default model"""
-    return await chat_completions_handler(user_token, get_default_model(), request, app)
+    return await chat_completions_handler(user_token, get_default_model(), await request.body(), app,
+                                          FORWARDED_HEADER in request.headers, request.headers.get(TRAFFIC_CLASS_HEADER),
+                                          request.headers.get(SPLIT_HEADER))
 
 @app.post("/{user_token}/{model_name}/v1/chat/completions")
-async def chat_completions(user_token: str, model_name: str, request: dict):
+async def chat_completions(user_token: str, model_name: str, request: Request):
     # Handle chat completion request with user token and model name
-    return await chat_completions_handler(user_token, model_name, request, app)
+    return await chat_completions_handler(user_token, model_name, await request.body(), app,
+                                          FORWARDED_HEADER in request.headers, request.headers.get(TRAFFIC_CLASS_HEADER),
+                                          request.headers.get(SPLIT_HEADER))
+
+if JOBS_ENABLED:
+    @app.post("/{user_token}/v1/jobs")
+    async def submit_job_default(user_token: str, request: Request, callback_url: str = None, timeout: float = None):
+        """Submit a chat completion as an asynchronous job with default model"""
+        return await submit_job_handler(user_token, get_default_model(), await request.body(), app, callback_url, timeout,
+                                        request.headers.get(TRAFFIC_CLASS_HEADER))
+
+    @app.post("/{user_token}/{model_name}/v1/jobs")
+    async def submit_job(user_token: str, model_name: str, request: Request, callback_url: str = None, timeout: float = None):
+        """Submit a chat completion as an asynchronous job"""
+        return await submit_job_handler(user_token, model_name, await request.body(), app, callback_url, timeout,
+                                        request.headers.get(TRAFFIC_CLASS_HEADER))
+
+    @app.get("/{user_token}/v1/jobs/{job_id}")
+    async def get_job(user_token: str, job_id: str, wait: float = 0):
+        """Poll a job, wait > 0 long-polls up to that many seconds"""
+        return await get_job_handler(user_token, job_id, app, wait)
+
+    @app.delete("/{user_token}/v1/jobs/{job_id}")
+    async def cancel_job(user_token: str, job_id: str):
+        return await cancel_job_handler(user_token, job_id, app)
+
+if BATCH_ENABLED:
+    @app.post("/{user_token}/v1/batch")
+    async def submit_batch_default(user_token: str, request: Request):
+        """Submit many chat requests with default model, results stream back as NDJSON"""
+        return await submit_batch_handler(user_token, get_default_model(), await request.body(), app,
+                                          request.headers.get(TRAFFIC_CLASS_HEADER))
+
+    @app.post("/{user_token}/{model_name}/v1/batch")
+    async def submit_batch(user_token: str, model_name: str, request: Request):
+        """Submit many chat requests, results stream back as NDJSON"""
+        return await submit_batch_handler(user_token, model_name, await request.body(), app,
+                                          request.headers.get(TRAFFIC_CLASS_HEADER))
+
+    @app.get("/{user_token}/v1/batch/{batch_id}")
+    async def get_batch(user_token: str, batch_id: str):
+        return await get_batch_handler(user_token, batch_id, app)
+
+    @app.delete("/{user_token}/v1/batch/{batch_id}")
+    async def cancel_batch(user_token: str, batch_id: str):
+        return await cancel_batch_handler(user_token, batch_id, app)
 
 @app.post("/{user_token}/fetch_task")
 async def fetch_task(user_token: str, request: dict):
     return await fetch_task_handler(user_token, request, app)
 
 @app.post("/{user_token}/submit_result")
-async def submit_result(user_token: str, submit: dict):
+async def submit_result(user_token: str, request: Request):
     """Submit processing result"""
-    return await submit_result_handler(user_token, submit, app)
+    return await submit_result_handler(user_token, await request.body(), app)
+
+@app.get("/{user_token}/peer_status")
+async def peer_status(user_token: str):
+    """Queue depth and spare capacity, polled by peer gateways"""
+    return await peer_status_handler(user_token, app)
+
+@app.get("/{user_token}/compression_dictionary")
+async def compression_dictionary(user_token: str):
+    """The shared zstd dictionary for the zstd-dict content coding"""
+    return await compression_dictionary_handler(user_token, codecs)
+
+@app.post("/{user_token}/submit_result/{task_id}")
+async def submit_raw_result(user_token: str, task_id: str, request: Request):
+    """Submit processing result, the body is the completion itself"""
+    return await submit_raw_result_handler(user_token, task_id, await request.body(), app)
+
+@app.get("/{user_token}/task_status/{task_id}")
+async def task_status(user_token: str, task_id: str):
+    """Check if a claimed task is still wanted (hedged copies may be cancelled)"""
+    return await task_status_handler(user_token, task_id, app)
+
+@app.get("/{user_token}/scheduler_stats")
+async def scheduler_stats(user_token: str):
+    """Report hedging budget usage and prefix affinity hit rate (admin only)"""
+    return await scheduler_stats_handler(user_token, app)
+
+@app.get("/{user_token}/metrics")
+async def metrics(user_token: str):
+    """Scheduler metrics in Prometheus text format, admin only"""
+    return await metrics_handler(user_token)
+
+@app.get("/{user_token}/traces")
+async def traces(user_token: str, task_id: str = None, since: float = 0):
+    """Finished task lifecycle traces as JSON lines, or one task's trace, admin only"""
+    return await traces_handler(user_token, app, task_id, since)
+
+@app.get("/{user_token}/db_stats")
+async def db_stats(user_token: str):
+    """Per-statement SQLite timings and recent slow queries, admin only"""
+    return await db_stats_handler(user_token)
+
+@app.get("/{user_token}/profile")
+async def profile(user_token: str, seconds: float = 10, interval: float = 0.005, output: str = "collapsed"):
+    """Sample the event loop for a few seconds and return collapsed stacks, admin only"""
+    return await profile_handler(user_token, app, seconds, interval, output)
+
+@app.get("/{user_token}/usage")
+async def usage(user_token: str, role: str = "requester", resolution: str = "hour", start: float = None,
+                end: float = None):
+    """The user's own usage history per hour or day, as requester or provider"""
+    return await usage_handler(user_token, app, role, resolution, start, end)
+
+@app.get("/{user_token}/usage/summary")
+async def usage_summary(user_token: str, role: str = "requester", resolution: str = "hour", start: float = None,
+                        end: float = None, by_user: bool = False):
+    """Usage of all users per hour or day, or per user over the range, admin only"""
+    return await usage_summary_handler(user_token, app, role, resolution, start, end, by_user)
 
 @app.get("/{user_token}/v1/models")
 async def list_default_models(user_token: str):
@@ -0,0 +1,275 @@
+from bisect import bisect_left
+from functools import wraps
+from time import perf_counter
+from typing import Callable, Iterable, Optional
+import math
+
+# Default histogram buckets in seconds, from a dict lookup to a long translation
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+def _format_labels(names: tuple, values: tuple, extra: str = None) -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+class _GaugeChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        # One slot per bucket plus +Inf, counts are made cumulative when rendering
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+class _Metric:
+    kind = None
+    child_class = None
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        """
+        Args:
+            name: Metric name in Prometheus format
+            documentation: HELP text
+            labelnames: Names of the labels, children are created per label value tuple
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def _new_child(self):
+        return self.child_class()
+
+    def labels(self, *values):
+        """
+        Get the child for a label value tuple, creating it on first use
+        Hot paths should look their children up once and keep them.
+        """
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            child = self.children[values] = self._new_child()
+        return child
+
+    def samples(self) -> list:
+        """Get (name suffix, label text, value) of every sample"""
+        return [("", _format_labels(self.labelnames, values), child.value)
+                for values, child in self.children.items()]
+
+class Counter(_Metric):
+    kind = "counter"
+    child_class = _CounterChild
+
+    def inc(self, amount: float = 1) -> None:
+        self._default.value += amount
+
+class Gauge(_Metric):
+    kind = "gauge"
+    child_class = _GaugeChild
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 function: Callable[[], float] = None):
+        """
+        Args:
+            function: Optional callback read at scrape time instead of a stored value,
+                      for values that are cheaper to look up than to track
+        """
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set_function(self, function: Optional[Callable[[], float]]) -> None:
+        self.function = function
+
+    def set(self, value: float) -> None:
+        self._default.value = value
+
+    def samples(self) -> list:
+        if self.function is not None:
+            if self.labelnames:
+                # Labelled gauges' callbacks return {label value tuple: value}
+                return [("", _format_labels(self.labelnames, values), value)
+                        for values, value in self.function().items()]
+            return [("", "", self.function())]
+        return super().samples()
+
+class Histogram(_Metric):
+    kind = "histogram"
+    child_class = _HistogramChild
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        """
+        Args:
+            buckets: Upper bounds of the buckets, fixed for the life of the process
+        """
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float) -> None:
+        child = self._default
+        child.counts[bisect_left(child.bounds, value)] += 1
+        child.sum += value
+
+    def samples(self) -> list:
+        samples = []
+        for values, child in self.children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), child.counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                samples.append(("_bucket", _format_labels(self.labelnames, values, le), cumulative))
+            labels = _format_labels(self.labelnames, values)
+            samples.append(("_sum", labels, child.sum))
+            samples.append(("_count", labels, cumulative))
+        return samples
+
+class Registry:
+    def __init__(self):
+        """
+        Collection of metrics rendered together
+        Updates are plain attribute writes without locking: the gateway updates
+        metrics from the event loop thread, and callers on other threads already
+        hold the lock of the structure they measure.
+        Each uvicorn worker process has its own registry.
+        """
+        self.metrics = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+              function: Callable[[], float] = None) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                  buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> bytes:
+        """Render every metric in the Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, labels, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{labels} {_format_value(value)}")
+        return ("\n".join(lines) + "\n").encode()
+
+REGISTRY = Registry()
+
+# Queue
+QUEUE_DEPTH = REGISTRY.gauge("sakura_queue_depth", "Tasks waiting in the queue")
+CLAIMED_TASKS = REGISTRY.gauge("sakura_claimed_tasks", "Tasks currently claimed by a provider")
+PENDING_RESULTS = REGISTRY.gauge("sakura_pending_results", "Requests waiting for a result")
+QUEUE_OPERATIONS = REGISTRY.counter("sakura_queue_operations_total", "Queue operations", ("op",))
+QUEUE_GET_SECONDS = REGISTRY.histogram("sakura_queue_get_seconds", "Time spent in CustomQueue.get holding the lock")
+
+# Scheduler
+TASK_WAIT_SECONDS = REGISTRY.histogram("sakura_task_wait_seconds", "Time from enqueue to first claim")
+CLAIM_TO_SUBMIT_SECONDS = REGISTRY.histogram("sakura_claim_to_submit_seconds", "Time from the winning claim to submit_result")
+FETCHES = REGISTRY.counter("sakura_fetches_total", "fetch_task calls by outcome", ("outcome",))
+DISPATCHES = REGISTRY.counter("sakura_dispatches_total", "Tasks handed to providers by queue mode", ("mode",))
+EXPIRED_SKIPS = REGISTRY.counter("sakura_expired_skips_total", "Queued tasks dropped at fetch because they would time out")
+REQUEUES = REGISTRY.counter("sakura_requeues_total", "Tasks re-queued after a silent claim")
+SUBMITS = REGISTRY.counter("sakura_submits_total", "submit_result calls by outcome", ("outcome",))
+
+# Requests
+CHAT_REQUESTS = REGISTRY.counter("sakura_chat_requests_total", "Chat completion requests by outcome", ("outcome",))
+CHAT_SECONDS = REGISTRY.histogram("sakura_chat_seconds", "Chat completion latency as seen by the requester")
+
+# Database
+DB_QUERY_SECONDS = REGISTRY.histogram("sakura_db_query_seconds", "Time spent in database.py functions", ("function",))
+DB_LOCK_WAITS = REGISTRY.counter("sakura_db_lock_waits_total", "Statements that found the database locked")
+DB_LOCK_WAIT_SECONDS = REGISTRY.counter("sakura_db_lock_wait_seconds_total", "Time spent waiting for database locks")
+DB_LOCK_ERRORS = REGISTRY.counter("sakura_db_lock_errors_total", "Statements that gave up on a locked database")
+DB_SLOW_QUERIES = REGISTRY.counter("sakura_db_slow_queries_total", "Statements slower than DB_SLOW_QUERY_SECONDS")
+
+# Peering
+PEER_FORWARDS = REGISTRY.counter("sakura_peer_forwards_total", "Chat tasks forwarded to peer gateways by outcome",
+                                 ("outcome",))
+
+# Compression of provider traffic, stage is "wire" (as sent) or "plain" (before compression)
+COMPRESSION_BYTES = REGISTRY.counter("sakura_compression_bytes_total", "Provider endpoint body bytes",
+                                     ("direction", "encoding", "stage"))
+COMPRESSION_SECONDS = REGISTRY.counter("sakura_compression_cpu_seconds_total",
+                                       "CPU time spent compressing and decompressing bodies", ("direction", "encoding"))
+
+# Traffic classes, see TRAFFIC_CLASSES in config.py
+TRAFFIC_QUEUE_DEPTH = REGISTRY.gauge("sakura_traffic_queue_depth", "Tasks waiting per traffic class", ("class",))
+TRAFFIC_CLAIMS = REGISTRY.counter("sakura_traffic_claims_total", "Tasks handed to providers per traffic class",
+                                  ("class",))
+TRAFFIC_WAIT_SECONDS = REGISTRY.histogram("sakura_traffic_wait_seconds",
+                                          "Time from enqueue to first claim per traffic class", ("class",))
+TRAFFIC_SECONDS = REGISTRY.histogram("sakura_traffic_request_seconds",
+                                     "Time from enqueue to result per traffic class", ("class",))
+TRAFFIC_SLO = REGISTRY.counter("sakura_traffic_slo_total",
+                               "Finished requests per traffic class, outcome is within_slo, over_slo or failed",
+                               ("class", "outcome"))
+
+# Split chat requests, see SPLIT_ENABLED in config.py
+SPLIT_REQUESTS = REGISTRY.counter("sakura_split_requests_total", "Chat requests split into pieces")
+SPLIT_PIECES = REGISTRY.counter("sakura_split_pieces_total",
+                                "Pieces of split chat requests by outcome: completed, retried or failed", ("outcome",))
+
+def timed(histogram: Histogram):
+    """Decorator recording each call's duration in histogram, labelled with the function name"""
+    def decorator(func):
+        child = histogram.labels(func.__name__)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                child.observe(perf_counter() - start)
+        return wrapper
+    return decorator
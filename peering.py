@@ -0,0 +1,138 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+import asyncio
+import time
+import urllib.request
+
+from utils import json_loads
+
+# Marks requests forwarded by a peer, they are never forwarded again
+FORWARDED_HEADER = "X-Sakura-Forwarded"
+
+class PeerError(Exception):
+    pass
+
+class Peer:
+    def __init__(self, url: str, token: str):
+        """
+        Another gateway deployment that may take overflow tasks
+        Args:
+            url: Base URL of the peer, e.g. http://127.0.0.1:8001
+            token: user_id-token of this gateway's account on the peer
+        """
+        self.url = url.rstrip("/")
+        self.token = token
+        self.queue_depth = None
+        self.accepting = False
+        self.updated_at = 0.0
+        self.in_flight = 0
+        self.forwarded = 0
+        self.failed = 0
+
+    def stats(self) -> dict:
+        return {
+            "url": self.url,
+            "queue_depth": self.queue_depth,
+            "accepting": self.accepting,
+            "age": time.time() - self.updated_at if self.updated_at else None,
+            "in_flight": self.in_flight,
+            "forwarded": self.forwarded,
+            "failed": self.failed
+        }
+
+def _request(url: str, body: Optional[bytes], timeout: float) -> bytes:
+    headers = {FORWARDED_HEADER: "1"}
+    if body is not None:
+        headers["Content-Type"] = "application/json"
+    req = urllib.request.Request(url, data=body, headers=headers, method="POST" if body is not None else "GET")
+    with urllib.request.urlopen(req, timeout=timeout) as response:
+        return response.read()
+
+class PeerPool:
+    def __init__(self, peers: list, forward_after: float = 40, max_depth: int = 0, max_forwards: int = 16,
+                 poll_interval: float = 5, request_timeout: float = 150):
+        """
+        Forward tasks about to time out to peer gateways with spare capacity
+        Peers are polled for their queue depth and whether they have idle
+        providers. A chat task still unclaimed after forward_after seconds is
+        taken out of the local queue and sent to the least loaded accepting
+        peer as an ordinary chat request, its response is relayed unchanged.
+        Args:
+            peers: Dicts with the url and token of each peer
+            forward_after: Seconds an unclaimed chat task waits locally before it may be forwarded
+            max_depth: Largest reported queue depth (plus our own forwards in flight) of a peer taking tasks
+            max_forwards: Forwarded requests in flight at once
+            poll_interval: Seconds between peer status polls
+            request_timeout: Seconds to wait for a forwarded request's response
+        """
+        self.peers = [Peer(peer["url"], peer["token"]) for peer in peers]
+        self.forward_after = forward_after
+        self.max_depth = max_depth
+        self.max_forwards = max_forwards
+        self.poll_interval = poll_interval
+        self.request_timeout = request_timeout
+        # Own threads so slow peers can't starve asyncio.to_thread users
+        self.executor = ThreadPoolExecutor(max_forwards + len(self.peers), thread_name_prefix="peer")
+        self.in_flight = 0
+
+    async def _call(self, url: str, body: Optional[bytes], timeout: float) -> bytes:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, _request, url, body, timeout)
+
+    async def poll(self, peer: Peer) -> None:
+        try:
+            status = json_loads(await self._call(f"{peer.url}/{peer.token}/peer_status", None,
+                                                 min(self.poll_interval, 10)))
+            peer.queue_depth = status["queue_depth"]
+            peer.accepting = bool(status["accepting"])
+            peer.updated_at = time.time()
+        except (OSError, ValueError, KeyError, TypeError):
+            peer.accepting = False
+
+    async def poll_forever(self) -> None:
+        while True:
+            await asyncio.gather(*(self.poll(peer) for peer in self.peers))
+            await asyncio.sleep(self.poll_interval)
+
+    def pick(self) -> Optional[Peer]:
+        """Get the accepting peer with the shallowest queue, None if no peer can take a task now"""
+        if self.in_flight >= self.max_forwards:
+            return None
+        stale = time.time() - 3 * self.poll_interval
+        candidates = [peer for peer in self.peers
+                      if peer.accepting and peer.updated_at >= stale
+                      and peer.queue_depth + peer.in_flight <= self.max_depth]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda peer: peer.queue_depth + peer.in_flight)
+
+    async def forward(self, peer: Peer, path: str, body: bytes) -> bytes:
+        """
+        Send a request to a peer and return its response body
+        Raises:
+            PeerError: If the peer failed, timed out or answered with an error status (HTTPError is an OSError)
+        """
+        self.in_flight += 1
+        peer.in_flight += 1
+        try:
+            result = await self._call(f"{peer.url}/{peer.token}{path}", body, self.request_timeout)
+        except OSError as e:
+            peer.failed += 1
+            # Don't send more until the next poll says otherwise
+            peer.accepting = False
+            raise PeerError(f"{peer.url}: {e}")
+        finally:
+            self.in_flight -= 1
+            peer.in_flight -= 1
+        peer.forwarded += 1
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "max_forwards": self.max_forwards,
+            "peers": [peer.stats() for peer in self.peers]
+        }
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
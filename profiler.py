@@ -0,0 +1,107 @@
+from collections import Counter
+import os
+import sys
+import threading
+import time
+
+HANDLERS_FILE = "handlers.py"
+# The event loop is blocked in the selector when it has nothing to run
+IDLE_FUNCTIONS = {"select", "poll", "epoll", "kqueue", "_run_once"}
+
+def frame_label(code) -> str:
+    return f"{getattr(code, 'co_qualname', code.co_name)} ({os.path.basename(code.co_filename)})"
+
+class SamplingProfiler:
+    def __init__(self, max_seconds: float = 60, min_interval: float = 0.001, max_overhead: float = 0.02):
+        """
+        Sample the stack of the event loop thread from a background thread
+        Samples are collapsed into "root;...;leaf count" lines for flamegraph.pl
+        or speedscope. Each stack is prefixed with the outermost handlers.py
+        function on it, so time is attributed to the coroutine serving a route.
+        Only the process serving the request is profiled.
+        Args:
+            max_seconds: Longest profile allowed
+            min_interval: Shortest sampling interval allowed
+            max_overhead: Share of wall time the sampler may spend walking stacks,
+                the interval is widened when it is exceeded
+        """
+        self.max_seconds = max_seconds
+        self.min_interval = min_interval
+        self.max_overhead = max_overhead
+        # One profile at a time, two samplers would double the overhead
+        self.lock = threading.Lock()
+
+    def is_running(self) -> bool:
+        return self.lock.locked()
+
+    def run(self, thread_id: int, seconds: float, interval: float) -> dict:
+        """
+        Sample thread_id for seconds, blocking the calling thread
+        Returns:
+            dict: stacks (collapsed stack -> samples), handlers (handler -> samples) and sampler figures
+        Raises:
+            RuntimeError: If a profile is already running
+        """
+        if not self.lock.acquire(blocking=False):
+            raise RuntimeError("A profile is already running")
+        try:
+            return self._sample(thread_id, min(seconds, self.max_seconds), max(interval, self.min_interval))
+        finally:
+            self.lock.release()
+
+    def _sample(self, thread_id: int, seconds: float, interval: float) -> dict:
+        stacks = Counter()
+        handlers = Counter()
+        samples = 0
+        sampling_time = 0.0
+        average_cost = 0.0
+        start = time.perf_counter()
+        deadline = start + seconds
+        requested_interval = interval
+
+        while True:
+            if time.perf_counter() >= deadline:
+                break
+            # CPU time of this thread, waiting for the GIL is not overhead
+            cpu_start = time.thread_time()
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                break
+            labels = []
+            handler = None
+            idle = frame.f_code.co_name in IDLE_FUNCTIONS
+            while frame is not None:
+                code = frame.f_code
+                labels.append(frame_label(code))
+                if os.path.basename(code.co_filename) == HANDLERS_FILE:
+                    # Keep the outermost handlers.py frame
+                    handler = code.co_name
+                frame = frame.f_back
+            del frame
+            root = handler or ("(idle)" if idle else "(other)")
+            labels.append(root)
+            stacks[";".join(reversed(labels))] += 1
+            handlers[root] += 1
+            samples += 1
+
+            cost = time.thread_time() - cpu_start
+            sampling_time += cost
+            average_cost = cost if samples == 1 else average_cost * 0.9 + cost * 0.1
+            # Stay under the overhead budget, the sampler holds the GIL while walking
+            interval = min(max(requested_interval, average_cost / self.max_overhead), 1.0)
+            time.sleep(interval)
+
+        elapsed = time.perf_counter() - start
+        return {
+            "seconds": elapsed,
+            "samples": samples,
+            "requested_interval": requested_interval,
+            "interval": interval,
+            "overhead": sampling_time / elapsed if elapsed else 0.0,
+            "handlers": dict(handlers.most_common()),
+            "stacks": dict(stacks)
+        }
+
+def collapsed(profile: dict) -> str:
+    """Format a profile as collapsed stacks, one "frame;frame;frame count" line each"""
+    return "".join(f"{stack} {count}\n" for stack, count in sorted(profile["stacks"].items()))
@@ -0,0 +1,340 @@
+"""
+Reference provider worker
+
+Connects a llama.cpp server to the gateway. Every llama.cpp parallel slot is
+kept busy: the next task is fetched while the current ones are generating,
+results are submitted in the background with retries, and both sides use
+pooled keep-alive connections. Tasks the gateway cancels (a hedge copy that
+lost, a requester that gave up) are dropped, even mid-generation. The model
+meta is read from llama.cpp and validated once at startup.
+
+    python -m provider --gateway https://sakura-share.one --token 2-abc --llama http://127.0.0.1:8080
+"""
+from typing import Optional
+import argparse
+import asyncio
+import logging
+import time
+
+import httpx
+
+from models import verify_model_meta
+from utils import json_dumps, json_loads
+
+logger = logging.getLogger(__name__)
+
+class ProviderError(Exception):
+    pass
+
+class WorkerStats:
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.fetches = 0
+        self.empty_fetches = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.submit_retries = 0
+        self.submit_failures = 0
+        self.busy_seconds = 0.0
+
+    def as_dict(self, slots: int) -> dict:
+        elapsed = time.monotonic() - self.started_at
+        return {
+            "fetches": self.fetches,
+            "empty_fetches": self.empty_fetches,
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+            "submit_retries": self.submit_retries,
+            "submit_failures": self.submit_failures,
+            # Share of slot time spent generating
+            "utilization": self.busy_seconds / (slots * elapsed) if elapsed > 0 else None
+        }
+
+class ProviderWorker:
+    def __init__(self, gateway_url: str, token: str, llama_url: str, slots: int = None, prefetch: int = 1,
+                 poll_interval: float = 0.5, poll_max: float = 5, submit_retries: int = 5,
+                 generation_timeout: float = 600, status_interval: float = 5, gateway_client: httpx.AsyncClient = None,
+                 llama_client: httpx.AsyncClient = None):
+        """
+        Serve gateway tasks with a llama.cpp server
+        Args:
+            gateway_url: Base URL of the gateway
+            token: Provider account in user_id-token form
+            llama_url: Base URL of the llama.cpp server
+            slots: Tasks generated at once, by default llama.cpp's total_slots
+            prefetch: Tasks claimed ahead of a free slot, they wait in the claim window so keep this small
+            poll_interval: Seconds to wait after an empty fetch, doubled while the queue stays empty
+            poll_max: Longest wait between fetches
+            submit_retries: Attempts to submit a result before it is dropped
+            generation_timeout: Seconds llama.cpp may take for one task
+            status_interval: Seconds between task_status checks while a task generates
+            gateway_client: Client for the gateway, e.g. with an in-process transport for tests
+            llama_client: Client for llama.cpp
+        """
+        self.token = token
+        self.slots = slots
+        self.prefetch = prefetch
+        self.poll_interval = poll_interval
+        self.poll_max = poll_max
+        self.submit_retries = submit_retries
+        self.status_interval = status_interval
+        self.gateway = gateway_client or httpx.AsyncClient(base_url=gateway_url, timeout=60)
+        self.llama = llama_client or httpx.AsyncClient(base_url=llama_url, timeout=generation_timeout)
+        self.stats = WorkerStats()
+        self.meta = None
+        self.capacity = {}
+        self.fetch_body = None
+        self.tokens_per_second = None
+        self.ready = None
+        self.claims = None
+        self.submissions = set()
+
+    async def load_meta(self) -> None:
+        """
+        Read the model meta and slot count from llama.cpp and check the model is one the gateway serves
+        Raises:
+            ProviderError: If llama.cpp is unreachable or serves an unknown model
+        """
+        try:
+            meta = (await self.llama.get("/v1/models")).raise_for_status().json()
+            props = (await self.llama.get("/props")).raise_for_status().json()
+        except (httpx.HTTPError, ValueError) as e:
+            raise ProviderError(f"Can't read model meta from llama.cpp: {e}")
+        if not verify_model_meta(meta):
+            raise ProviderError(f"Model {meta.get('data', [{}])[0].get('id')} is not served by the gateway")
+
+        if self.slots is None:
+            self.slots = props.get("total_slots") or 1
+        n_ctx = props.get("default_generation_settings", {}).get("n_ctx")
+        # Only the fields the gateway reads, meta is sent with every fetch
+        self.meta = {"data": [{"id": model["id"], "meta": model["meta"]} for model in meta["data"][:1]]}
+        self.capacity = {"n_ctx": n_ctx} if n_ctx else {}
+        self.encode_fetch_body()
+
+    def encode_fetch_body(self) -> None:
+        """Encode the fetch_task body once, again only when the measured speed changes"""
+        capacity = dict(self.capacity)
+        if self.tokens_per_second:
+            capacity["tokens_per_second"] = round(self.tokens_per_second, 1)
+        self.fetch_body = json_dumps(dict(self.meta, capacity=capacity))
+
+    async def fetch(self) -> Optional[dict]:
+        """Claim a task, None if the queue is empty"""
+        r = await self.gateway.post(f"/{self.token}/fetch_task", content=self.fetch_body,
+                                    headers={"Content-Type": "application/json"})
+        if r.status_code in (400, 401):
+            # Wrong token or model meta, fetching again won't fix it
+            raise ProviderError(f"Gateway rejected fetch_task: {r.text}")
+        r.raise_for_status()
+        self.stats.fetches += 1
+        task = r.json()
+        if "task_id" not in task:
+            self.stats.empty_fetches += 1
+            return None
+        return task
+
+    async def fetch_loop(self) -> None:
+        """Claim tasks while a slot is free, or up to prefetch tasks ahead while all are busy"""
+        idle = self.poll_interval
+        while True:
+            # Claimed tasks time out, so don't claim more than the slots start soon
+            await self.claims.acquire()
+            try:
+                task = await self.fetch()
+            except httpx.HTTPError as e:
+                self.claims.release()
+                logger.warning("fetch_task failed: %s", e)
+                await asyncio.sleep(self.poll_max)
+                continue
+            if task is None:
+                self.claims.release()
+                await asyncio.sleep(idle)
+                idle = min(idle * 2, self.poll_max)
+                continue
+            idle = self.poll_interval
+            await self.ready.put(task)
+
+    async def is_cancelled(self, task_id: str) -> bool:
+        """
+        Check whether the gateway still wants a result, False if it can't be reached
+        A task is cancelled once another provider (e.g. a hedge copy) submitted it, or its requester gave up
+        """
+        try:
+            r = await self.gateway.get(f"/{self.token}/task_status/{task_id}")
+            r.raise_for_status()
+            return r.json().get("status") in ("cancelled", "not_found")
+        except (httpx.HTTPError, ValueError) as e:
+            logger.warning("task_status for %s failed: %s", task_id, e)
+            return False
+
+    async def generate_unless_cancelled(self, task: dict) -> Optional[bytes]:
+        """Run generate, checking task_status every status_interval seconds, None if the task was cancelled"""
+        generation = asyncio.create_task(self.generate(task))
+        try:
+            while True:
+                done, _ = await asyncio.wait([generation], timeout=self.status_interval)
+                if done:
+                    return generation.result()
+                if await self.is_cancelled(task["task_id"]):
+                    # Closing the request makes llama.cpp stop generating
+                    return None
+        finally:
+            generation.cancel()
+
+    async def generate(self, task: dict) -> bytes:
+        """Run a task on llama.cpp, return the completion (or an error completion) as JSON bytes"""
+        request_body = dict(task["request_body"])
+        request_body.pop("stream", None)
+        start = time.monotonic()
+        try:
+            r = await self.llama.post("/v1/chat/completions", content=json_dumps(request_body),
+                                      headers={"Content-Type": "application/json"})
+        except httpx.HTTPError as e:
+            self.stats.failed += 1
+            return json_dumps({"error": {"message": f"llama.cpp request failed: {e}", "type": "provider_error"}})
+        finally:
+            self.stats.busy_seconds += time.monotonic() - start
+
+        if r.status_code >= 400:
+            self.stats.failed += 1
+            # llama.cpp errors are already {"error": {...}}, pass them on as they are
+            try:
+                if "error" in json_loads(r.content):
+                    return r.content
+            except ValueError:
+                pass
+            return json_dumps({"error": {"message": f"llama.cpp returned {r.status_code}", "type": "provider_error"}})
+
+        self.measure_speed(r.content, time.monotonic() - start)
+        return r.content
+
+    def measure_speed(self, content: bytes, seconds: float) -> None:
+        """Track generation speed per slot, advertised to the gateway for size-aware dispatch"""
+        try:
+            completion = json_loads(content)
+        except ValueError:
+            return
+        speed = (completion.get("timings") or {}).get("predicted_per_second")
+        if not speed:
+            tokens = (completion.get("usage") or {}).get("completion_tokens")
+            speed = tokens / seconds if tokens and seconds > 0 else None
+        if not speed:
+            return
+        previous = self.tokens_per_second
+        self.tokens_per_second = speed if previous is None else 0.8 * previous + 0.2 * speed
+        # Re-encode only on a noticeable change
+        if previous is None or abs(self.tokens_per_second - previous) > 0.05 * previous:
+            self.encode_fetch_body()
+
+    async def submit(self, task_id: str, result: bytes) -> None:
+        """Submit a result, retrying connection errors and server errors with backoff"""
+        delay = 0.5
+        for attempt in range(self.submit_retries):
+            try:
+                r = await self.gateway.post(f"/{self.token}/submit_result/{task_id}", content=result,
+                                            headers={"Content-Type": "application/json"})
+                if r.status_code < 500:
+                    # 404: the task timed out or another provider finished it, retrying won't help
+                    if r.status_code == 200:
+                        self.stats.completed += 1
+                    return
+            except httpx.HTTPError as e:
+                logger.warning("submit_result for %s failed: %s", task_id, e)
+            if attempt + 1 < self.submit_retries:
+                self.stats.submit_retries += 1
+                await asyncio.sleep(delay)
+                delay *= 2
+        self.stats.submit_failures += 1
+
+    async def slot_loop(self) -> None:
+        while True:
+            task = await self.ready.get()
+            try:
+                # A prefetched task may have been finished by another provider while it waited
+                result = None
+                if not await self.is_cancelled(task["task_id"]):
+                    result = await self.generate_unless_cancelled(task)
+            finally:
+                self.claims.release()
+            if result is None or await self.is_cancelled(task["task_id"]):
+                self.stats.cancelled += 1
+                continue
+            # Start the next task at once, the submit runs alongside it
+            submission = asyncio.create_task(self.submit(task["task_id"], result))
+            self.submissions.add(submission)
+            submission.add_done_callback(self.submissions.discard)
+
+    async def log_stats(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            logger.info("%s", self.stats.as_dict(self.slots))
+
+    async def run(self, stats_interval: float = 60) -> None:
+        """
+        Serve tasks until cancelled
+        Raises:
+            ProviderError: If llama.cpp serves an unknown model or the gateway rejects this provider
+        """
+        await self.load_meta()
+        self.ready = asyncio.Queue()
+        self.claims = asyncio.Semaphore(self.slots + self.prefetch)
+        logger.info("Serving %s with %d slots", self.meta["data"][0]["id"], self.slots)
+        workers = [asyncio.create_task(self.slot_loop()) for _ in range(self.slots)]
+        workers.append(asyncio.create_task(self.fetch_loop()))
+        workers.append(asyncio.create_task(self.log_stats(stats_interval)))
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            # Don't drop finished results on shutdown
+            if self.submissions:
+                await asyncio.wait(self.submissions, timeout=30)
+
+    async def close(self) -> None:
+        await self.gateway.aclose()
+        await self.llama.aclose()
+
+async def serve(args) -> None:
+    # One keep-alive connection per slot to llama.cpp, a few to the gateway for fetches and submits
+    worker = ProviderWorker(
+        args.gateway, args.token, args.llama, slots=args.slots, prefetch=args.prefetch,
+        poll_interval=args.poll_interval, poll_max=args.poll_max, submit_retries=args.submit_retries,
+        status_interval=args.status_interval,
+        gateway_client=httpx.AsyncClient(base_url=args.gateway, timeout=60,
+                                         limits=httpx.Limits(max_keepalive_connections=8, keepalive_expiry=60)),
+        llama_client=httpx.AsyncClient(base_url=args.llama, timeout=args.generation_timeout,
+                                       limits=httpx.Limits(max_keepalive_connections=64, keepalive_expiry=60))
+    )
+    try:
+        await worker.run(args.stats_interval)
+    finally:
+        await worker.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--gateway", required=True, help="Base URL of the gateway")
+    parser.add_argument("--token", required=True, help="Provider account, user_id-token")
+    parser.add_argument("--llama", default="http://127.0.0.1:8080", help="Base URL of the llama.cpp server")
+    parser.add_argument("--slots", type=int, default=None, help="Tasks at once, defaults to llama.cpp's --parallel")
+    parser.add_argument("--prefetch", type=int, default=1, help="Tasks claimed ahead while all slots are busy")
+    parser.add_argument("--poll-interval", type=float, default=0.5, help="Sleep after an empty fetch")
+    parser.add_argument("--poll-max", type=float, default=5, help="Longest sleep while the queue stays empty")
+    parser.add_argument("--submit-retries", type=int, default=5)
+    parser.add_argument("--generation-timeout", type=float, default=600)
+    parser.add_argument("--status-interval", type=float, default=5,
+                        help="Seconds between checks that a generating task is still wanted")
+    parser.add_argument("--stats-interval", type=float, default=60, help="Seconds between stats log lines")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    try:
+        asyncio.run(serve(args))
+    except ProviderError as e:
+        parser.exit(1, f"{e}\n")
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
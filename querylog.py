@@ -0,0 +1,170 @@
+from collections import deque
+from functools import lru_cache
+from typing import Optional
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+from config import DB_SLOW_QUERY_SECONDS, DB_BUSY_TIMEOUT
+from metrics import DB_LOCK_WAITS, DB_LOCK_WAIT_SECONDS, DB_LOCK_ERRORS, DB_SLOW_QUERIES
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE = re.compile(r"\s+")
+
+@lru_cache(maxsize=1024)
+def normalize(sql: str) -> str:
+    """Collapse whitespace so the same statement from different call sites is counted once"""
+    return _WHITESPACE.sub(" ", sql).strip()
+
+def is_locked_error(error: sqlite3.OperationalError) -> bool:
+    message = str(error)
+    return "database is locked" in message or "database table is locked" in message
+
+class StatementStats:
+    __slots__ = ("calls", "total", "errors", "lock_waits", "lock_wait", "durations")
+
+    def __init__(self, window: int):
+        self.calls = 0
+        self.total = 0.0
+        self.errors = 0
+        self.lock_waits = 0
+        self.lock_wait = 0.0
+        # Recent durations for percentiles
+        self.durations = deque(maxlen=window)
+
+    def summary(self) -> dict:
+        ordered = sorted(self.durations)
+        def percentile(fraction: float) -> Optional[float]:
+            if not ordered:
+                return None
+            return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+        return {
+            "calls": self.calls,
+            "total_seconds": self.total,
+            "mean_seconds": self.total / self.calls if self.calls else None,
+            "p50_seconds": percentile(0.5),
+            "p95_seconds": percentile(0.95),
+            "p99_seconds": percentile(0.99),
+            "errors": self.errors,
+            "lock_waits": self.lock_waits,
+            "lock_wait_seconds": self.lock_wait
+        }
+
+class QueryLog:
+    def __init__(self, slow_seconds: float = 0.05, window: int = 1024, slow_log_size: int = 100):
+        """
+        Per-statement timing for the SQLite data layer
+        Args:
+            slow_seconds: Statements slower than this are logged with their query plan
+            window: Number of recent durations kept per statement for percentiles
+            slow_log_size: Number of recent slow statements kept for the admin view
+        """
+        self.slow_seconds = slow_seconds
+        self.window = window
+        self.statements = {}
+        self.slow = deque(maxlen=slow_log_size)
+        # database.py may be called from worker threads (e.g. the Telegram bot)
+        self.lock = threading.Lock()
+
+    def record(self, sql: str, duration: float, lock_wait: float = 0.0, error: bool = False) -> None:
+        with self.lock:
+            stats = self.statements.get(sql)
+            if stats is None:
+                stats = self.statements[sql] = StatementStats(self.window)
+            stats.calls += 1
+            stats.total += duration
+            stats.durations.append(duration)
+            if error:
+                stats.errors += 1
+            if lock_wait:
+                stats.lock_waits += 1
+                stats.lock_wait += lock_wait
+
+    def record_slow(self, sql: str, duration: float, plan: list) -> None:
+        DB_SLOW_QUERIES.inc()
+        self.slow.append({"statement": sql, "seconds": duration, "at": time.time(), "plan": plan})
+        logger.warning("Slow query (%.1f ms): %s\n%s", duration * 1000, sql, "\n".join(plan))
+
+    def summary(self) -> dict:
+        """Get per-statement figures, slowest in total first, and the recent slow statements"""
+        with self.lock:
+            statements = [dict(statement=sql, **stats.summary()) for sql, stats in self.statements.items()]
+        statements.sort(key=lambda entry: entry["total_seconds"], reverse=True)
+        return {
+            "slow_threshold_seconds": self.slow_seconds,
+            "statements": statements,
+            "slow": list(self.slow)
+        }
+
+QUERY_LOG = QueryLog(DB_SLOW_QUERY_SECONDS)
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql: str, parameters=()):
+        return self.connection._run(super().execute, sql, parameters)
+
+    def executemany(self, sql: str, seq_of_parameters):
+        return self.connection._run(super().executemany, sql, seq_of_parameters, explain=False)
+
+class InstrumentedConnection(sqlite3.Connection):
+    """
+    Connection timing every statement into QUERY_LOG
+    It is opened with a zero busy timeout so a locked database shows up as an
+    error, which is counted and then retried with DB_BUSY_TIMEOUT; the time
+    spent in the retry is the lock wait.
+    """
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql: str, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def commit(self):
+        return self._run(lambda sql, parameters: super(InstrumentedConnection, self).commit(), "COMMIT", (),
+                         explain=False)
+
+    def _run(self, run, sql: str, parameters, explain: bool = True):
+        start = time.perf_counter()
+        lock_wait = 0.0
+        try:
+            try:
+                result = run(sql, parameters)
+            except sqlite3.OperationalError as error:
+                if not is_locked_error(error):
+                    raise
+                DB_LOCK_WAITS.inc()
+                wait_start = time.perf_counter()
+                sqlite3.Connection.execute(self, f"PRAGMA busy_timeout = {int(DB_BUSY_TIMEOUT * 1000)}")
+                try:
+                    result = run(sql, parameters)
+                finally:
+                    sqlite3.Connection.execute(self, "PRAGMA busy_timeout = 0")
+                    lock_wait = time.perf_counter() - wait_start
+                    DB_LOCK_WAIT_SECONDS.inc(lock_wait)
+        except sqlite3.Error as error:
+            if isinstance(error, sqlite3.OperationalError) and is_locked_error(error):
+                DB_LOCK_ERRORS.inc()
+            QUERY_LOG.record(normalize(sql), time.perf_counter() - start, lock_wait, error=True)
+            raise
+
+        duration = time.perf_counter() - start
+        statement = normalize(sql)
+        QUERY_LOG.record(statement, duration, lock_wait)
+        # Lock waits are reported on their own, only slow execution is worth a query plan
+        if duration - lock_wait > QUERY_LOG.slow_seconds:
+            QUERY_LOG.record_slow(statement, duration, self._plan(sql, parameters) if explain else [])
+        return result
+
+    def _plan(self, sql: str, parameters) -> list:
+        """Get EXPLAIN QUERY PLAN lines for a statement, bypassing the instrumentation"""
+        try:
+            rows = sqlite3.Connection.execute(self, "EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+        except sqlite3.Error:
+            return []
+        return [row[-1] for row in rows]
+
+def connect(path: str) -> sqlite3.Connection:
+    """Open an instrumented connection to a SQLite database"""
+    return sqlite3.connect(path, timeout=0, factory=InstrumentedConnection)
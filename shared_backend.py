@@ -0,0 +1,426 @@
+from typing import Any, Callable, Optional
+import asyncio
+import functools
+import pickle
+import sqlite3
+import threading
+import time
+
+from config import SHARED_BUSY_TIMEOUT, SHARED_BUSY_RETRIES, TRAFFIC_CLASSES
+from custom_queue import QueueBackend, QueueMode, Task
+from traffic import DEFAULT_CLASS, class_of
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS queue (
+        sequence INTEGER PRIMARY KEY AUTOINCREMENT,
+        task_id TEXT NOT NULL,
+        priority INTEGER NOT NULL,
+        task BLOB NOT NULL,
+        traffic_class TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_queue_task_id ON queue (task_id);
+    CREATE INDEX IF NOT EXISTS idx_queue_priority ON queue (priority DESC, sequence);
+    CREATE TABLE IF NOT EXISTS claims (
+        task_id TEXT PRIMARY KEY,
+        claim BLOB NOT NULL,
+        updated_at REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS pending (
+        task_id TEXT PRIMARY KEY,
+        done INTEGER NOT NULL DEFAULT 0,
+        result BLOB,
+        created_at REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value REAL NOT NULL
+    );
+'''
+
+# ORDER BY clause and level filter for each queue mode, matching CustomQueue.get
+MODE_ORDER = {
+    QueueMode.PURE_FIFO: "sequence",
+    QueueMode.TWO_LEVEL: "(priority > 0) DESC, sequence",
+    QueueMode.STRICT_PRIORITY: "priority DESC, sequence"
+}
+
+def is_busy(error: sqlite3.OperationalError) -> bool:
+    """Check if an error means another connection held the lock past the busy timeout"""
+    message = str(error)
+    return "locked" in message or "busy" in message
+
+def retry_busy(method):
+    """
+    Retry a method that gave up waiting for another worker's lock
+    Statements run on the event loop, so each wait is kept to SHARED_BUSY_TIMEOUT
+    and a stuck lock stalls requests for SHARED_BUSY_TIMEOUT * SHARED_BUSY_RETRIES at most
+    """
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        for attempt in range(SHARED_BUSY_RETRIES):
+            try:
+                return method(*args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if not is_busy(e) or attempt == SHARED_BUSY_RETRIES - 1:
+                    raise
+    return wrapper
+
+def connect(path: str) -> sqlite3.Connection:
+    """Open a WAL-mode connection to the shared queue database, creating tables if needed"""
+    # Schema setup runs once at startup and may wait for other workers doing the same
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    # Databases created before traffic classes lack the column
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(queue)")]
+    if "traffic_class" not in columns:
+        try:
+            conn.execute("ALTER TABLE queue ADD COLUMN traffic_class TEXT")
+        except sqlite3.OperationalError:
+            # Another worker added it first
+            pass
+    # Rows queued before the column existed are scheduled with the default class
+    conn.execute("UPDATE queue SET traffic_class = ? WHERE traffic_class IS NULL", (DEFAULT_CLASS,))
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_queue_class ON queue (traffic_class, priority DESC, sequence)")
+    conn.execute(f"PRAGMA busy_timeout={int(SHARED_BUSY_TIMEOUT * 1000)}")
+    return conn
+
+class SQLiteTaskQueue(QueueBackend):
+    def __init__(self, path: str, select_limit: int = 256):
+        """
+        Priority queue of Tasks in a SQLite database shared by every worker process
+        Args:
+            path: Path of the shared queue database
+            select_limit: Maximum number of candidates passed to a select callback
+        """
+        self.conn = connect(path)
+        self.select_limit = select_limit
+        self.lock = threading.Lock()
+
+    @retry_busy
+    def put(self, item: Any, priority: int = 0) -> None:
+        """Put a task into the queue with specified priority"""
+        with self.lock:
+            self.conn.execute(
+                'INSERT INTO queue (task_id, priority, task, traffic_class) VALUES (?, ?, ?, ?)',
+                (item.task_id, priority, pickle.dumps(item, pickle.HIGHEST_PROTOCOL), item.traffic_class)
+            )
+
+    @retry_busy
+    def put_many(self, items: list, priority: int = 0) -> None:
+        """Put several tasks into the queue with the same priority in one transaction"""
+        rows = [(item.task_id, priority, pickle.dumps(item, pickle.HIGHEST_PROTOCOL), item.traffic_class)
+                for item in items]
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.conn.executemany(
+                    'INSERT INTO queue (task_id, priority, task, traffic_class) VALUES (?, ?, ?, ?)', rows
+                )
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    @retry_busy
+    def get(self, mode: QueueMode = QueueMode.PURE_FIFO, select: Callable[[list], Optional[int]] = None,
+            classes: list = None) -> Optional[Any]:
+        """Get a task from the queue based on the specified mode, see CustomQueue.get"""
+        order = MODE_ORDER[mode]
+        with self.lock:
+            # IMMEDIATE takes the write lock up front so two workers can't take the same row
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                for traffic_class in (classes if classes is not None else [None]):
+                    task = self._take(mode, order, select, traffic_class)
+                    if task is not None:
+                        break
+                self.conn.execute('COMMIT')
+                return task
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def _take(self, mode: QueueMode, order: str, select, traffic_class: Optional[str]) -> Optional[Any]:
+        """Delete and return the task get() picks from one traffic class (all tasks if None), in its transaction"""
+        base_conditions, base_params = [], []
+        if traffic_class == DEFAULT_CLASS:
+            # Also tasks of a class since removed from the config, like CustomQueue.get
+            base_conditions.append(
+                f'(traffic_class = ? OR traffic_class IS NULL OR traffic_class NOT IN ({",".join("?" * len(TRAFFIC_CLASSES))}))'
+            )
+            base_params += [traffic_class, *TRAFFIC_CLASSES]
+        elif traffic_class is not None:
+            base_conditions.append('traffic_class = ?')
+            base_params.append(traffic_class)
+        # Lower bound on the priority class, moved down while select finds nothing at a level
+        below, below_params = [], []
+        while True:
+            conditions, params = base_conditions + below, base_params + below_params
+            where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+            head = self.conn.execute(
+                f'SELECT sequence, priority, task FROM queue {where} ORDER BY {order} LIMIT 1', params
+            ).fetchone()
+            if head is None:
+                return None
+
+            rows = [head]
+            if select is not None:
+                if mode == QueueMode.TWO_LEVEL:
+                    conditions.append('(priority > 0) = ?')
+                    params.append(head[1] > 0)
+                elif mode == QueueMode.STRICT_PRIORITY:
+                    conditions.append('priority = ?')
+                    params.append(head[1])
+                where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+                rows = self.conn.execute(
+                    f'SELECT sequence, priority, task FROM queue {where} ORDER BY {order} LIMIT ?',
+                    params + [self.select_limit]
+                ).fetchall()
+
+            tasks = [pickle.loads(row[2]) for row in rows]
+            held = [task.held_since for task in tasks]
+            index = 0 if select is None else select(tasks)
+            # select may mark tasks as held back for their size, which must outlive this copy
+            for row, task, held_since in zip(rows, tasks, held):
+                if task.held_since != held_since:
+                    self.conn.execute('UPDATE queue SET task = ? WHERE sequence = ?',
+                                      (pickle.dumps(task, pickle.HIGHEST_PROTOCOL), row[0]))
+            if index is not None:
+                self.conn.execute('DELETE FROM queue WHERE sequence = ?', (rows[index][0],))
+                return tasks[index]
+
+            # Nothing suits this provider at the head's level, try the next one down
+            if mode == QueueMode.STRICT_PRIORITY:
+                below, below_params = ['priority < ?'], [head[1]]
+            elif mode == QueueMode.TWO_LEVEL and head[1] > 0:
+                below, below_params = ['priority <= 0'], []
+            else:
+                return None
+
+    @retry_busy
+    def empty(self) -> bool:
+        """Check if the queue is empty"""
+        with self.lock:
+            return self.conn.execute('SELECT 1 FROM queue LIMIT 1').fetchone() is None
+
+    @retry_busy
+    def qsize(self) -> int:
+        """Get the number of queued tasks across all workers"""
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM queue').fetchone()[0]
+
+    @retry_busy
+    def class_sizes(self) -> dict:
+        """Get the number of queued tasks per traffic class across all workers"""
+        with self.lock:
+            rows = self.conn.execute('SELECT traffic_class, COUNT(*) FROM queue GROUP BY traffic_class').fetchall()
+        sizes = {}
+        for traffic_class, count in rows:
+            name = class_of(traffic_class)
+            sizes[name] = sizes.get(name, 0) + count
+        return sizes
+
+    @retry_busy
+    def remove_task(self, task_id: str) -> bool:
+        """Remove a task and its claim state by its task_id, True if it was still queued"""
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                found = self.conn.execute('DELETE FROM queue WHERE task_id = ?', (task_id,)).rowcount > 0
+                self.conn.execute('DELETE FROM claims WHERE task_id = ?', (task_id,))
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+        return found
+
+    @retry_busy
+    def claim(self, task: Task) -> None:
+        """Publish the task's claim fields for the worker holding the requester"""
+        claim = tuple(getattr(task, field) for field in Task.CLAIM_FIELDS)
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO claims (task_id, claim, updated_at) VALUES (?, ?, ?)',
+                (task.task_id, pickle.dumps(claim, pickle.HIGHEST_PROTOCOL), time.time())
+            )
+
+    @retry_busy
+    def refresh(self, task: Task) -> None:
+        """Load claim fields published by other workers into task"""
+        with self.lock:
+            row = self.conn.execute('SELECT claim FROM claims WHERE task_id = ?', (task.task_id,)).fetchone()
+        if row is None:
+            return
+        for field, value in zip(Task.CLAIM_FIELDS, pickle.loads(row[0])):
+            setattr(task, field, value)
+
+    @retry_busy
+    def touch_last_fetch(self, now: float) -> float:
+        """Record a fetch at now, returning the previous fetch time of any worker"""
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.conn.execute("SELECT value FROM meta WHERE key = 'last_fetch_time'").fetchone()
+                self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_fetch_time', ?)", (now,))
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+        return row[0] if row else 0
+
+    @retry_busy
+    def purge(self, max_age: float) -> None:
+        """Drop claim state of tasks nobody has touched for max_age seconds"""
+        with self.lock:
+            self.conn.execute('DELETE FROM claims WHERE updated_at < ?', (time.time() - max_age,))
+
+class RemoteResult:
+    """Stand-in for a result Future owned by another worker process"""
+    def __init__(self, pending: "SQLitePendingResults", task_id: str):
+        self.pending = pending
+        self.task_id = task_id
+        self._done = False
+
+    def done(self) -> bool:
+        return self._done
+
+    def set_result(self, result) -> None:
+        self._done = True
+        self.pending.publish(self.task_id, result)
+
+class SQLitePendingResults:
+    def __init__(self, path: str, poll_interval: float = 0.02):
+        """
+        Map of task_id -> result Future shared by every worker process
+        Supports the dict operations the handlers use on app.state.pending_results.
+        Futures stay in the worker that created them; a worker submitting a result
+        for another worker's task writes it to the database, and the owner's
+        poll_forever() picks it up and resolves its Future.
+        Args:
+            path: Path of the shared queue database
+            poll_interval: Seconds between checks for results from other workers
+        """
+        self.conn = connect(path)
+        self.poll_interval = poll_interval
+        self.local = {}
+        self.lock = threading.Lock()
+
+    @retry_busy
+    def __setitem__(self, task_id: str, future: asyncio.Future) -> None:
+        self.local[task_id] = future
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO pending (task_id, done, result, created_at) VALUES (?, 0, NULL, ?)',
+                (task_id, time.time())
+            )
+
+    @retry_busy
+    def __contains__(self, task_id: str) -> bool:
+        if task_id in self.local:
+            return True
+        with self.lock:
+            row = self.conn.execute('SELECT 1 FROM pending WHERE task_id = ? AND done = 0', (task_id,)).fetchone()
+        return row is not None
+
+    def __len__(self) -> int:
+        return len(self.local)
+
+    def get(self, task_id: str, default=None):
+        """Get the Future for task_id, a RemoteResult if another worker owns it"""
+        future = self.local.get(task_id)
+        if future is not None:
+            return future
+        if task_id in self:
+            return RemoteResult(self, task_id)
+        return default
+
+    def pop(self, task_id: str, default=None):
+        """Remove a Future owned by this worker, rows of other workers are left to their owner"""
+        future = self.local.pop(task_id, None)
+        if future is None:
+            return default
+        self._delete(task_id)
+        return future
+
+    @retry_busy
+    def _delete(self, task_id: str) -> None:
+        with self.lock:
+            self.conn.execute('DELETE FROM pending WHERE task_id = ?', (task_id,))
+
+    @retry_busy
+    def publish(self, task_id: str, result) -> bool:
+        """
+        Store a result for the worker owning task_id
+        Returns:
+            bool: True if the task was still pending
+        """
+        with self.lock:
+            cursor = self.conn.execute(
+                'UPDATE pending SET done = 1, result = ? WHERE task_id = ? AND done = 0',
+                (pickle.dumps(result, pickle.HIGHEST_PROTOCOL), task_id)
+            )
+        return cursor.rowcount > 0
+
+    @retry_busy
+    def collect(self) -> int:
+        """
+        Resolve local Futures whose results were published by other workers
+        Returns:
+            int: Number of Futures resolved
+        """
+        if not self.local:
+            return 0
+        task_ids = list(self.local)
+        resolved = 0
+        with self.lock:
+            # One transaction, so a retry after a busy error doesn't miss rows already deleted
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                # Stay below SQLite's host parameter limit
+                rows = []
+                for start in range(0, len(task_ids), 500):
+                    chunk = task_ids[start:start + 500]
+                    rows += self.conn.execute(
+                        f'SELECT task_id, result FROM pending WHERE done = 1 AND task_id IN ({",".join("?" * len(chunk))})',
+                        chunk
+                    ).fetchall()
+                for task_id, result in rows:
+                    self.conn.execute('DELETE FROM pending WHERE task_id = ?', (task_id,))
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+        for task_id, result in rows:
+            future = self.local.pop(task_id, None)
+            if future is not None and not future.done():
+                future.set_result(pickle.loads(result))
+                resolved += 1
+        return resolved
+
+    async def poll_forever(self) -> None:
+        """Collect results from other workers every poll_interval"""
+        data_version = None
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            if not self.local:
+                continue
+            # data_version only changes when another connection commits
+            try:
+                with self.lock:
+                    version = self.conn.execute('PRAGMA data_version').fetchone()[0]
+                if version == data_version:
+                    continue
+                self.collect()
+                data_version = version
+            except sqlite3.OperationalError as e:
+                if not is_busy(e):
+                    raise
+                # Still locked after the retries, try again next round
+
+    @retry_busy
+    def purge(self, max_age: float) -> None:
+        """Drop rows of tasks whose owner never cleaned them up, e.g. after a crash"""
+        with self.lock:
+            self.conn.execute('DELETE FROM pending WHERE created_at < ?', (time.time() - max_age,))
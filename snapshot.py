@@ -0,0 +1,298 @@
+from typing import Optional
+import asyncio
+import copy
+import os
+import pickle
+import struct
+import time
+import zlib
+
+from fastapi import FastAPI
+
+from custom_queue import CustomQueue, QueueMode, Task
+from database import get_user_credit
+from handlers import run_job, finish_trace
+from jobs import Job
+from traffic import claim_timeout
+
+MAGIC = b"SAKQ"
+VERSION = 1
+RECORD_HEADER = struct.Struct("<I")
+
+# Snapshot layout: MAGIC, VERSION byte, then a zlib-compressed pickle of
+# {
+#     "saved_at": float,
+#     "sequence_counter": int,
+#     "queued": [(priority, sequence, Task), ...],
+#     "claimed": [Task, ...],
+#     "finished_jobs": [(job_id, owner_id, status, result, error, created_at, finished_at), ...]
+# }
+
+class JournaledQueue(CustomQueue):
+    def __init__(self, path: str, fsync: bool = False):
+        """
+        CustomQueue that appends every change to a journal file, so the queue
+        survives a crash between snapshots
+        Args:
+            path: Path of the journal file
+            fsync: Whether to fsync after every record
+        """
+        super().__init__()
+        self.path = path
+        self.fsync = fsync
+        self.journal = open(path, "ab")
+
+    def _append(self, record: tuple) -> None:
+        if self.journal is None:
+            return
+        data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        self.journal.write(RECORD_HEADER.pack(len(data)) + data)
+        self.journal.flush()
+        if self.fsync:
+            os.fsync(self.journal.fileno())
+
+    def put(self, item, priority: int = 0) -> None:
+        sequence = self.sequence_counter
+        super().put(item, priority)
+        self._append(("put", priority, sequence, item))
+
+    def put_many(self, items: list, priority: int = 0) -> None:
+        sequence = self.sequence_counter
+        super().put_many(items, priority)
+        for offset, item in enumerate(items):
+            self._append(("put", priority, sequence + offset, item))
+
+    def remove_task(self, task_id: str) -> bool:
+        found = super().remove_task(task_id)
+        self._append(("remove", task_id))
+        return found
+
+    def claim(self, task: Task) -> None:
+        # A task leaves the queue in the journal when it is claimed, not when get() returns it,
+        # fetch_task drops expired tasks without handing them out
+        self._append(("claim", task.task_id, tuple(getattr(task, field) for field in Task.CLAIM_FIELDS)))
+
+    def offset(self) -> int:
+        """Get the journal position, records after it are not in a snapshot collected now"""
+        return self.journal.tell()
+
+    def truncate(self, offset: int = None) -> None:
+        """
+        Drop journal records, called right after a snapshot was written
+        Args:
+            offset: Keep the records written after this offset(), None drops them all
+        """
+        if self.journal is None:
+            return
+        tail = b""
+        if offset is not None:
+            with open(self.path, "rb") as f:
+                f.seek(offset)
+                tail = f.read()
+        self.journal.truncate(0)
+        self.journal.seek(0)
+        self.journal.write(tail)
+        self.journal.flush()
+
+    def close(self) -> None:
+        """Stop journaling, cleanup by tasks cancelled during shutdown must not reach the journal"""
+        self.journal.close()
+        self.journal = None
+
+def collect_snapshot(app: FastAPI) -> dict:
+    """
+    Copy the queue, claimed tasks and finished jobs into a snapshot state
+    Tasks are copied so write_snapshot can pickle them off the event loop
+    Returns:
+        dict: State in the snapshot layout above
+    """
+    queue = app.state.task_queue
+    queued = [(priority, sequence, _copy_task(task)) for priority, sequence, task in queue.snapshot_items()]
+    queued_ids = {item[2].task_id for item in queued}
+    claimed = [_copy_task(task) for task_id, task in app.state.claimed_tasks.items() if task_id not in queued_ids]
+
+    # Unfinished jobs are restored from their tasks, finished ones keep their results
+    finished_jobs = sorted(
+        ((job.job_id, job.owner_id, job.status, job.result, job.error, job.created_at, job.finished_at)
+         for job in app.state.job_store.jobs.values() if job.finished_at is not None),
+        key=lambda row: row[6]
+    )
+
+    return {
+        "saved_at": time.time(),
+        "sequence_counter": queue.sequence_counter,
+        "queued": queued,
+        "claimed": claimed,
+        "finished_jobs": finished_jobs
+    }
+
+def _copy_task(task: Task) -> Task:
+    copied = copy.copy(task)
+    if copied.trace is not None:
+        copied.trace = list(copied.trace)
+    return copied
+
+def write_snapshot(state: dict, path: str) -> int:
+    """
+    Write a state from collect_snapshot to path atomically
+    Returns:
+        int: Size of the snapshot in bytes
+    """
+    data = MAGIC + bytes([VERSION]) + zlib.compress(pickle.dumps(state, pickle.HIGHEST_PROTOCOL), 1)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return len(data)
+
+def save_snapshot(app: FastAPI, path: str) -> int:
+    """
+    Write the queue, claimed tasks and finished jobs to path atomically
+    Returns:
+        int: Size of the snapshot in bytes
+    """
+    return write_snapshot(collect_snapshot(app), path)
+
+def load_snapshot(path: str) -> Optional[dict]:
+    """Read a snapshot written by save_snapshot, None if missing or unreadable"""
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    # A file cut short before its header counts as no snapshot
+    if len(data) < 5 or data[:4] != MAGIC or data[4] != VERSION:
+        return None
+    return pickle.loads(zlib.decompress(data[5:]))
+
+def replay_journal(path: str, state: Optional[dict]) -> Optional[dict]:
+    """Apply journal records written after the snapshot to its state"""
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return state
+    if not data:
+        return state
+
+    state = state or {"saved_at": time.time(), "sequence_counter": 0, "queued": [], "claimed": [], "finished_jobs": []}
+    queued = {task.task_id: (priority, sequence, task) for priority, sequence, task in state["queued"]}
+    claimed = {task.task_id: task for task in state["claimed"]}
+    sequence_counter = state["sequence_counter"]
+
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        (length,) = RECORD_HEADER.unpack_from(data, offset)
+        start = offset + RECORD_HEADER.size
+        if start + length > len(data):
+            break  # Torn write at crash time
+        record = pickle.loads(data[start:start + length])
+        offset = start + length
+
+        kind = record[0]
+        if kind == "put":
+            _, priority, sequence, task = record
+            queued[task.task_id] = (priority, sequence, task)
+            claimed.pop(task.task_id, None)
+            sequence_counter = max(sequence_counter, sequence + 1)
+        elif kind == "take":
+            # Written by older versions on every get()
+            entry = queued.pop(record[1], None)
+            if entry is not None:
+                claimed[record[1]] = entry[2]
+        elif kind == "claim":
+            task = claimed.get(record[1])
+            if task is None and record[1] in queued:
+                task = queued.pop(record[1])[2]
+                claimed[record[1]] = task
+            if task is not None:
+                for field, value in zip(Task.CLAIM_FIELDS, record[2]):
+                    setattr(task, field, value)
+        elif kind == "remove":
+            queued.pop(record[1], None)
+            claimed.pop(record[1], None)
+
+    state["queued"] = sorted(queued.values(), key=lambda entry: entry[1])
+    state["claimed"] = list(claimed.values())
+    state["sequence_counter"] = sequence_counter
+    return state
+
+async def run_orphan(app: FastAPI, task: Task, result_future: asyncio.Future):
+    """
+    Accept the result of a restored claimed chat task until its claim times out
+    The requester's connection did not survive the restart, so the result is dropped
+    and the task is never re-queued
+    """
+    outcome = "cancelled"
+    try:
+        await asyncio.wait_for(result_future, timeout=claim_timeout(task.traffic_class))
+        outcome = "completed"
+    except asyncio.TimeoutError:
+        outcome = "timeout"
+    finally:
+        app.state.pending_results.pop(task.task_id, None)
+        app.state.claimed_tasks.pop(task.task_id, None)
+        app.state.task_queue.remove_task(task.task_id)
+        finish_trace(app, task, outcome)
+
+def restore_snapshot(app: FastAPI, state: dict) -> int:
+    """
+    Load snapshot state into a freshly started app
+    Queued jobs keep their priority and order, claimed tasks can still be submitted.
+    Queued chat tasks are dropped, nobody is waiting for their result any more
+    Returns:
+        int: Number of tasks restored
+    """
+    queued = [entry for entry in state["queued"] if entry[2].is_job]
+    app.state.task_queue.restore_items(queued, state["sequence_counter"])
+    for task in state["claimed"]:
+        app.state.claimed_tasks[task.task_id] = task
+
+    for job_id, owner_id, status, result, error, created_at, finished_at in state["finished_jobs"]:
+        job = Job(job_id, owner_id, None)
+        job.status, job.result, job.error = status, result, error
+        job.created_at, job.finished_at = created_at, finished_at
+        app.state.job_store.restore(job)
+
+    # Every restored task needs a waiter to resolve and clean it up
+    priorities = {task.task_id: priority for priority, _, task in queued}
+    credits = {}
+    for task in [entry[2] for entry in queued] + state["claimed"]:
+        result_future = asyncio.Future()
+        app.state.pending_results[task.task_id] = result_future
+        task.trace_event("restored")
+        if task.is_job:
+            priority = priorities.get(task.task_id)
+            if priority is None:
+                if task.requester_id not in credits:
+                    credits[task.requester_id] = get_user_credit(task.requester_id)
+                priority = credits[task.requester_id]
+            job = Job(task.task_id, task.requester_id, task, task.callback_url)
+            job.created_at = task.created_at
+            app.state.job_store.restore(job)
+            job.runner = asyncio.create_task(run_job(app, job, result_future, priority))
+        else:
+            asyncio.create_task(run_orphan(app, task, result_future))
+
+    return len(queued) + len(state["claimed"])
+
+async def snapshot_periodically(app: FastAPI, path: str, interval: float):
+    """Write a snapshot every interval seconds, keeping the journal short"""
+    while True:
+        await asyncio.sleep(interval)
+        queue = app.state.task_queue
+        journaled = isinstance(queue, JournaledQueue)
+        # State is copied on the event loop, pickling and fsync run in a thread
+        state = collect_snapshot(app)
+        offset = queue.offset() if journaled else None
+        writing = asyncio.ensure_future(asyncio.to_thread(write_snapshot, state, path))
+        try:
+            await asyncio.shield(writing)
+        except asyncio.CancelledError:
+            # Let the write finish so it cannot replace the final snapshot taken at shutdown
+            await writing
+            raise
+        if journaled:
+            queue.truncate(offset)
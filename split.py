@@ -0,0 +1,149 @@
+from typing import Optional
+import math
+import re
+
+from config import SPLIT_ENABLED, SPLIT_MIN_CHARS, SPLIT_PIECE_CHARS, SPLIT_MAX_PIECES, SPLIT_TEXT_MARKERS
+from utils import json_loads
+
+# Header a requester sets to opt in: "auto" for SPLIT_PIECE_CHARS, or the characters per piece
+SPLIT_HEADER = "X-Split"
+
+# Paragraph breaks, kept so the translated pieces are joined the same way
+_BREAKS = re.compile(r"(\n+)")
+
+class SplitPieceError(Exception):
+    def __init__(self, result):
+        """A piece still failed after SPLIT_PIECE_TRIES, result is the provider's error completion"""
+        super().__init__("split piece failed")
+        self.result = result
+
+def parse_split(value: Optional[str]) -> Optional[int]:
+    """
+    Read the X-Split header
+    Returns:
+        int: Target characters per piece, None if the request is not to be split
+    Raises:
+        ValueError: If the value is neither "auto" nor a positive integer
+    """
+    if value is None or not SPLIT_ENABLED:
+        return None
+    value = value.strip().lower()
+    if value == "auto":
+        return SPLIT_PIECE_CHARS
+    if not value.isdigit() or int(value) == 0:
+        raise ValueError(f"{SPLIT_HEADER} must be \"auto\" or the number of characters per piece")
+    return int(value)
+
+def pack(paragraphs: list, piece_chars: int, max_pieces: int) -> list:
+    """
+    Group paragraphs into runs of about piece_chars characters, a longer paragraph stays whole
+    Paragraphs that don't fill a run can leave up to twice as many runs as piece_chars implies,
+    so the neighbouring runs with the fewest characters together are merged until max_pieces remain
+    """
+    pieces = [[]]
+    sizes = [0]
+    for paragraph in paragraphs:
+        if pieces[-1] and sizes[-1] + len(paragraph) > piece_chars:
+            pieces.append([])
+            sizes.append(0)
+        pieces[-1].append(paragraph)
+        sizes[-1] += len(paragraph)
+    while len(pieces) > max_pieces:
+        i = min(range(len(pieces) - 1), key=lambda i: sizes[i] + sizes[i + 1])
+        pieces[i:i + 2] = [pieces[i] + pieces[i + 1]]
+        sizes[i:i + 2] = [sizes[i] + sizes[i + 1]]
+    return pieces
+
+class SplitRequest:
+    def __init__(self, request_body: dict, piece_chars: int):
+        """
+        Split the text of a chat request's last message into paragraph-aligned pieces
+        Every piece keeps the earlier messages (system prompt) and the instruction in front
+        of the text, which carries the glossary, up to and including the last of
+        SPLIT_TEXT_MARKERS. max_tokens is shared out by piece length.
+        Args:
+            request_body: Parsed chat request
+            piece_chars: Target characters per piece, raised to stay within SPLIT_MAX_PIECES
+        """
+        self.bodies = []
+        # Paragraph breaks between consecutive pieces
+        self.separators = []
+
+        messages = request_body.get("messages")
+        if request_body.get("stream") or not isinstance(messages, list) or not messages \
+                or not isinstance(messages[-1], dict) or messages[-1].get("role") != "user":
+            return
+        content = messages[-1].get("content")
+        if not isinstance(content, str):
+            return
+
+        prefix, text = "", content
+        for marker in SPLIT_TEXT_MARKERS:
+            at = content.rfind(marker)
+            if at >= 0 and at + len(marker) > len(prefix):
+                prefix, text = content[:at + len(marker)], content[at + len(marker):]
+        if len(text) < SPLIT_MIN_CHARS:
+            return
+
+        # Alternating paragraph, break, paragraph, ... with the text's leading and trailing breaks dropped
+        parts = _BREAKS.split(text.strip("\n"))
+        paragraphs, breaks = parts[::2], parts[1::2]
+        piece_chars = max(piece_chars, math.ceil(len(text) / SPLIT_MAX_PIECES))
+        groups = pack(paragraphs, piece_chars, SPLIT_MAX_PIECES)
+        if len(groups) < 2:
+            return
+
+        max_tokens = request_body.get("max_tokens")
+        index = 0
+        for group in groups:
+            piece = "".join(paragraph + breaks[index + i] for i, paragraph in enumerate(group[:-1])) + group[-1]
+            index += len(group)
+            if index <= len(breaks):
+                self.separators.append(breaks[index - 1])
+            body = dict(request_body, messages=messages[:-1] + [dict(messages[-1], content=prefix + piece)])
+            if isinstance(max_tokens, int) and max_tokens > 0:
+                body["max_tokens"] = max(1, math.ceil(max_tokens * len(piece) / len(text)))
+            self.bodies.append(body)
+
+    def __len__(self) -> int:
+        return len(self.bodies)
+
+    def merge(self, results: list) -> dict:
+        """
+        Join the pieces' completions, in order, into one chat completion
+        The first piece's completion gives id, model and the other top level fields,
+        usage is summed and finish_reason is "length" if any piece was cut off
+        """
+        completions = [piece_completion(result) for result in results]
+        contents = [completion["choices"][0]["message"]["content"].strip("\n") for completion in completions]
+        text = contents[0] + "".join(separator + content for separator, content in zip(self.separators, contents[1:]))
+
+        reasons = [completion["choices"][0].get("finish_reason") for completion in completions]
+        merged = {key: value for key, value in completions[0].items() if key not in ("timings", "usage")}
+        merged["choices"] = [{
+            "index": 0,
+            "message": {"role": "assistant", "content": text},
+            "finish_reason": "length" if "length" in reasons else reasons[0]
+        }]
+        usages = [completion.get("usage") for completion in completions]
+        if all(isinstance(usage, dict) for usage in usages):
+            merged["usage"] = {
+                key: sum(usage.get(key) or 0 for usage in usages)
+                for key in ("prompt_tokens", "completion_tokens", "total_tokens")
+            }
+        return merged
+
+def piece_completion(result) -> Optional[dict]:
+    """Parse a piece's result, None if it is an error or has no message content to join"""
+    if isinstance(result, bytes):
+        try:
+            result = json_loads(result)
+        except ValueError:
+            return None
+    if not isinstance(result, dict) or "error" in result:
+        return None
+    choices = result.get("choices")
+    if not isinstance(choices, list) or not choices or not isinstance(choices[0], dict) \
+            or not isinstance((choices[0].get("message") or {}).get("content"), str):
+        return None
+    return result
@@ -1,12 +1,41 @@
 import textwrap
 from telegram import Update
 from telegram.ext import Application, CommandHandler
-from database import create_or_update_user, refresh_user_token, get_user_info, get_top_contributors, get_top_credits, get_top_total_usage, get_top_daily_usage
+from database import create_or_update_user, refresh_user_token
+from caches import UserInfoCache, LeaderboardSnapshot
+from config import USER_CACHE_TTL, LEADERBOARD_TTL
+from statistics import median
 import asyncio
+import fcntl
+import time
+
+def acquire_bot_lock(path: str):
+    """
+    Take an exclusive lock so only one gateway worker polls Telegram
+    Returns:
+        file: The locked file, keep it open while the bot runs, None if another process holds the lock
+    """
+    lock_file = open(path, "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
 
 class TelegramBot:
-    def __init__(self, token: str):
-        self.application = Application.builder().token(token).build()
+    def __init__(self, token: str, app=None):
+        """
+        Args:
+            token: Bot token
+            app: Gateway FastAPI app when running inside its lifespan, enables live queue commands
+        """
+        self.app = app
+        # Only the bot's commands read these, the gateway authenticates against the database
+        self.user_cache = UserInfoCache(USER_CACHE_TTL)
+        self.leaderboards = LeaderboardSnapshot(LEADERBOARD_TTL)
+        # post_init only runs in standalone mode (run_polling), start() sets commands itself
+        self.application = Application.builder().token(token).post_init(self.post_init).build()
         
         # Add command handlers
         self.application.add_handler(CommandHandler("start", self.help_command))
@@ -15,6 +44,8 @@ class TelegramBot:
         self.application.add_handler(CommandHandler("refresh", self.refresh_command))
         self.application.add_handler(CommandHandler("userdata", self.userdata_command))
         self.application.add_handler(CommandHandler("globaldata", self.globaldata_command))
+        if app is not None:
+            self.application.add_handler(CommandHandler("queue", self.queue_command))
 
     async def set_commands(self):
         """Set the bot's command list that appears in the menu"""
@@ -25,12 +56,28 @@ class TelegramBot:
             ("userdata", "查看自己的数据"),
             ("globaldata", "查看全局统计")
         ]
+        if self.app is not None:
+            commands.append(("queue", "查看当前队列与预计等待时间"))
         await self.application.bot.set_my_commands(commands)
 
-    async def run(self):
-        # Set commands before starting the bot
+    async def post_init(self, application: Application):
+        await self.set_commands()
+
+    def run(self):
+        """Run standalone, blocking until interrupted"""
+        self.application.run_polling()
+
+    async def start(self):
+        """Start polling on the running event loop, e.g. inside the gateway's lifespan"""
+        await self.application.initialize()
         await self.set_commands()
-        await self.application.run_polling()
+        await self.application.start()
+        await self.application.updater.start_polling()
+
+    async def stop(self):
+        await self.application.updater.stop()
+        await self.application.stop()
+        await self.application.shutdown()
 
     async def help_command(self, update: Update, context):
         # Create help message with all available commands
@@ -42,6 +89,8 @@ class TelegramBot:
         /userdata - 查看自己的数据
         /globaldata - 查看全局统计
         """)
+        if self.app is not None:
+            help_text += "/queue - 查看当前队列与预计等待时间\n"
         # Send help message to user
         await update.message.reply_text(help_text)
 
@@ -58,8 +107,9 @@ class TelegramBot:
         if update.effective_user.last_name:
             display_name += f" {update.effective_user.last_name}"
         
-        # Create or update user and get token
-        token = create_or_update_user(user_id, display_name)
+        # Create or update user and get token, off the event loop the gateway shares
+        token = await asyncio.to_thread(create_or_update_user, user_id, display_name)
+        self.user_cache.invalidate(user_id)
         
         # Generate access URL
         access_url = f"https://sakura-share.one/{user_id}-{token}"
@@ -87,7 +137,8 @@ class TelegramBot:
         user_id = update.effective_user.id
         
         # Refresh token
-        new_token = refresh_user_token(user_id)
+        new_token = await asyncio.to_thread(refresh_user_token, user_id)
+        self.user_cache.invalidate(user_id)
         
         if new_token is None:
             await update.message.reply_text("❌ 请先使用 /register 注册账户！")
@@ -113,8 +164,8 @@ class TelegramBot:
         # Get user ID
         user_id = update.effective_user.id
         
-        # Get user info from database
-        user_info = get_user_info(user_id)
+        # Get user info, from memory if looked up recently
+        user_info = await asyncio.to_thread(self.user_cache.get, user_id)
         
         if user_info is None:
             await update.message.reply_text("❌ 请先使用 /register 注册账户！")
@@ -134,15 +185,26 @@ class TelegramBot:
         • 今日使用：{user_info['daily_usage']}
         """)
         
+        # Recent history from the gateway's usage store, only when running inside the gateway
+        if self.app is not None:
+            now = time.time()
+            usage = self.app.state.usage
+            requested = sum(row["requests"] for row in
+                            await asyncio.to_thread(usage.query, "requester", now - 7 * 86400, now, "day", user_id))
+            provided = sum(row["requests"] for row in
+                           await asyncio.to_thread(usage.query, "provider", now - 7 * 86400, now, "day", user_id))
+            user_data_text += f"• 近7日请求：{requested}\n• 近7日提供：{provided}\n"
+        
         # Send message with markdown parsing enabled
         await update.message.reply_text(user_data_text, parse_mode="Markdown")
     
     async def globaldata_command(self, update: Update, context):
-        # Get top 5 users for each category
-        top_contributors = get_top_contributors(5)
-        top_credits = get_top_credits(5)
-        top_total_usage = get_top_total_usage(5)
-        top_daily_usage = get_top_daily_usage(5)
+        # Get top 5 users for each category, from the shared snapshot
+        rankings = await asyncio.to_thread(self.leaderboards.get)
+        top_contributors = rankings["contributors"]
+        top_credits = rankings["credits"]
+        top_total_usage = rankings["total_usage"]
+        top_daily_usage = rankings["daily_usage"]
         
         # Format rankings into text
         def format_ranking(title: str, data: list, unit: str = "") -> str:
@@ -167,9 +229,33 @@ class TelegramBot:
         # Send message
         await update.message.reply_text(global_stats)
     
+    async def queue_command(self, update: Update, context):
+        # Live state of this gateway worker
+        state = self.app.state
+        depth = state.task_queue.qsize()
+        claimed = list(state.claimed_tasks.values())
+        providers = len({task.provider_id for task in claimed})
+        
+        # Estimate the wait of a new request from recent claim-to-submit times
+        samples = list(state.hedger.samples)
+        if samples and providers:
+            eta = f"约 {(depth + 1) * median(samples) / providers:.0f} 秒"
+        else:
+            eta = "暂无数据"
+        
+        queue_text = textwrap.dedent(f"""
+        🚦 当前队列
+
+        • 排队任务：{depth}
+        • 处理中任务：{len(claimed)}
+        • 在线提供者：{providers}
+        • 新请求预计等待：{eta}
+        """)
+        
+        await update.message.reply_text(queue_text)
+    
     
 
 if __name__ == "__main__":
     bot = TelegramBot("7866348862:AAGTbajWm4aV4gqHTSyh94gImIZ8rGHP2_I")
-    bot.set_commands()
-    bot.application.run_polling()
\ No newline at end of file
+    bot.run()
\ No newline at end of file
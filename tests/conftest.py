@@ -0,0 +1,13 @@
+import os
+import sys
+
+# The gateway's modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from custom_queue import Task
+
+def make_task(task_id: str, prompt_tokens: int = 0, generation_tokens: int = 0, created_at: float = None,
+              **fields) -> Task:
+    """Build a task owned by requester 1, fields are passed on to Task"""
+    return Task({"messages": [{"role": "user", "content": task_id}]}, 1, task_id, created_at=created_at,
+                prompt_tokens=prompt_tokens, generation_tokens=generation_tokens, **fields)
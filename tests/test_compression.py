@@ -0,0 +1,46 @@
+import gzip
+
+import pytest
+
+from compression import Codecs
+
+@pytest.fixture
+def codecs():
+    return Codecs()
+
+def test_gzip_round_trip(codecs):
+    data = b'{"messages":[]}' * 100
+    assert codecs.decompress("gzip", codecs.compress("gzip", data), len(data)) == data
+
+def test_gzip_limit_is_inclusive(codecs):
+    data = b"a" * 1000
+    body = gzip.compress(data)
+    assert codecs.decompress("gzip", body, 1000) == data
+    with pytest.raises(ValueError, match="too large"):
+        codecs.decompress("gzip", body, 999)
+
+def test_gzip_bomb_is_stopped_at_the_limit(codecs):
+    body = gzip.compress(b"\0" * (64 * 1024 * 1024))
+    with pytest.raises(ValueError, match="too large"):
+        codecs.decompress("gzip", body, 1024 * 1024)
+
+def test_corrupt_gzip_is_a_value_error(codecs):
+    with pytest.raises(ValueError, match="Invalid gzip"):
+        codecs.decompress("gzip", b"not gzip at all", 1024)
+
+def test_negotiate(codecs):
+    assert codecs.negotiate("gzip, deflate") == "gzip"
+    assert codecs.negotiate("gzip;q=0, br") is None
+    assert codecs.negotiate("identity") is None
+
+def test_zstd_limit_ignores_the_declared_content_size():
+    zstandard = pytest.importorskip("zstandard")
+    codecs = Codecs()
+    data = b"b" * 1000
+    assert codecs.decompress("zstd", codecs.compress("zstd", data), 1000) == data
+    # A frame claiming to be small must still be cut off at the limit
+    body = zstandard.ZstdCompressor(write_content_size=False).compress(b"\0" * (16 * 1024 * 1024))
+    with pytest.raises(ValueError, match="too large"):
+        codecs.decompress("zstd", body, 1024 * 1024)
+    with pytest.raises(ValueError, match="Invalid zstd"):
+        codecs.decompress("zstd", b"not zstd", 1024)
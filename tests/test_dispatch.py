@@ -0,0 +1,107 @@
+import time
+
+import pytest
+
+from config import SMALL_TASK_TOKENS, SIZE_HEAD_MAX_WAIT, SIZE_HOLD_SECONDS
+from conftest import make_task
+from custom_queue import CustomQueue, QueueMode
+from dispatch import FleetCapacity, can_finish, parse_capacity, select_task
+from shared_backend import SQLiteTaskQueue
+from traffic import claim_timeout
+
+def test_parse_capacity_keeps_positive_numbers():
+    assert parse_capacity({"n_ctx": 4096, "tokens_per_second": 0, "extra": 1}) == {"n_ctx": 4096}
+    assert parse_capacity({"n_ctx": True}) == {}
+    assert parse_capacity(None) == {}
+
+def test_can_finish_checks_context_and_claim_timeout():
+    now = time.time()
+    assert can_finish(make_task("a", 100, 100, now), {"n_ctx": 4096}, now)
+    assert not can_finish(make_task("b", 4000, 200, now), {"n_ctx": 4096}, now)
+    # Estimated seconds: prompt / PREFILL_SPEEDUP + generation, at 1 token per second
+    slow = {"tokens_per_second": 1}
+    assert not can_finish(make_task("c", 0, int(claim_timeout("interactive")) + 1, now), slow, now)
+    assert can_finish(make_task("d", 0, 10, now), slow, now)
+
+def test_can_finish_respects_deadline():
+    now = time.time()
+    task = make_task("a", 0, 100, now, deadline=now + 50)
+    assert not can_finish(task, {"tokens_per_second": 1}, now)
+    assert can_finish(task, {"tokens_per_second": 10}, now)
+
+def test_can_finish_releases_a_held_back_task():
+    now = time.time()
+    task = make_task("a", 8000, 200, now)
+    assert not can_finish(task, {"n_ctx": 4096}, now)
+    assert task.held_since == now
+    assert not can_finish(task, {"n_ctx": 4096}, now + SIZE_HOLD_SECONDS - 1)
+    assert can_finish(task, {"n_ctx": 4096}, now + SIZE_HOLD_SECONDS)
+
+def test_can_finish_keeps_holding_while_the_fleet_can_run_the_task():
+    now = time.time()
+    fleet = FleetCapacity(60)
+    fleet.record(3, {"n_ctx": 16384}, now)
+    task = make_task("a", 8000, 200, now)
+    assert not can_finish(task, {"n_ctx": 4096}, now, fleet)
+    assert not can_finish(task, {"n_ctx": 4096}, now + SIZE_HOLD_SECONDS, fleet)
+    # The big provider stopped fetching, nobody else can run the task
+    assert can_finish(task, {"n_ctx": 4096}, now + 61, fleet)
+
+def test_can_finish_refuses_an_old_task_never_held_back():
+    now = time.time()
+    # Waiting in a backlog is not being held back, the task never met a provider too small for it
+    task = make_task("a", 8000, 200, now - 10 * SIZE_HOLD_SECONDS)
+    assert not can_finish(task, {"n_ctx": 4096}, now)
+    assert can_finish(task, {"n_ctx": 16384}, now)
+
+def test_select_task_prefers_small_tasks_while_the_head_has_slack():
+    now = time.time()
+    tasks = [make_task("big", 500, 500, now), make_task("small", 10, 10, now), make_task("smaller", 5, 5, now)]
+    assert select_task(tasks, 2, {}, now) == 2
+
+def test_select_task_keeps_the_head_when_nothing_is_small():
+    now = time.time()
+    size = SMALL_TASK_TOKENS
+    tasks = [make_task("a", size, size, now), make_task("b", size, size, now)]
+    assert select_task(tasks, 2, {}, now) == 0
+
+def test_select_task_yields_to_a_head_running_out_of_time():
+    now = time.time()
+    # A chat task expires one claim timeout after it was created
+    head = make_task("head", 500, 500, now - claim_timeout("interactive") + 5)
+    tasks = [head, make_task("small", 10, 10, now)]
+    assert select_task(tasks, 2, {}, now) == 0
+
+def test_select_task_takes_a_requeued_head_that_waited_too_long():
+    now = time.time()
+    head = make_task("requeued", 500, 500, now - SIZE_HEAD_MAX_WAIT)
+    # A chat task re-queued after its second claim never expires
+    head.try_count = 2
+    assert head.expires_at() is None
+    assert select_task([head, make_task("small", 10, 10, now)], 2, {}, now) == 0
+    head.created_at = now - SIZE_HEAD_MAX_WAIT + 5
+    assert select_task([head, make_task("small", 10, 10, now)], 2, {}, now) == 1
+
+def test_select_task_skips_tasks_the_provider_cannot_fit():
+    now = time.time()
+    tasks = [make_task("big", 3000, 3000, now), make_task("fits", 300, 300, now)]
+    assert select_task(tasks, 2, {"n_ctx": 2048}, now) == 1
+    assert select_task(tasks[:1], 2, {"n_ctx": 2048}, now) is None
+
+@pytest.fixture(params=["memory", "sqlite"])
+def queue(request, tmp_path):
+    if request.param == "memory":
+        return CustomQueue()
+    return SQLiteTaskQueue(str(tmp_path / "queue.db"))
+
+@pytest.mark.parametrize("mode", [QueueMode.TWO_LEVEL, QueueMode.STRICT_PRIORITY])
+def test_get_falls_through_to_a_lower_level(queue, mode):
+    now = time.time()
+    queue.put(make_task("high", 3000, 3000, now), 2)
+    queue.put(make_task("middle", 3000, 3000, now), 1)
+    queue.put(make_task("low", 300, 300, now), 0)
+    capacity = {"n_ctx": 2048}
+    task = queue.get(mode, lambda tasks: select_task(tasks, 2, capacity, now))
+    assert task.task_id == "low"
+    assert queue.get(mode, lambda tasks: select_task(tasks, 2, capacity, now)) is None
+    assert queue.qsize() == 2
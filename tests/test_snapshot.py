@@ -0,0 +1,115 @@
+import asyncio
+import time
+import types
+
+from conftest import make_task
+from custom_queue import CustomQueue
+from jobs import Job, JobStore
+from snapshot import JournaledQueue, load_snapshot, replay_journal, restore_snapshot, save_snapshot
+
+def make_app(queue=None):
+    return types.SimpleNamespace(state=types.SimpleNamespace(
+        task_queue=queue if queue is not None else CustomQueue(),
+        claimed_tasks={},
+        pending_results={},
+        job_store=JobStore()
+    ))
+
+def test_save_and_load_round_trip(tmp_path):
+    app = make_app()
+    app.state.task_queue.put(make_task("low"), 0)
+    app.state.task_queue.put(make_task("high", traffic_class="bulk"), 5)
+    claimed = make_task("claimed", provider_id=2, claimed_at=time.time())
+    app.state.claimed_tasks["claimed"] = claimed
+    job = Job("done", 1, None)
+    job.status, job.result, job.finished_at = "completed", {"ok": 1}, time.time()
+    app.state.job_store.restore(job)
+
+    path = str(tmp_path / "queue.snapshot")
+    assert save_snapshot(app, path) > 0
+    state = load_snapshot(path)
+    queued = sorted(state["queued"], key=lambda entry: entry[1])
+    assert [(priority, task.task_id) for priority, _, task in queued] == [(0, "low"), (5, "high")]
+    assert queued[1][2].traffic_class == "bulk"
+    assert [task.task_id for task in state["claimed"]] == ["claimed"]
+    assert state["claimed"][0].provider_id == 2
+    assert state["sequence_counter"] == 2
+    assert [row[0] for row in state["finished_jobs"]] == ["done"]
+
+def test_missing_short_or_foreign_files_are_no_snapshot(tmp_path):
+    path = tmp_path / "queue.snapshot"
+    assert load_snapshot(str(path)) is None
+    for data in (b"", b"SAK", b"SAKQ", b"NOPE\x01data"):
+        path.write_bytes(data)
+        assert load_snapshot(str(path)) is None
+
+def test_journal_replays_changes_after_the_snapshot(tmp_path):
+    path = str(tmp_path / "queue.journal")
+    queue = JournaledQueue(path)
+    queue.put(make_task("a"), 1)
+    queue.put_many([make_task("b"), make_task("c")], 0)
+    taken = queue.get()
+    taken.provider_id = 7
+    queue.claim(taken)
+    queue.remove_task("c")
+    queue.close()
+
+    state = replay_journal(path, None)
+    assert [task.task_id for _, _, task in state["queued"]] == ["b"]
+    assert [(task.task_id, task.provider_id) for task in state["claimed"]] == [("a", 7)]
+    assert state["sequence_counter"] == 3
+
+def test_journal_keeps_tasks_taken_but_never_claimed_queued(tmp_path):
+    path = str(tmp_path / "queue.journal")
+    queue = JournaledQueue(path)
+    queue.put(make_task("expired"))
+    queue.put(make_task("claimed"))
+    assert queue.get().task_id == "expired"
+    queue.claim(queue.get())
+    queue.close()
+
+    state = replay_journal(path, None)
+    assert [task.task_id for _, _, task in state["queued"]] == ["expired"]
+    assert [task.task_id for task in state["claimed"]] == ["claimed"]
+
+def test_truncate_keeps_records_written_after_the_offset(tmp_path):
+    path = str(tmp_path / "queue.journal")
+    queue = JournaledQueue(path)
+    queue.put(make_task("before"))
+    offset = queue.offset()
+    queue.put(make_task("after"))
+    queue.truncate(offset)
+    queue.put(make_task("later"))
+    queue.close()
+    assert [task.task_id for _, _, task in replay_journal(path, None)["queued"]] == ["after", "later"]
+
+def test_journal_torn_write_is_ignored(tmp_path):
+    path = tmp_path / "queue.journal"
+    queue = JournaledQueue(str(path))
+    queue.put(make_task("a"))
+    queue.close()
+    path.write_bytes(path.read_bytes() + b"\x40\x00\x00\x00partial")
+    assert [task.task_id for _, _, task in replay_journal(str(path), None)["queued"]] == ["a"]
+
+def test_restore_drops_queued_chat_tasks():
+    async def restore():
+        app = make_app()
+        claimed = make_task("claimed", provider_id=2, claimed_at=time.time())
+        state = {
+            "saved_at": time.time(),
+            "sequence_counter": 5,
+            "queued": [(0, 3, make_task("queued"))],
+            "claimed": [claimed],
+            "finished_jobs": []
+        }
+        restored = restore_snapshot(app, state)
+        waiters = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        result = (restored, app.state.task_queue.qsize(), set(app.state.claimed_tasks), set(app.state.pending_results))
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        return result
+
+    restored, queued, claimed, pending = asyncio.run(restore())
+    assert restored == 1 and queued == 0
+    assert claimed == {"claimed"} and pending == {"claimed"}
@@ -0,0 +1,93 @@
+import math
+
+import pytest
+
+from config import SPLIT_MAX_PIECES, SPLIT_MIN_CHARS, SPLIT_PIECE_CHARS, SPLIT_TEXT_MARKERS
+from split import SplitRequest, pack, parse_split, piece_completion
+from utils import json_dumps
+
+MARKER = SPLIT_TEXT_MARKERS[0]
+
+def chat_body(text: str, **fields) -> dict:
+    return dict({
+        "messages": [
+            {"role": "system", "content": "system prompt"},
+            {"role": "user", "content": "glossary" + MARKER + text}
+        ]
+    }, **fields)
+
+def completion(content: str, finish_reason: str = "stop", prompt_tokens: int = 10, completion_tokens: int = 5) -> dict:
+    return {
+        "id": "chatcmpl",
+        "model": "sakura",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": finish_reason}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                  "total_tokens": prompt_tokens + completion_tokens},
+        "timings": {"predicted_ms": 1}
+    }
+
+def test_parse_split():
+    assert parse_split(None) is None
+    assert parse_split(" Auto ") == SPLIT_PIECE_CHARS
+    assert parse_split("800") == 800
+    for value in ("0", "-5", "lots"):
+        with pytest.raises(ValueError):
+            parse_split(value)
+
+def test_pack_keeps_long_paragraphs_whole():
+    assert pack(["a" * 10, "b" * 50, "c" * 10], 20, 16) == [["a" * 10], ["b" * 50], ["c" * 10]]
+    assert pack(["a" * 5, "b" * 5, "c" * 5], 10, 16) == [["a" * 5, "b" * 5], ["c" * 5]]
+
+def test_pack_merges_neighbours_down_to_max_pieces():
+    # Two 30 character paragraphs don't fit a 55 character piece, so greedy packing leaves one per piece
+    paragraphs = ["p" * 30] * 40
+    pieces = pack(paragraphs, 55, 16)
+    assert len(pieces) == 16
+    assert [p for piece in pieces for p in piece] == paragraphs
+
+def test_short_text_is_not_split():
+    assert len(SplitRequest(chat_body("x" * (SPLIT_MIN_CHARS - 1)), 100)) == 0
+
+def test_streaming_and_odd_requests_are_not_split():
+    text = "\n".join(["x" * 100] * 20)
+    assert len(SplitRequest(chat_body(text, stream=True), 200)) == 0
+    assert len(SplitRequest({"messages": [{"role": "assistant", "content": text}]}, 200)) == 0
+    assert len(SplitRequest({"messages": "text"}, 200)) == 0
+
+def test_pieces_keep_the_prompt_and_share_max_tokens():
+    paragraphs = [str(i) * 100 for i in range(10)]
+    text = "\n".join(paragraphs[:6]) + "\n\n" + "\n".join(paragraphs[6:])
+    split = SplitRequest(chat_body(text, max_tokens=2000), 300)
+    assert len(split) == 4
+    assert split.separators == ["\n", "\n\n", "\n"]
+    for body in split.bodies:
+        assert body["messages"][0] == {"role": "system", "content": "system prompt"}
+        assert body["messages"][1]["content"].startswith("glossary" + MARKER)
+    # max_tokens is shared out by piece length, rounded up
+    assert split.bodies[-1]["max_tokens"] == math.ceil(2000 * 100 / len(text))
+    assert sum(body["max_tokens"] for body in split.bodies) <= 2000 + len(split)
+    joined = split.bodies[0]["messages"][1]["content"][len("glossary" + MARKER):]
+    assert joined == "\n".join(paragraphs[:3])
+
+def test_piece_count_stays_within_max_pieces():
+    text = "\n".join(["y" * 30] * 400)
+    split = SplitRequest(chat_body(text), 10)
+    assert 1 < len(split) <= SPLIT_MAX_PIECES
+    assert len(split.separators) == len(split) - 1
+
+def test_merge_joins_pieces_in_order():
+    text = "\n\n".join(["z" * 400] * 4)
+    split = SplitRequest(chat_body(text), 400)
+    assert len(split) == 4
+    results = [completion("one\n"), json_dumps(completion("two")), completion("three", "length"), completion("four")]
+    merged = split.merge(results)
+    assert merged["choices"][0]["message"]["content"] == "one\n\ntwo\n\nthree\n\nfour"
+    assert merged["choices"][0]["finish_reason"] == "length"
+    assert merged["usage"] == {"prompt_tokens": 40, "completion_tokens": 20, "total_tokens": 60}
+    assert merged["id"] == "chatcmpl" and "timings" not in merged
+
+def test_piece_completion_rejects_errors():
+    assert piece_completion({"error": {"message": "boom"}}) is None
+    assert piece_completion(b"not json") is None
+    assert piece_completion({"choices": []}) is None
+    assert piece_completion(json_dumps(completion("ok")))["choices"][0]["message"]["content"] == "ok"
@@ -0,0 +1,78 @@
+import time
+
+import pytest
+
+from conftest import make_task
+from custom_queue import CustomQueue, QueueMode
+from traffic import DEFAULT_CLASS, TrafficScheduler, class_of, resolve_class
+
+CLASSES = {"interactive": {"share": 0.75}, "bulk": {"share": 0.25}}
+
+def claim_next(scheduler: TrafficScheduler, waiting: set, now: float) -> str:
+    """Charge a claim to the first class in order that has tasks waiting"""
+    name = next(name for name in scheduler.order() if name in waiting)
+    scheduler.record_claim(make_task("t", traffic_class=name), now)
+    return name
+
+def test_claims_split_by_share_while_every_class_waits():
+    scheduler = TrafficScheduler(CLASSES)
+    now = time.time()
+    claims = [claim_next(scheduler, {"interactive", "bulk"}, now) for _ in range(400)]
+    assert claims.count("interactive") == 300
+    assert claims.count("bulk") == 100
+
+def test_idle_class_share_goes_to_the_others():
+    scheduler = TrafficScheduler(CLASSES)
+    now = time.time()
+    claims = [claim_next(scheduler, {"bulk"}, now) for _ in range(50)]
+    assert claims == ["bulk"] * 50
+
+def test_class_back_from_idle_does_not_cash_in_missed_claims():
+    scheduler = TrafficScheduler(CLASSES)
+    now = time.time()
+    for _ in range(100):
+        claim_next(scheduler, {"bulk"}, now)
+    # interactive was idle for 100 claims, it now gets about its share, not all 40
+    claims = [claim_next(scheduler, {"interactive", "bulk"}, now) for _ in range(40)]
+    assert 29 <= claims.count("interactive") <= 31
+
+def test_zero_share_class_only_gets_spare_capacity():
+    scheduler = TrafficScheduler({"interactive": {"share": 1}, "bulk": {"share": 0}})
+    now = time.time()
+    claims = [claim_next(scheduler, {"interactive", "bulk"}, now) for _ in range(100)]
+    assert claims.count("bulk") <= 1
+    assert claim_next(scheduler, {"bulk"}, now) == "bulk"
+
+def test_stats_and_depths():
+    scheduler = TrafficScheduler(CLASSES)
+    scheduler.record_claim(make_task("a", traffic_class="bulk"), time.time())
+    stats = scheduler.stats({"bulk": 3})
+    assert stats["bulk"]["claims"] == 1 and stats["bulk"]["claimed_share"] == 1.0 and stats["bulk"]["queued"] == 3
+    assert stats["interactive"]["queued"] == 0
+    assert scheduler.depths({"bulk": 3}) == {("interactive",): 0, ("bulk",): 3}
+
+def test_unknown_classes_count_as_the_default_class():
+    assert class_of(None) == DEFAULT_CLASS
+    assert class_of("removed") == DEFAULT_CLASS
+    assert class_of("bulk") == "bulk"
+    scheduler = TrafficScheduler(CLASSES)
+    scheduler.record_claim(make_task("a"), time.time())
+    assert scheduler.claims[DEFAULT_CLASS] == 1
+
+def test_resolve_class():
+    assert resolve_class(1, "chat") == "interactive"
+    assert resolve_class(1, "batch") == "bulk"
+    assert resolve_class(1, "chat", " Bulk ") == "bulk"
+    with pytest.raises(ValueError):
+        resolve_class(1, "chat", "urgent")
+
+def test_queue_takes_classes_in_the_given_order():
+    queue = CustomQueue()
+    queue.put(make_task("bulk", traffic_class="bulk"))
+    queue.put(make_task("legacy"))
+    queue.put(make_task("interactive", traffic_class="interactive"))
+    assert queue.class_sizes() == {"bulk": 1, DEFAULT_CLASS: 2}
+    assert queue.get(QueueMode.PURE_FIFO, classes=["bulk", "interactive"]).task_id == "bulk"
+    # Tasks without a class are scheduled as the default class
+    assert queue.get(QueueMode.PURE_FIFO, classes=["bulk", "interactive"]).task_id == "legacy"
+    assert queue.get(QueueMode.PURE_FIFO, classes=["bulk"]) is None
@@ -0,0 +1,71 @@
+from collections import deque
+from typing import Optional
+import random
+
+from utils import json_dumps, json_loads
+
+class TraceRecorder:
+    def __init__(self, capacity: int = 10000, sample_rate: float = 1.0):
+        """
+        Keep the lifecycle events of finished tasks in a fixed-size ring buffer
+        A sampled task carries a list of (timestamp, event, detail) in task.trace,
+        unsampled tasks carry None so recording an event costs one attribute check.
+        Args:
+            capacity: Number of finished traces kept, the oldest are dropped first
+            sample_rate: Fraction of tasks traced
+        """
+        self.sample_rate = sample_rate
+        self.traces = deque(maxlen=capacity)
+        self.started = 0
+        self.finished = 0
+
+    def start(self, task) -> None:
+        """Decide whether to trace a new task"""
+        if self.sample_rate >= 1 or random.random() < self.sample_rate:
+            task.trace = []
+            self.started += 1
+
+    def finish(self, task, outcome: str) -> None:
+        """Record the task's final outcome and move its trace into the buffer"""
+        if task.trace is None:
+            return
+        task.trace_event(outcome)
+        self.traces.append({
+            "task_id": task.task_id,
+            "requester_id": task.requester_id,
+            "outcome": outcome,
+            "created_at": task.created_at,
+            "deadline": task.deadline,
+            "is_job": task.is_job,
+            "prompt_tokens": task.prompt_tokens,
+            "generation_tokens": task.generation_tokens,
+            "events": task.trace
+        })
+        # A task finishes once, later events (e.g. a losing hedge copy) are not kept
+        task.trace = None
+        self.finished += 1
+
+    def find(self, task_id: str) -> Optional[dict]:
+        """Get the trace of a finished task, None if not sampled or already dropped"""
+        for trace in reversed(self.traces):
+            if trace["task_id"] == task_id:
+                return trace
+        return None
+
+    def export_jsonl(self, since: float = 0) -> bytes:
+        """Encode traces of tasks created after since as JSON lines, oldest first"""
+        return b"".join(json_dumps(trace) + b"\n" for trace in list(self.traces) if trace["created_at"] >= since)
+
+    def stats(self) -> dict:
+        return {
+            "sample_rate": self.sample_rate,
+            "started": self.started,
+            "finished": self.finished,
+            "buffered": len(self.traces),
+            "capacity": self.traces.maxlen
+        }
+
+def load_traces(path: str) -> list:
+    """Read traces exported by export_jsonl, e.g. for replay"""
+    with open(path, "rb") as f:
+        return [json_loads(line) for line in f if line.strip()]
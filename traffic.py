@@ -0,0 +1,111 @@
+from typing import Optional
+import time
+
+from config import TRAFFIC_CLASSES, TRAFFIC_CLASS_ROUTES, TRAFFIC_CLASS_USERS, CLAIM_TIMEOUT
+from metrics import TRAFFIC_CLAIMS, TRAFFIC_WAIT_SECONDS, TRAFFIC_SECONDS, TRAFFIC_SLO
+
+# Header a requester may set to pick its traffic class
+TRAFFIC_CLASS_HEADER = "X-Traffic-Class"
+
+# Keeps a class with a zero share schedulable, it then only gets spare capacity
+MIN_SHARE = 0.001
+
+# Class of tasks queued before traffic classes existed, or whose class was removed from the config
+DEFAULT_CLASS = TRAFFIC_CLASS_ROUTES["chat"]
+
+def resolve_class(user_id: int, route: str, requested: Optional[str] = None) -> str:
+    """
+    Pick the traffic class of a request
+    Args:
+        user_id: ID of the requester, accounts in TRAFFIC_CLASS_USERS are pinned to their class
+        route: "chat", "job" or "batch", decides the class when nothing else does
+        requested: Value of the X-Traffic-Class header, if any
+    Raises:
+        ValueError: If requested names an unknown class
+    """
+    pinned = TRAFFIC_CLASS_USERS.get(user_id)
+    if pinned is not None:
+        return pinned
+    if requested is not None:
+        requested = requested.strip().lower()
+        if requested not in TRAFFIC_CLASSES:
+            raise ValueError(f"Unknown traffic class {requested}, expected one of {', '.join(TRAFFIC_CLASSES)}")
+        return requested
+    return TRAFFIC_CLASS_ROUTES[route]
+
+def class_of(traffic_class: Optional[str]) -> str:
+    """Get the configured class a task is scheduled as, DEFAULT_CLASS for None or an unknown class"""
+    return traffic_class if traffic_class in TRAFFIC_CLASSES else DEFAULT_CLASS
+
+def claim_timeout(traffic_class: Optional[str]) -> float:
+    """Seconds a chat task of the class waits for a claim, and a claim may stay silent"""
+    spec = TRAFFIC_CLASSES.get(class_of(traffic_class))
+    return spec.get("claim_timeout", CLAIM_TIMEOUT) if spec is not None else CLAIM_TIMEOUT
+
+def record_request(task, failed: bool) -> None:
+    """Record a finished request's latency against its class's SLO"""
+    name = class_of(task.traffic_class)
+    spec = TRAFFIC_CLASSES.get(name)
+    if spec is None:
+        return
+    seconds = time.time() - task.created_at
+    TRAFFIC_SECONDS.labels(name).observe(seconds)
+    if failed:
+        outcome = "failed"
+    else:
+        outcome = "within_slo" if seconds <= spec.get("slo", seconds) else "over_slo"
+    TRAFFIC_SLO.labels(name, outcome).inc()
+
+class TrafficScheduler:
+    def __init__(self, classes: dict):
+        """
+        Share fetch_task claims between traffic classes (stride scheduling)
+        Every class has a pass value that grows by 1 / share with each claim,
+        and classes are offered to providers lowest pass first. While every
+        class has tasks waiting, claims split by share; a class with an empty
+        queue is skipped, so its share goes to the others. A class coming back
+        from idle restarts at the current pass instead of cashing in the
+        claims it missed, so it can't starve the rest either.
+        Each worker process schedules its own fetches.
+        Args:
+            classes: TRAFFIC_CLASSES, {name: {"share": ..., ...}}
+        """
+        self.shares = {name: max(spec.get("share", 0), MIN_SHARE) for name, spec in classes.items()}
+        self.passes = dict.fromkeys(classes, 0.0)
+        self.virtual_time = 0.0
+        self.claims = dict.fromkeys(classes, 0)
+        self._claims = {name: TRAFFIC_CLAIMS.labels(name) for name in classes}
+        self._waits = {name: TRAFFIC_WAIT_SECONDS.labels(name) for name in classes}
+
+    def order(self) -> list:
+        """Get the classes in the order their queues should be offered, larger share first on ties"""
+        return sorted(self.passes, key=lambda name: (self.passes[name], -self.shares[name]))
+
+    def record_claim(self, task, now: float) -> None:
+        """Charge a claim to the task's class"""
+        name = class_of(task.traffic_class)
+        if name not in self.passes:
+            return
+        start = max(self.passes[name], self.virtual_time)
+        self.virtual_time = start
+        self.passes[name] = start + 1 / self.shares[name]
+        self.claims[name] += 1
+        self._claims[name].inc()
+        if task.try_count == 1:
+            self._waits[name].observe(now - task.created_at)
+
+    def depths(self, sizes: dict) -> dict:
+        """Queue depth of every class for TRAFFIC_QUEUE_DEPTH, from the queue's class_sizes()"""
+        return {(name,): sizes.get(name, 0) for name in self.passes}
+
+    def stats(self, sizes: dict = None) -> dict:
+        total = sum(self.claims.values())
+        return {
+            name: {
+                "share": self.shares[name],
+                "claims": self.claims[name],
+                "claimed_share": self.claims[name] / total if total else None,
+                "queued": (sizes or {}).get(name, 0)
+            }
+            for name in self.passes
+        }
@@ -0,0 +1,236 @@
+from collections import defaultdict
+import asyncio
+import sqlite3
+import threading
+import time
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS usage_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ts REAL NOT NULL,
+        role TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        failed INTEGER NOT NULL,
+        prompt_tokens INTEGER NOT NULL,
+        generation_tokens INTEGER NOT NULL,
+        seconds REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS usage_hourly (
+        bucket INTEGER NOT NULL,
+        role TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        requests INTEGER NOT NULL,
+        failures INTEGER NOT NULL,
+        prompt_tokens INTEGER NOT NULL,
+        generation_tokens INTEGER NOT NULL,
+        seconds REAL NOT NULL,
+        PRIMARY KEY (role, user_id, bucket)
+    );
+    CREATE INDEX IF NOT EXISTS idx_usage_hourly_bucket ON usage_hourly (role, bucket);
+    CREATE TABLE IF NOT EXISTS usage_daily (
+        bucket INTEGER NOT NULL,
+        role TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        requests INTEGER NOT NULL,
+        failures INTEGER NOT NULL,
+        prompt_tokens INTEGER NOT NULL,
+        generation_tokens INTEGER NOT NULL,
+        seconds REAL NOT NULL,
+        PRIMARY KEY (role, user_id, bucket)
+    );
+    CREATE INDEX IF NOT EXISTS idx_usage_daily_bucket ON usage_daily (role, bucket);
+    CREATE TABLE IF NOT EXISTS usage_meta (
+        key TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    );
+'''
+
+ROLES = ("requester", "provider")
+
+# Rollup table and bucket width in seconds for each resolution, buckets are UTC aligned
+RESOLUTIONS = {
+    "hour": ("usage_hourly", 3600),
+    "day": ("usage_daily", 86400)
+}
+
+COLUMNS = ("requests", "failures", "prompt_tokens", "generation_tokens", "seconds")
+
+# Rollup rows summing every user of a role, so totals don't scan one row per user
+ALL_USERS = 0
+
+def connect(path: str) -> sqlite3.Connection:
+    """Open a WAL-mode connection to the usage database, creating tables if needed"""
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+class UsageStore:
+    def __init__(self, path: str, raw_retention: float = 7 * 86400, hourly_retention: float = 90 * 86400):
+        """
+        Append-only usage events rolled up into hourly and daily tables
+        Events are buffered in memory and written in batches by flush. compact
+        folds events written since the last compaction into the rollups and
+        prunes old raw events, so range queries read at most one row per
+        bucket and user whatever the history length. Several worker processes
+        may share the database.
+        Args:
+            path: Path of the usage database
+            raw_retention: Seconds raw events are kept after compaction
+            hourly_retention: Seconds hourly rollups are kept, daily rollups are kept forever
+        """
+        self.conn = connect(path)
+        self.raw_retention = raw_retention
+        self.hourly_retention = hourly_retention
+        self.buffer = []
+        self.lock = threading.Lock()
+
+    def record(self, role: str, user_id: int, failed: bool, prompt_tokens: int = 0, generation_tokens: int = 0,
+               seconds: float = 0.0) -> None:
+        """Buffer one usage event, written on the next flush"""
+        self.buffer.append((time.time(), role, user_id, int(failed), prompt_tokens, generation_tokens, seconds))
+
+    def take(self) -> list:
+        """Detach the buffered events, called on the thread that records them"""
+        events, self.buffer = self.buffer, []
+        return events
+
+    def flush(self, events: list = None) -> int:
+        """
+        Write events, by default the buffered ones, in one transaction
+        Returns:
+            int: Number of events written
+        """
+        if events is None:
+            events = self.take()
+        if not events:
+            return 0
+        with self.lock:
+            try:
+                self.conn.execute('BEGIN IMMEDIATE')
+                self.conn.executemany(
+                    'INSERT INTO usage_events (ts, role, user_id, failed, prompt_tokens, generation_tokens, seconds) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    events
+                )
+                self.conn.execute('COMMIT')
+            except BaseException:
+                if self.conn.in_transaction:
+                    self.conn.execute('ROLLBACK')
+                # Keep the events for the next flush
+                self.buffer[:0] = events
+                raise
+        return len(events)
+
+    def compact(self, now: float = None) -> int:
+        """
+        Fold events written since the last compaction into the rollups and prune old data
+        Rollup rows are incremented, so the current hour and day are partial
+        until they end and are completed by later compactions.
+        Returns:
+            int: Number of events folded
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.conn.execute("SELECT value FROM usage_meta WHERE key = 'compacted_id'").fetchone()
+                compacted_id = row[0] if row else 0
+                events = self.conn.execute(
+                    'SELECT id, ts, role, user_id, failed, prompt_tokens, generation_tokens, seconds '
+                    'FROM usage_events WHERE id > ? ORDER BY id',
+                    (compacted_id,)
+                ).fetchall()
+
+                if events:
+                    for table, width in RESOLUTIONS.values():
+                        totals = defaultdict(lambda: [0, 0, 0, 0, 0.0])
+                        for _, ts, role, user_id, failed, prompt_tokens, generation_tokens, seconds in events:
+                            bucket = int(ts // width) * width
+                            for total in (totals[(bucket, role, user_id)], totals[(bucket, role, ALL_USERS)]):
+                                total[0] += 1
+                                total[1] += failed
+                                total[2] += prompt_tokens
+                                total[3] += generation_tokens
+                                total[4] += seconds
+                        self.conn.executemany(
+                            f'INSERT INTO {table} (bucket, role, user_id, {", ".join(COLUMNS)}) '
+                            'VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+                            'ON CONFLICT (role, user_id, bucket) DO UPDATE SET '
+                            + ", ".join(f"{column} = {column} + excluded.{column}" for column in COLUMNS),
+                            [key + tuple(total) for key, total in totals.items()]
+                        )
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO usage_meta (key, value) VALUES ('compacted_id', ?)",
+                        (events[-1][0],)
+                    )
+                    compacted_id = events[-1][0]
+
+                # Ids follow time closely, so delete up to the first recent event instead of scanning ts
+                self.conn.execute(
+                    'DELETE FROM usage_events WHERE id <= ? AND id < COALESCE('
+                    '(SELECT id FROM usage_events WHERE ts >= ? ORDER BY id LIMIT 1), ?)',
+                    (compacted_id, now - self.raw_retention, compacted_id + 1)
+                )
+                self.conn.execute(
+                    f'DELETE FROM usage_hourly WHERE role IN ({", ".join("?" * len(ROLES))}) AND bucket < ?',
+                    ROLES + (now - self.hourly_retention,)
+                )
+                self.conn.execute('COMMIT')
+            except BaseException:
+                if self.conn.in_transaction:
+                    self.conn.execute('ROLLBACK')
+                raise
+        return len(events)
+
+    def query(self, role: str, start: float, end: float, resolution: str = "hour", user_id: int = None,
+              by_user: bool = False) -> list:
+        """
+        Read usage between start and end from the rollups
+        Args:
+            role: "requester" or "provider"
+            start: Start of the range, rounded down to a bucket
+            end: End of the range, exclusive
+            resolution: "hour" or "day"
+            user_id: Only this user's usage, all users if None
+            by_user: Total per user over the whole range instead of per bucket
+        Returns:
+            list: Dicts with bucket (or user_id) and the summed columns
+        """
+        table, width = RESOLUTIONS[resolution]
+        where = 'role = ? AND bucket >= ? AND bucket < ?'
+        params = [role, int(start // width) * width, end]
+        if by_user:
+            where += ' AND user_id != ?'
+            params.append(ALL_USERS)
+        else:
+            where += ' AND user_id = ?'
+            params.append(ALL_USERS if user_id is None else user_id)
+        key = 'user_id' if by_user else 'bucket'
+        sums = ", ".join(f"SUM({column})" for column in COLUMNS)
+        order = 'SUM(requests) DESC' if by_user else 'bucket'
+        with self.lock:
+            rows = self.conn.execute(
+                f'SELECT {key}, {sums} FROM {table} WHERE {where} GROUP BY {key} ORDER BY {order}',
+                params
+            ).fetchall()
+        return [dict(zip((key,) + COLUMNS, row)) for row in rows]
+
+    def close(self) -> None:
+        self.flush()
+        self.conn.close()
+
+async def maintain_usage(store: UsageStore, flush_interval: float, compact_interval: float):
+    """Periodically flush buffered events and compact them, off the event loop"""
+    last_compaction = time.monotonic()
+    while True:
+        await asyncio.sleep(flush_interval)
+        try:
+            await asyncio.to_thread(store.flush, store.take())
+            if time.monotonic() - last_compaction >= compact_interval:
+                await asyncio.to_thread(store.compact)
+                last_compaction = time.monotonic()
+        except sqlite3.Error:
+            # Retried on the next round, flush keeps unwritten events
+            pass
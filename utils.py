@@ -1,6 +1,14 @@
 import random
+import re
 import string
 
+# orjson is optional, fall back to the standard library encoder
+try:
+    import orjson
+except ImportError:
+    orjson = None
+    import json
+
 def generate_random_password(length=12):
     """
     Generate a random password with specified length
@@ -30,3 +38,73 @@ def parse_user_token(user_token: str) -> tuple[int, str]:
         return user_id, token
     except (ValueError, TypeError):
         raise ValueError("Invalid user token format")
+
+def json_loads(data):
+    """
+    Parse JSON from bytes or str
+    Raises:
+        ValueError: If data is not valid JSON
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_dumps(obj) -> bytes:
+    """Serialize obj to compact JSON bytes"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def json_string_values(data: bytes, key: str) -> list:
+    """
+    Locate the string values of a key anywhere in a JSON document without parsing it
+    A JSON string can't hold an unescaped quote, so '"key":' only matches real keys,
+    and the search runs in C instead of building the document's objects
+    Returns:
+        list: (start, end) of each value, data[start:end] being the still escaped text between its quotes
+    Raises:
+        ValueError: If a value is not terminated
+    """
+    pattern = re.compile(rb'"' + re.escape(key.encode()) + rb'"\s*:\s*"')
+    spans = []
+    match = pattern.search(data)
+    while match is not None:
+        start = end = match.end()
+        while True:
+            end = data.find(b'"', end)
+            if end < 0:
+                raise ValueError(f"Unterminated {key} string")
+            # A quote after an odd number of backslashes is escaped
+            backslashes = 0
+            while data[end - 1 - backslashes] == 0x5c:
+                backslashes += 1
+            if backslashes % 2 == 0:
+                break
+            end += 1
+        spans.append((start, end))
+        match = pattern.search(data, end + 1)
+    return spans
+
+def json_string_length(text: bytes) -> int:
+    """
+    Approximate character count of an escaped JSON string's text, as found by json_string_values
+    Japanese and Chinese text is taken to be 3 bytes per character in UTF-8 and 6 when
+    escaped as \\uXXXX, which is much cheaper than decoding or counting the escapes
+    """
+    if not text.isascii():
+        return len(text) // 3
+    if b"\\u" in text:
+        return len(text) // 6
+    return len(text)
+
+def json_has_key(data: bytes, key: str) -> bool:
+    """Check if a key appears anywhere in a JSON document without parsing it"""
+    return re.search(rb'"' + re.escape(key.encode()) + rb'"\s*:', data) is not None
+
+def json_int_value(data: bytes, key: str):
+    """Get the integer value of a key in a JSON document without parsing it, None if there is none"""
+    at = data.rfind(b'"' + key.encode() + b'"')
+    if at < 0:
+        return None
+    match = re.compile(rb'"[^"]*"\s*:\s*(-?\d+)\s*[,}]').match(data, at)
+    return int(match.group(1)) if match else None